@@ -23,6 +23,22 @@ def argument_parser():
                         help='width of an image')
     parser.add_argument('--train-sampler', type=str, default='RandomSampler',
                         help='sampler for trainloader')
+    parser.add_argument('--decode-backend', type=str, default='pil', choices=['pil', 'cv2'],
+                        help='image decoder of the loader workers')
+    parser.add_argument('--quarantine-file', type=str, default='',
+                        help='file listing the images that could not be read, they are skipped')
+    parser.add_argument('--worker-start-method', type=str, default='', choices=['', 'fork', 'spawn', 'forkserver'],
+                        help='start method of the loader workers, the platform default if not given')
+    parser.add_argument('--uint8-images', action='store_true',
+                        help='the loader workers send uint8 images, normalized by the batch on the device')
+    parser.add_argument('--no-fused-warp', action='store_true',
+                        help='augment with the chained mirror, crop and rotation instead of a single warp')
+    parser.add_argument('--batch-targets', action='store_true',
+                        help='build the vec and weight targets on the collated batch '
+                             'on the training device instead of in the loader workers')
+    parser.add_argument('--sparse-targets', action='store_true',
+                        help='send compact per polygon targets from the loader workers '
+                             'and build the vec and weight maps in the main process')
     
     # ************************************************************
     # Data augmentation
@@ -33,6 +49,16 @@ def argument_parser():
                         help='randomly change the brightness, contrast and saturation')
     parser.add_argument('--color-aug', action='store_true',
                         help='randomly alter the intensities of RGB channels')
+    parser.add_argument('--no-augment', action='store_true',
+                        help='train on resized images without random augmentation')
+    parser.add_argument('--field-augment', action='store_true',
+                        help='mirror and rotate the vec and weight targets with the image '
+                             'instead of computing them from the transformed polygons')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='with --field-augment, resize the images instead of the random crop')
+    parser.add_argument('--target-cache', type=str, default='',
+                        help='folder of precomputed targets (see build_target_cache.py), '
+                             'only used with --no-augment or --field-augment --no-crop')
     
     # ************************************************************
     # Dataset-specific setting
@@ -156,7 +182,18 @@ def image_dataset_kwargs(parsed_args):
         'train_batch_size': parsed_args.train_batch_size,
         'test_batch_size': parsed_args.test_batch_size,
         'workers': parsed_args.workers,
-        'train_sampler': parsed_args.train_sampler
+        'train_sampler': parsed_args.train_sampler,
+        'batch_targets': parsed_args.batch_targets,
+        'sparse_targets': parsed_args.sparse_targets,
+        'augment': not parsed_args.no_augment,
+        'field_augment': parsed_args.field_augment,
+        'crop': not parsed_args.no_crop,
+        'target_cache': parsed_args.target_cache,
+        'decode_backend': parsed_args.decode_backend,
+        'quarantine_file': parsed_args.quarantine_file,
+        'start_method': parsed_args.worker_start_method,
+        'uint8_images': parsed_args.uint8_images,
+        'fused_warp': not parsed_args.no_fused_warp
     }
 
 
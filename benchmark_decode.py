@@ -0,0 +1,31 @@
+import argparse
+import glob
+
+from torchtext.image_reader import ImageReader
+
+
+def benchmark_decode(image_paths, min_size=None, repeat=3):
+    """Decode time per image of every backend, full size and reduced to min_size"""
+    for backend in ImageReader.backends:
+        for size in (None, min_size):
+            reader = ImageReader(backend)
+            for _ in range(repeat):
+                for img_path in image_paths:
+                    try:
+                        reader.read(img_path, size)
+                    except IOError as err:
+                        print(err)
+            print('=> {} decode, {}'.format(backend, 'at least {}x{}'.format(*size) if size else 'full size'))
+            print(reader.summary())
+            if min_size is None:
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', type=str, help='folder of .jpg images')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    benchmark_decode(sorted(glob.glob(args.folder + '/*.jpg')), (args.height, args.width), args.repeat)
@@ -0,0 +1,116 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import torch
+
+from torchtext.dataset_loader import DetectDataset
+from torchtext.targets import build_targets, collate_sparse_targets, densify_targets, tensor_bytes
+from torchtext.utils.misc import AverageMeter
+
+
+def random_polygons(rng, height, width, num_polygon, hard_ratio=0.1):
+    """Word like polygons, some crossing the image border, some overlapping"""
+    bboxes = []
+    hards = []
+    for _ in range(num_polygon):
+        cx = rng.randint(-20, width + 20)
+        cy = rng.randint(-20, height + 20)
+        num_point = rng.randint(4, 15)
+        angle = np.sort(rng.rand(num_point)) * 2 * np.pi
+        rx = rng.randint(10, max(11, width // 6))
+        ry = rng.randint(5, max(6, height // 20))
+        points = np.stack([cx + rx * np.cos(angle), cy + ry * np.sin(angle)], axis=1)
+        bboxes.append(points.astype(np.int32))
+        hards.append(int(rng.rand() < hard_ratio))
+    return bboxes, hards
+
+
+def benchmark_cal_vector(size=768, num_polygon=40, repeat=20, seed=0):
+    """Time of cal_vector per sample, and its peak memory traced by tracemalloc"""
+    rng = np.random.RandomState(seed)
+    dataset = DetectDataset([])
+    image = np.zeros((size, size, 3), np.float32)
+    batch_time = AverageMeter()
+    peak_memory = AverageMeter()
+    max_peak = 0
+    for _ in range(repeat):
+        bboxes, hards = random_polygons(rng, size, size, num_polygon)
+        start = time.time()
+        dataset.cal_vector(image, bboxes, hards)
+        batch_time.update(time.time() - start)
+
+        tracemalloc.start()
+        dataset.cal_vector(image, bboxes, hards)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_memory.update(peak)
+        max_peak = max(max_peak, peak)
+    print('cal_vector {}x{} {} polygons: {:.1f} ms/sample, peak memory {:.1f} MB/sample '
+          '(max {:.1f} MB)'.format(size, size, num_polygon, batch_time.avg * 1000,
+                                   peak_memory.avg / 2**20, max_peak / 2**20))
+
+
+def benchmark_build_targets(size=768, num_polygon=40, repeat=20, batch_size=8, seed=0, device=None):
+    """Time of build_targets per sample, the whole batch built at once on device"""
+    rng = np.random.RandomState(seed)
+    batch_time = AverageMeter()
+    for _ in range(repeat):
+        polygons = [random_polygons(rng, size, size, num_polygon) for _ in range(batch_size)]
+        bboxes = [bboxes for bboxes, _ in polygons]
+        hards = [hards for _, hards in polygons]
+        start = time.time()
+        build_targets((batch_size, 3, size, size), bboxes, hards, device=device)
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        batch_time.update((time.time() - start) / batch_size, batch_size)
+    print('build_targets {}x{} {} polygons, batch {} on {}: {:.1f} ms/sample'.format(
+        size, size, num_polygon, batch_size, device or 'cpu', batch_time.avg * 1000))
+
+
+def benchmark_transport(size=768, num_polygon=40, repeat=20, batch_size=8, seed=0):
+    """Bytes of targets per batch sent by the loader workers, dense and compact,
+    and the time to densify the compact ones in the main process"""
+    rng = np.random.RandomState(seed)
+    dataset = DetectDataset([])
+    image = np.zeros((size, size, 3), np.float32)
+    dense_bytes = AverageMeter()
+    sparse_bytes = AverageMeter()
+    densify_time = AverageMeter()
+    for _ in range(repeat):
+        dense, sparse = [], []
+        for _ in range(batch_size):
+            bboxes, hards = random_polygons(rng, size, size, num_polygon)
+            _, vec, weight = dataset.cal_vector(image, bboxes, hards)
+            dense.append(vec.nbytes + weight.nbytes)
+            sparse.append(dataset.cal_patches(image, bboxes, hards))
+        _, targets = collate_sparse_targets(sparse)
+        start = time.time()
+        densify_targets(targets)
+        densify_time.update(time.time() - start)
+        dense_bytes.update(sum(dense))
+        sparse_bytes.update(tensor_bytes(targets.values()))
+    print('targets {}x{} {} polygons, batch {}: dense {:.2f} MB/batch, compact {:.2f} MB/batch, '
+          'densify {:.1f} ms/batch'.format(size, size, num_polygon, batch_size, dense_bytes.avg / 2**20,
+                                          sparse_bytes.avg / 2**20, densify_time.avg * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=768)
+    parser.add_argument('--num-polygon', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--batch-targets', action='store_true',
+                        help='also time build_targets on the batch')
+    parser.add_argument('--transport', action='store_true',
+                        help='also measure the bytes of dense and compact targets per batch')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--device', type=str, default=None)
+    args = parser.parse_args()
+    benchmark_cal_vector(args.size, args.num_polygon, args.repeat)
+    if args.transport:
+        benchmark_transport(args.size, args.num_polygon, args.repeat, args.batch_size)
+    if args.batch_targets:
+        device = torch.device(args.device) if args.device else None
+        benchmark_build_targets(args.size, args.num_polygon, args.repeat, args.batch_size,
+                                device=device)
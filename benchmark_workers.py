@@ -0,0 +1,113 @@
+import argparse
+import pickle
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from torchtext.datasets import init_detect_dataset
+from torchtext.datasets.sample_index import SampleIndex
+from torchtext.dataset_loader import DetectDataset
+from torchtext.transforms import build_transforms, batch_normalize
+from torchtext.utils.avgmeter import AverageMeter
+from torchtext.models import init_model
+
+
+def worker_memory(pid):
+    """rss, pss and private memory in MB of a process, read from /proc"""
+    memory = {'Rss': 0, 'Pss': 0, 'Private': 0}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            key = 'Private' if key.startswith('Private') else key
+            if key in memory:
+                memory[key] += int(value.split()[0]) / 1024.
+    return memory
+
+
+def benchmark_workers(samples, transform, model, start_method='spawn', workers=2, batch_size=2):
+    """
+    Time to the first batch and memory of the loader workers, for the dataset
+    alone and holding the model as DetectDataset(model, ...) used to
+    """
+    for with_model in (False, True):
+        dataset = DetectDataset(samples, transform_image=transform)
+        if with_model:
+            dataset.model = model
+        pickled = len(pickle.dumps(dataset)) / 2 ** 20
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers,
+                            multiprocessing_context=start_method)
+        start = time.time()
+        try:
+            batches = iter(loader)
+            next(batches)
+        except (ValueError, RuntimeError, OSError) as err:
+            print('=> {}, {}: workers failed to start: {}'.format(
+                start_method, 'with model' if with_model else 'dataset only', err))
+            continue
+        startup = time.time() - start
+        memory = [worker_memory(worker.pid) for worker in batches._workers]
+        del batches
+        print('=> {}, {}: pickled dataset {:.1f} MB, first batch {:.2f} s'.format(
+            start_method, 'with model' if with_model else 'dataset only', pickled, startup))
+        for key in ('Rss', 'Pss', 'Private'):
+            print('   {:8s} per worker {:.1f} MB'.format(key, sum(m[key] for m in memory) / len(memory)))
+
+
+def benchmark_image_transfer(samples, height, width, workers=2, batch_size=8, batches=20, device='cpu'):
+    """
+    Bytes of images per batch sent by the loader workers and loader
+    throughput, with float32 images normalized in the workers and with uint8
+    images normalized by the batch on device
+    """
+    for uint8_images in (False, True):
+        transform = build_transforms(height, width, is_train=True, normalize=not uint8_images)
+        loader = DataLoader(DetectDataset(samples, transform_image=transform), batch_size=batch_size,
+                            shuffle=True, num_workers=workers, drop_last=True)
+        normalize = batch_normalize()
+        image_bytes = AverageMeter()
+        count = 0
+        start = None
+        while count < batches:
+            for imgs, _, _ in loader:
+                # the first batch includes the start of the workers
+                if start is None:
+                    start = time.time()
+                    continue
+                image_bytes.update(imgs.numel() * imgs.element_size())
+                imgs = normalize(imgs.to(device))
+                count += 1
+                if count == batches:
+                    break
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        print('=> {} images: {:.2f} MB per batch, {:.1f} img/s'.format(
+            'uint8' if uint8_images else 'float32', image_bytes.avg / 2 ** 20, count * batch_size / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default='data')
+    parser.add_argument('-s', '--source-names', type=str, required=True, nargs='+')
+    parser.add_argument('--arch', type=str, default='se_resnext101_32x4d')
+    parser.add_argument('--start-methods', type=str, nargs='+', default=['fork', 'spawn'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--image-transfer', action='store_true',
+                        help='benchmark the images sent by the workers as float32 and as uint8 instead')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+    samples = SampleIndex.concatenate([init_detect_dataset(root=args.root, name=name).train
+                                       for name in args.source_names])
+    if args.image_transfer:
+        benchmark_image_transfer(samples, args.height, args.width, args.workers, args.batch_size,
+                                 args.batches, args.device)
+        exit()
+    transform = build_transforms(args.height, args.width, is_train=False)
+    model = init_model(name=args.arch)
+    for start_method in args.start_methods:
+        benchmark_workers(samples, transform, model, start_method, args.workers, args.batch_size)
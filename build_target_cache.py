@@ -0,0 +1,39 @@
+import argparse
+import numpy as np
+
+from torchtext.datasets import init_detect_dataset
+from torchtext.transforms import build_transforms
+from torchtext.target_cache import build_target_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Precompute the vec and weight targets of the resized, not augmented, '
+                    'training images, see --target-cache of train_text_net.py')
+    parser.add_argument('--root', type=str, default='data',
+                        help='root path to data directory')
+    parser.add_argument('-s', '--source-names', type=str, required=True, nargs='+',
+                        help='source datasets (delimited by space)')
+    parser.add_argument('--height', type=int, default=384,
+                        help='height of an image')
+    parser.add_argument('--width', type=int, default=384,
+                        help='width of an image')
+    parser.add_argument('--cache-dir', type=str, required=True,
+                        help='folder of the cache, updated when it already exists')
+    parser.add_argument('--float16', action='store_true',
+                        help='store the targets as float16')
+    args = parser.parse_args()
+
+    samples = []
+    for name in args.source_names:
+        dataset = init_detect_dataset(root=args.root, name=name)
+        for img_path, annotation_path, parse_txt in dataset.train:
+            samples.append([img_path, annotation_path, parse_txt])
+    transform = build_transforms(args.height, args.width, is_train=False)
+    computed = build_target_cache(samples, transform, args.cache_dir,
+                                  dtype=np.float16 if args.float16 else np.float32)
+    print('=> {} of {} samples computed in {}'.format(computed, len(samples), args.cache_dir))
+
+
+if __name__ == "__main__":
+    main()
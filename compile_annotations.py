@@ -0,0 +1,26 @@
+import argparse
+import os
+
+from torchtext.datasets import init_detect_dataset
+from torchtext.datasets.compiled import compile_annotations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parse the annotations of datasets once into a columnar store, '
+                    'loaded back as -s compiled-<name>. Run it again after editing annotations')
+    parser.add_argument('--root', type=str, default='data',
+                        help='root path to data directory')
+    parser.add_argument('-s', '--source-names', type=str, required=True, nargs='+',
+                        help='datasets to compile (delimited by space)')
+    args = parser.parse_args()
+
+    for name in args.source_names:
+        dataset = init_detect_dataset(root=args.root, name=name)
+        store_dir = os.path.join(args.root, 'compiled', name)
+        count = compile_annotations(dataset.train, store_dir)
+        print('=> {} of {} samples of {} compiled in {}'.format(count, len(dataset.train), name, store_dir))
+
+
+if __name__ == "__main__":
+    main()
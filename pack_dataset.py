@@ -0,0 +1,28 @@
+import argparse
+import os
+
+from torchtext.datasets import init_detect_dataset
+from torchtext.datasets.packed import pack_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pack the images and annotations of datasets into large shard files, '
+                    'loaded back as -s packed-<name>')
+    parser.add_argument('--root', type=str, default='data',
+                        help='root path to data directory')
+    parser.add_argument('-s', '--source-names', type=str, required=True, nargs='+',
+                        help='datasets to pack (delimited by space)')
+    parser.add_argument('--shard-size', type=int, default=1024,
+                        help='size of a shard in MB')
+    args = parser.parse_args()
+
+    for name in args.source_names:
+        dataset = init_detect_dataset(root=args.root, name=name)
+        pack_dir = os.path.join(args.root, 'packed', name)
+        count = pack_samples(dataset.train, pack_dir, shard_size=args.shard_size << 20)
+        print('=> {} of {} samples of {} packed in {}'.format(count, len(dataset.train), name, pack_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
+import argparse
 import torch
 from PIL import Image
-from torchtext.transforms import build_transforms
+from torchtext.transforms import build_transforms, batch_normalize
 import numpy as np
 from torchtext.models import init_model
-from torchtext.utils.misc import process_output, mkdirs
+from torchtext.utils.misc import mkdirs
+from torchtext.utils.avgmeter import AverageMeter
+from torchtext.inference import FieldPostProcessor
+from torchtext.dataset_loader import FolderImageDataset
+from torchtext.samplers import BucketBatchSampler
+from torch.utils.data import DataLoader
 import pickle
 from functools import partial
 import cv2
@@ -11,6 +17,8 @@ import queue
 import glob
 from tqdm import tqdm
 import os
+import time
+from collections import deque
 
 
 def load_model(model, model_path):
@@ -35,32 +43,149 @@ def write_to_file(contours, file_path):
             f.write(cont + '\n')
 
 
-def test(path_input, path_output):
-    mkdirs(path_output)
+def load_test_model():
     model = init_model(name='se_resnext101_32x4d')
     load_model(
         model, 'log/se_resnext101_32x4d-final-text-net-total-text-768-2/quick_save_checkpoint_ep81.pth.tar')
     model = model.to('cuda')
     model.eval()
+    return model
+
+
+def flush_results(pending, max_pending, post_time, wait_time):
+    """Write the oldest results of pending (file path, future) until at most max_pending are left"""
+    while len(pending) > max_pending:
+        file_path, future = pending.popleft()
+        end = time.time()
+        contours, elapsed = future.result()
+        wait_time.update(time.time() - end)
+        post_time.update(elapsed)
+        write_to_file(contours, file_path)
+
+
+def test(path_input, path_output, workers=0, threshold=0.4, min_area=200):
+    """
+    Detect text in every jpg of path_input and write one txt per image
+    :param workers: (int), post-process fields in that many processes while
+                    the next images go through the model, 0 runs everything in turn
+    """
+    mkdirs(path_output)
+    model = load_test_model()
     transform = build_transforms(
         maxHeight=512, maxWidth=512, is_train=False)
     list_image = glob.glob(path_input+'/*.jpg')
+    forward_time = AverageMeter()
+    post_time = AverageMeter()
+    wait_time = AverageMeter()
+    post = FieldPostProcessor(workers, threshold=threshold, min_area=min_area)
+    pending = deque()
+
+    start = time.time()
     for idx in tqdm(range(len(list_image))):
         path_image = list_image[idx]
         image_id = path_image.split('/')[-1]
         im = Image.open(path_image)
         image = np.array(im)
         img, _ = transform(np.copy(image), None)
+        end = time.time()
         im = img.transpose(2, 0, 1)
         im = torch.Tensor(im).to('cuda').unsqueeze(0)
         with torch.no_grad():
             output = model(im)
-        contours = process_output(img, output[0].to(
-            'cpu').numpy(), image, threshold=0.4, min_area=200)
-        write_to_file(contours, os.path.join(
-            path_output, image_id.replace('jpg', 'txt')))
+        field = output[0].to('cpu').numpy()
+        forward_time.update(time.time() - end)
+        pending.append((os.path.join(path_output, image_id.replace('jpg', 'txt')),
+                        post.submit(field, image.shape)))
+        flush_results(pending, 2 * workers, post_time, wait_time)
+    flush_results(pending, 0, post_time, wait_time)
+    post.shutdown()
+    elapsed = time.time() - start
+    print('Forward {:.4f}s/img  Post-process {:.4f}s/img  Waiting for post-process {:.4f}s/img'.format(
+        forward_time.avg, post_time.avg, wait_time.avg))
+    print('Total {:.1f}s, {:.2f} img/s'.format(
+        elapsed, len(list_image) / max(elapsed, 1e-6)))
+
+
+def test_batched(path_input, path_output, batch_size=8, workers=4, post_workers=0,
+                 keep_ratio=False, reduced_decode=False, uint8_images=False, threshold=0.4, min_area=200):
+    """
+    Same as test, but images are decoded and transformed by DataLoader workers
+    and go through the model batch_size at a time
+    :param workers: (int), DataLoader workers
+    :param post_workers: (int), post-processing processes, see test
+    :param keep_ratio: (bool), see FolderImageDataset, batches only mix images of the same size
+    :param reduced_decode: (bool), see FolderImageDataset
+    :param uint8_images: (bool), the loader workers send uint8 images,
+                         normalized on the GPU by the batch
+    """
+    mkdirs(path_output)
+    model = load_test_model()
+    list_image = glob.glob(path_input+'/*.jpg')
+    dataset = FolderImageDataset(
+        list_image, maxHeight=512, maxWidth=512, keep_ratio=keep_ratio,
+        reduced_decode=reduced_decode, uint8_images=uint8_images)
+    normalize = batch_normalize()
+    sampler = BucketBatchSampler(
+        [dataset.target_size(idx) for idx in range(len(dataset))], batch_size)
+    loader = DataLoader(dataset, batch_sampler=sampler,
+                        num_workers=workers, pin_memory=True)
+    data_time = AverageMeter()
+    image_bytes = AverageMeter()
+    forward_time = AverageMeter()
+    post_time = AverageMeter()
+    wait_time = AverageMeter()
+    post = FieldPostProcessor(post_workers, threshold=threshold, min_area=min_area)
+    pending = deque()
+
+    start = time.time()
+    end = time.time()
+    for imgs, raw_shapes, indices in tqdm(loader):
+        data_time.update(time.time() - end)
+        image_bytes.update(imgs.numel() * imgs.element_size())
+        end = time.time()
+        with torch.no_grad():
+            outputs = model(normalize(imgs.to('cuda', non_blocking=True)))
+        fields = outputs.to('cpu').numpy()
+        forward_time.update(time.time() - end)
+        for field, raw_shape, idx in zip(fields, raw_shapes.numpy(), indices.tolist()):
+            image_id = list_image[idx].split('/')[-1]
+            pending.append((os.path.join(path_output, image_id.replace('jpg', 'txt')),
+                            post.submit(field, raw_shape)))
+        flush_results(pending, 2 * post_workers, post_time, wait_time)
+        end = time.time()
+    flush_results(pending, 0, post_time, wait_time)
+    post.shutdown()
+    elapsed = time.time() - start
+    print('Batch size {}, {} loader workers, {} post-process workers'.format(
+        batch_size, workers, post_workers))
+    print('Data {:.4f}s/batch  Forward {:.4f}s/batch  Post-process {:.4f}s/img  Waiting for post-process {:.4f}s/img'.format(
+        data_time.avg, forward_time.avg, post_time.avg, wait_time.avg))
+    print('Images moved per batch: {:.2f} MB'.format(image_bytes.avg / 2**20))
+    print('Total {:.1f}s, {:.2f} img/s'.format(
+        elapsed, len(list_image) / max(elapsed, 1e-6)))
 
 
 if __name__ == "__main__":
-    test('./data/total-text/Images/Test', 'output/total-text-768-81-0.4-200-512')
-    os.system('python Deteval.py total-text-768-81-0.4-200-512')
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='./data/total-text/Images/Test')
+    parser.add_argument('--name', type=str, default='total-text-768-81-0.4-200-512',
+                        help='results are written to output/<name> and evaluated by Deteval.py')
+    parser.add_argument('--batched', action='store_true',
+                        help='decode in DataLoader workers and run the model on batches, see test_batched')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='DataLoader workers of --batched')
+    parser.add_argument('--post-workers', type=int, default=0,
+                        help='post-processing processes')
+    parser.add_argument('--keep-ratio', action='store_true')
+    parser.add_argument('--reduced-decode', action='store_true')
+    parser.add_argument('--uint8-images', action='store_true')
+    args = parser.parse_args()
+    path_output = os.path.join('output', args.name)
+    if args.batched:
+        test_batched(args.input, path_output, batch_size=args.batch_size, workers=args.workers,
+                     post_workers=args.post_workers, keep_ratio=args.keep_ratio,
+                     reduced_decode=args.reduced_decode, uint8_images=args.uint8_images)
+    else:
+        test(args.input, path_output, workers=args.post_workers)
+    os.system('python Deteval.py {}'.format(args.name))
\ No newline at end of file
@@ -0,0 +1,207 @@
+import os
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from benchmark_targets import random_polygons
+from benchmark_workers import worker_memory
+from torchtext.dataset_loader import DetectDataset, balanced_weight
+from torchtext.transforms import build_transforms
+from test_target_cache import _make_samples
+
+
+def _cal_vector_reference(image, bboxes, hards):
+    # the per polygon cal_vector, drawing every polygon on full image maps
+    height, width = image.shape[0:2]
+    accumulation = np.zeros((3, height, width), dtype=np.float32)
+    for bboxi, points in enumerate(bboxes):
+        points = points.astype(np.int32)
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
+        if right < 0 or bottom < 0:
+            continue
+        if left > width-1 or top > height-1:
+            continue
+        left = max(0, left)
+        top = max(0, top)
+        right = min(width-1, right)
+        bottom = min(height-1, bottom)
+        new_points = points - [left,top]+1
+        new_height = bottom-top+3
+        new_width = right-left+3
+        hard = hards[bboxi]
+        new_seg = np.zeros((new_height, new_width), dtype=np.uint8)
+        cv2.fillPoly(new_seg, [new_points], (1,))
+        contours = np.array(
+            [[0, 0], [new_seg.shape[1]-1, 0], [new_seg.shape[1]-1, new_seg.shape[0]-1], [0, new_seg.shape[0]-1]])
+        cv2.drawContours(new_seg, [contours], -1, (0,), 1)
+        new_img = new_seg.astype(np.uint8)
+        dst, labels = cv2.distanceTransformWithLabels(
+            new_img, cv2.DIST_L2, cv2.DIST_MASK_PRECISE, labelType=cv2.DIST_LABEL_PIXEL)
+        index = np.copy(labels)
+        index[new_img > 0] = 0
+        place = np.argwhere(index > 0)
+        nearCord = place[labels-1, :]
+        # x height, y width
+        x = nearCord[:, :, 0]
+        y = nearCord[:, :, 1]
+        nearPixel = np.zeros((2, new_height, new_width))
+        nearPixel[0, :, :] = x
+        nearPixel[1, :, :] = y
+        grid = np.indices(new_img.shape)
+        grid = grid.astype(np.float32)
+        diff = grid - nearPixel
+        dist = np.sqrt(np.sum(diff**2, axis=0))
+
+        new_direction = np.zeros(
+            (3, new_height, new_width), dtype=np.float32)
+        new_direction[0, new_img > 0] = np.divide(
+            diff[0, new_img > 0], dist[new_img > 0])
+        new_direction[1, new_img > 0] = np.divide(
+            diff[1, new_img > 0], dist[new_img > 0])
+
+        direction = np.zeros(
+            (3, height, width), dtype=np.float32)
+        direction[:, top:bottom+1, left:right +
+                  1] = new_direction[:, 1:new_height-1, 1:new_width-1]
+
+        seg = np.zeros(image.shape[0:2], dtype=np.uint8)
+        cv2.fillPoly(seg, [points], (1,))
+        img = seg.astype(np.uint8)
+        if hard == 0:
+            direction[2, img > 0] = bboxi+1
+        else:
+            direction[2, img > 0] = -1
+
+        accumulation[0, img > 0] = 0
+        accumulation[1, img > 0] = 0
+        accumulation[2, img > 0] = 0
+        accumulation = accumulation + direction
+    vec = np.stack((accumulation[0], accumulation[1]))
+    # compute weight
+    weight = np.zeros((height, width), dtype=np.float32)
+    weight[accumulation[2] < 0] = -1
+    posRegion = accumulation[2] > 0
+    posCount = np.sum(posRegion)
+    if posCount != 0:
+        bboxRemain = 0
+        for bboxi, polygon in enumerate(bboxes):
+            overlap_bboxi = accumulation[2] == (bboxi+1)
+            overlapCount_bboxi = np.sum(overlap_bboxi)
+            if overlapCount_bboxi == 0:
+                continue
+            bboxRemain = bboxRemain+1
+        bboxAve = float(posCount)/bboxRemain
+        for bboxi, polygon in enumerate(bboxes):
+            overlap_bboxi = accumulation[2] == (bboxi+1)
+            overlapCount_bboxi = np.sum(overlap_bboxi)
+            if overlapCount_bboxi == 0:
+                continue
+            pixAve = bboxAve/overlapCount_bboxi
+            weight = weight*(~overlap_bboxi) + pixAve*overlap_bboxi
+    return image, vec, weight.astype(np.float32)
+
+
+def _assert_bit_identical(result, expected):
+    assert result.dtype == expected.dtype and result.shape == expected.shape
+    assert np.ascontiguousarray(result).tobytes() == np.ascontiguousarray(expected).tobytes()
+
+
+def _fixed_polygons():
+    height, width = 60, 80
+    bboxes = [
+        # crossing the top left corner, then the right border
+        np.array([[-10, -5], [20, -8], [25, 15], [-3, 12]]),
+        np.array([[70, 20], [95, 22], [90, 40], [68, 38]]),
+        # overlapping the first one, hard, then overlapped by a normal one
+        np.array([[10, 5], [40, 5], [40, 25], [10, 25]]),
+        np.array([[30, 10], [55, 12], [50, 35], [28, 30]]),
+        # outside the image, a single pixel and a line
+        np.array([[-30, -30], [-10, -30], [-10, -10]]),
+        np.array([[100, 10], [120, 10], [120, 30]]),
+        np.array([[40, 50], [40, 50], [40, 50]]),
+        np.array([[5, 55], [60, 55], [60, 55]]),
+        # covering the whole image
+        np.array([[-5, 45], [85, 45], [85, 65], [-5, 65]]),
+    ]
+    hards = [0, 0, 1, 0, 0, 0, 0, 1, 0]
+    return height, width, [points.astype(np.int32) for points in bboxes], hards
+
+
+def test_cal_vector_matches_per_polygon_reference():
+    dataset = DetectDataset([])
+    cases = [_fixed_polygons()]
+    rng = np.random.RandomState(0)
+    for height, width, num_polygon in ((64, 64, 0), (96, 128, 6), (160, 120, 25), (200, 200, 40)):
+        cases.append((height, width) + random_polygons(rng, height, width, num_polygon, hard_ratio=0.3))
+    for height, width, bboxes, hards in cases:
+        image = np.zeros((height, width, 3), np.float32)
+        _, expected_vec, expected_weight = _cal_vector_reference(image, bboxes, hards)
+        _, vec, weight = dataset.cal_vector(image, bboxes, hards)
+        _assert_bit_identical(vec, expected_vec)
+        _assert_bit_identical(weight, expected_weight)
+
+
+def _balanced_weight_reference(instance, num_polygon):
+    # the weight of cal_vector before the bincount, a full map per instance
+    weight = np.zeros(instance.shape, dtype=np.float32)
+    weight[instance < 0] = -1
+    posRegion = instance > 0
+    posCount = np.sum(posRegion)
+    if posCount != 0:
+        bboxRemain = 0
+        for bboxi in range(num_polygon):
+            overlap_bboxi = instance == (bboxi+1)
+            overlapCount_bboxi = np.sum(overlap_bboxi)
+            if overlapCount_bboxi == 0:
+                continue
+            bboxRemain = bboxRemain+1
+        bboxAve = float(posCount)/bboxRemain
+        for bboxi in range(num_polygon):
+            overlap_bboxi = instance == (bboxi+1)
+            overlapCount_bboxi = np.sum(overlap_bboxi)
+            if overlapCount_bboxi == 0:
+                continue
+            pixAve = bboxAve/overlapCount_bboxi
+            weight = weight*(~overlap_bboxi) + pixAve*overlap_bboxi
+    return weight.astype(np.float32)
+
+
+def test_balanced_weight_matches_instance_loop():
+    rng = np.random.RandomState(0)
+    cases = [(np.zeros((20, 30), np.float32), 0), (np.full((20, 30), -1, np.float32), 3)]
+    for num_polygon in (1, 5, 17, 40):
+        # rectangles of random instances over each other, some polygons
+        # drawn nowhere, don't care ones marked -1
+        instance = np.zeros((64, 96), np.float32)
+        for _ in range(num_polygon):
+            top, left = rng.randint(0, 60), rng.randint(0, 90)
+            value = -1 if rng.rand() < 0.2 else rng.randint(1, num_polygon + 1)
+            instance[top:top+rng.randint(1, 20), left:left+rng.randint(1, 30)] = value
+        cases.append((instance, num_polygon))
+    for instance, num_polygon in cases:
+        _assert_bit_identical(balanced_weight(instance, num_polygon),
+                              _balanced_weight_reference(instance, num_polygon))
+
+
+def test_detect_dataset_pickles_without_model(tmp_path):
+    samples = _make_samples(tmp_path)
+    dataset = DetectDataset(samples, transform_image=build_transforms(64, 64, is_train=False))
+    assert not any(isinstance(value, torch.nn.Module) for value in vars(dataset).values())
+    # what the spawned workers receive: the sample index, the transform and the reader
+    data = pickle.dumps(dataset)
+    assert len(data) < 1 << 16
+    restored = pickle.loads(data)
+    for i in range(len(samples)):
+        for result, expected in zip(restored[i], dataset[i]):
+            np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'), reason='needs /proc/<pid>/smaps_rollup')
+def test_worker_memory():
+    memory = worker_memory(os.getpid())
+    assert sorted(memory) == ['Private', 'Pss', 'Rss']
+    assert memory['Rss'] >= memory['Pss'] > 0 and memory['Rss'] >= memory['Private'] > 0
@@ -0,0 +1,112 @@
+import json
+import pickle
+
+import cv2
+import numpy as np
+
+from torchtext.datasets.compiled import CompiledText, compile_annotations
+from torchtext.datasets.packed import PackedText, decode_annotation, encode_annotation, pack_samples, read_packed
+from torchtext.datasets.sample_index import SampleIndex
+from torchtext.image_reader import ImageReader
+
+
+def _parse_json(annotation_path):
+    # [[points, dtype, orient, text]...] written by _make_samples
+    with open(annotation_path) as f:
+        return [[np.array(points, dtype), orient, text] for points, dtype, orient, text in json.load(f)]
+
+
+def _make_samples(folder, count=5):
+    """png images and json annotations, point types, unicode texts and an image without text"""
+    rng = np.random.RandomState(0)
+    dtypes = ['int32', 'int64', 'float32', 'float64', 'int16']
+    samples = []
+    for i in range(count):
+        img_path = str(folder / '{}.png'.format(i))
+        cv2.imwrite(img_path, rng.randint(0, 255, (20 + i, 30, 3)).astype(np.uint8))
+        polygons = [[rng.randint(0, 30, (rng.randint(3, 9), 2)).tolist(), dtypes[(i + j) % len(dtypes)],
+                     ['c', 'h', 'm'][j % 3], ['text', '###', 'über', '文字'][(i + j) % 4]]
+                    for j in range(i % 4)]
+        annotation_path = str(folder / '{}.json'.format(i))
+        with open(annotation_path, 'w') as f:
+            json.dump(polygons, f)
+        samples.append([img_path, annotation_path, _parse_json])
+    return samples
+
+
+def _assert_same_polygons(result, expected):
+    assert len(result) == len(expected)
+    for (pts, orient, text), (expected_pts, expected_orient, expected_text) in zip(result, expected):
+        # point types out of the supported ones come back as float64
+        dtype = expected_pts.dtype if expected_pts.dtype != np.int16 else np.float64
+        assert pts.dtype == dtype
+        np.testing.assert_array_equal(pts, expected_pts.reshape(-1, 2))
+        assert (orient, text) == (expected_orient, expected_text)
+
+
+def test_packed_round_trip(tmp_path):
+    samples = _make_samples(tmp_path)
+    samples.insert(2, [samples[0][0], str(tmp_path / 'missing.json'), _parse_json])
+    pack_dir = tmp_path / 'data' / 'packed' / 'small'
+    # a shard of a few hundred bytes, the images spread over several
+    assert pack_samples(samples, str(pack_dir), shard_size=200, verbose=False) == len(samples) - 1
+    dataset = PackedText(root=str(tmp_path / 'data'), name='small', verbose=False)
+    del samples[2]
+    assert len(dataset.train) == len(samples) and len(list(pack_dir.glob('*.pack'))) > 1
+
+    reader = ImageReader()
+    for (img_ref, annotation_ref, parse), (img_path, annotation_path, parse_json) in zip(dataset.train, samples):
+        with open(img_path, 'rb') as f:
+            assert bytes(read_packed(img_ref)) == f.read()
+        np.testing.assert_array_equal(reader.read(img_ref)[0], reader.read(img_path)[0])
+        _assert_same_polygons(parse(annotation_ref), parse_json(annotation_path))
+    assert decode_annotation(encode_annotation([])) == []
+
+
+def test_compiled_store_matches_parsed(tmp_path):
+    samples = _make_samples(tmp_path, count=7)
+    samples.insert(3, [samples[0][0], str(tmp_path / 'missing.json'), _parse_json])
+    store_dir = tmp_path / 'data' / 'compiled' / 'small'
+    assert compile_annotations(samples, str(store_dir), verbose=False) == len(samples) - 1
+    dataset = CompiledText(root=str(tmp_path / 'data'), name='small', verbose=False)
+    del samples[3]
+    assert [sample[0] for sample in dataset.train] == [sample[0] for sample in samples]
+    for (_, annotation_ref, parse), (_, annotation_path, parse_json) in zip(dataset.train, samples):
+        _assert_same_polygons(parse(annotation_ref), parse_json(annotation_path))
+
+
+def _parse_orients(annotation_path):
+    # one polygon per distinct orient
+    index = int(annotation_path)
+    return [[np.array([[index, 0], [index, 1], [index + 1, 1]], np.int32), 'orient {}'.format(index), 'text']]
+
+
+def test_compiled_store_many_orients(tmp_path):
+    # more distinct orients than a uint8 code holds
+    samples = [['{}.png'.format(i), str(i), _parse_orients] for i in range(300)]
+    compile_annotations(samples, str(tmp_path / 'data' / 'compiled' / 'orients'), verbose=False)
+    dataset = CompiledText(root=str(tmp_path / 'data'), name='orients', verbose=False)
+    for (_, annotation_ref, parse), (_, annotation_path, _) in zip(dataset.train, samples):
+        _assert_same_polygons(parse(annotation_ref), _parse_orients(annotation_path))
+
+
+def test_sample_index_pickles(tmp_path):
+    samples = _make_samples(tmp_path, count=4)
+    pack_samples(samples, str(tmp_path / 'data' / 'packed' / 'small'), verbose=False)
+    packed = PackedText(root=str(tmp_path / 'data'), name='small', verbose=False)
+    # a function, the bound method of a dataset and non ascii paths
+    samples += packed.train + [['ümlaut.png', '文字.json', _parse_json]]
+    index = SampleIndex.concatenate([SampleIndex(samples[:4]), samples[4:]])
+    assert len(index.parsers) == 3
+    # the parsers loaded by this process are not pickled
+    index[0][2]
+    restored = pickle.loads(pickle.dumps(index))
+    assert restored._parsers == {}
+    assert len(restored) == len(samples)
+    for (img_path, annotation_path, parse), sample in zip(restored, samples):
+        assert (img_path, annotation_path) == tuple(sample[:2])
+        assert getattr(parse, '__func__', parse) is getattr(sample[2], '__func__', sample[2])
+    assert restored[-1][:2] == ('ümlaut.png', '文字.json')
+    _assert_same_polygons(restored[5][2](restored[5][1]), _parse_json(samples[1][1]))
+    # the parser of the packed samples is pickled without the dataset samples
+    assert not hasattr(restored[4][2].__self__, 'train')
@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from torchtext.image_reader import ImageReader
+
+
+class _ReadDataset(Dataset):
+
+    def __init__(self, image_paths, image_reader):
+        self.image_paths = image_paths
+        self.image_reader = image_reader
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        return self.image_reader.read(self.image_paths[index])[0]
+
+
+def _write_images(folder, count):
+    rng = np.random.RandomState(0)
+    image_paths = []
+    for i in range(count):
+        img_path = str(folder / '{}.png'.format(i))
+        cv2.imwrite(img_path, rng.randint(0, 255, (24, 32, 3)).astype(np.uint8))
+        image_paths.append(img_path)
+    return image_paths
+
+
+def test_decompression_bomb_is_quarantined(tmp_path, monkeypatch):
+    img_path = _write_images(tmp_path, 1)[0]
+    # over twice the pixel limit PIL raises DecompressionBombError
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 100)
+    quarantine_file = str(tmp_path / 'quarantine.txt')
+    reader = ImageReader(retries=2, retry_delay=0, quarantine_file=quarantine_file)
+    with pytest.raises(IOError):
+        reader.read(img_path)
+    with pytest.raises(IOError, match='quarantined'):
+        reader.read(img_path)
+    assert ImageReader(quarantine_file=quarantine_file).quarantine == {img_path}
+    assert reader.summary().splitlines()[-1] == 'reduced: 0, failures: 1, quarantined: 1'
+
+
+def test_summary_counts_the_workers(tmp_path):
+    image_paths = _write_images(tmp_path, 6)
+    reader = ImageReader(num_workers=2)
+    loader = DataLoader(_ReadDataset(image_paths + [str(tmp_path / 'missing.png')], reader),
+                        batch_size=1, num_workers=2, collate_fn=lambda batch: batch)
+    with pytest.raises(IOError):
+        list(loader)
+    reader.read(image_paths[0])
+    lines = reader.summary().splitlines()
+    assert lines[0].startswith('pil: 7 images')
+    assert lines[-1] == 'reduced: 0, failures: 0, quarantined: 1'
@@ -0,0 +1,263 @@
+import importlib
+import queue
+import sys
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from torchtext.utils import postprocess
+
+
+def _random_fields(seed, count=40, size=30):
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        height, width = rng.randint(1, size, 2)
+        mask = np.where(rng.rand(height, width) < rng.rand(), 255, 0).astype(np.float32)
+        angle = (rng.rand(height, width) * 2 * np.pi).astype(np.float32)
+        yield mask, angle
+
+
+def _smooth_fields(seed, count=20, size=60):
+    # fields pointing at a point, mostly trees without loops and long chains
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        height, width = rng.randint(5, size, 2)
+        rows, cols = np.mgrid[:height, :width].astype(np.float32)
+        pred_x = rng.rand() * height - rows + rng.randn(height, width).astype(np.float32) * 0.3
+        pred_y = rng.rand() * width - cols + rng.randn(height, width).astype(np.float32) * 0.3
+        _, angle = cv2.cartToPolar(pred_x.astype(np.float32), pred_y.astype(np.float32))
+        mask = np.where(rng.rand(height, width) < 0.9, 255, 0).astype(np.float32)
+        yield mask, angle
+
+
+def _vortex_fields(seed, count=10, size=60):
+    # fields turning round a point, trees holding loops of every length
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        height, width = rng.randint(5, size, 2)
+        rows, cols = np.mgrid[:height, :width].astype(np.float32)
+        rows -= rng.rand() * height
+        cols -= rng.rand() * width
+        sink = rng.rand() * 2 - 1
+        noise = rng.rand() * rng.randn(2, height, width).astype(np.float32)
+        _, angle = cv2.cartToPolar(-cols - sink * rows + noise[0], rows - sink * cols + noise[1])
+        mask = np.where(rng.rand(height, width) < 0.9, 255, 0).astype(np.float32)
+        yield mask, angle
+
+
+def test_quantize_direction_matches_loop():
+    for mask, angle in _random_fields(0):
+        for expected, result in zip(postprocess._quantize_direction_loop(mask, angle),
+                                    postprocess.quantize_direction(mask, angle)):
+            np.testing.assert_array_equal(result, expected)
+
+
+def test_quantize_direction_bin_edges():
+    # angles on the bin edges as float32 holds them, one step either side,
+    # and the ends of the range
+    edges = (np.arange(1, 16, 2) * np.pi / 8).astype(np.float32)
+    angle = np.concatenate([edges, np.nextafter(edges, np.float32(0)), np.nextafter(edges, np.float32(7)),
+                            np.float32([0, np.pi, 2 * np.pi])])
+    angle = np.tile(angle, (3, 1))
+    mask = np.full(angle.shape, 255, np.float32)
+    mask[:, ::4] = 0
+    for expected, result in zip(postprocess._quantize_direction_loop(mask, angle),
+                                postprocess.quantize_direction(mask, angle)):
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_quantize_direction_empty_mask():
+    rng = np.random.RandomState(1)
+    for height, width in ((1, 1), (4, 7), (0, 5)):
+        mask = np.zeros((height, width), np.float32)
+        angle = (rng.rand(height, width) * 2 * np.pi).astype(np.float32)
+        parent, ending = postprocess.quantize_direction(mask, angle)
+        assert parent.shape == (height, width, 2) and ending.shape == (height, width)
+        assert not parent.any() and not ending.any()
+        expected_parent, expected_ending = postprocess._quantize_direction_loop(mask, angle)
+        np.testing.assert_array_equal(parent, expected_parent)
+        np.testing.assert_array_equal(ending, expected_ending)
+
+
+def _text_fields(seed, count=4):
+    # rows of boxes with the field pointing at their centre line over noise
+    rng = np.random.RandomState(seed)
+    for _ in range(count):
+        height, width = rng.randint(48, 80, 2)
+        output = rng.randn(2, height, width).astype(np.float32) * 0.1
+        rows, cols = np.mgrid[:height, :width]
+        for top in range(2, height - 14, 16):
+            left = rng.randint(0, width - 30)
+            bottom, right = top + rng.randint(8, 13), left + rng.randint(20, 30)
+            box = (rows >= top) & (rows < bottom) & (cols >= left) & (cols < right)
+            output[0][box] += ((top + bottom) / 2. - rows[box]) / 2
+            output[1][box] += ((left + right) / 2. - cols[box]) / 4
+        yield output
+
+
+def _process(output, **kwargs):
+    raw_img = np.zeros((output.shape[1] * 2, output.shape[2] * 2, 3), np.uint8)
+    return postprocess.process_output(None, output, raw_img, 0.5, 20, **kwargs)
+
+
+def _assert_same_contours(result, expected):
+    assert len(result) == len(expected)
+    for contour, expected_contour in zip(result, expected):
+        np.testing.assert_array_equal(contour, expected_contour)
+
+
+class Coordinate():
+    def __init__(self, x=0, y=0):
+        self.x = x
+        self.y = y
+
+    def copy(self):
+        return Coordinate(self.x, self.y)
+
+
+def _label_trees_bfs(mask, parent):
+    # the queue BFS process_output used before label_trees
+    height, width = mask.shape
+    p = Coordinate()
+    pt = Coordinate()
+    visited = np.zeros((height, width), np.float32)
+    dict_id = np.zeros((height, width, 2), np.float32)
+    sup_idx = 1
+    for row in range(0, height):
+        for col in range(0, width):
+            if mask[row][col] == 255 and visited[row][col] == 0:
+                p.x = row
+                p.y = col
+                Q = queue.Queue()
+                Q.put(p)
+                while not Q.empty():
+                    pc = Q.get()
+                    dict_id[pc.x][pc.y][0] = sup_idx
+                    visited[pc.x][pc.y] = 1
+                    for dx in range(-1, 2):
+                        for dy in range(-1, 2):
+                            pt.x = pc.x + dx
+                            pt.y = pc.y + dy
+                            if pt.x >= 0 and pt.x <= height-1 and pt.y >= 0 and pt.y <= width-1:
+                                if visited[pt.x][pt.y] == 0 and (parent[pt.x][pt.y][0] != 0 or parent[pt.x][pt.y][1] != 0):
+                                    if parent[pt.x][pt.y][0] == -1*dx and parent[pt.x][pt.y][1] == -1*dy:
+                                        Q.put(pt.copy())
+                                        dict_id[pc.x][pc.y][1] = max(
+                                            dict_id[pc.x][pc.y][1], dict_id[pt.x][pt.y][1]+1)
+                                    elif parent[pc.x][pc.y][0] == 1*dx and parent[pc.x][pc.y][1] == 1*dy:
+                                        Q.put(pt.copy())
+                                        dict_id[pt.x][pt.y][1] = max(
+                                            dict_id[pt.x][pt.y][1], dict_id[pc.x][pc.y][1]+1)
+                sup_idx += 1
+    return dict_id, sup_idx
+
+
+def test_label_trees_matches_queue_bfs():
+    fields = list(_random_fields(2)) + list(_smooth_fields(3)) + list(_vortex_fields(4))
+    for mask, angle in fields:
+        parent, _ = postprocess.quantize_direction(mask, angle)
+        expected, expected_sup_idx = _label_trees_bfs(mask, parent)
+        for dict_id, sup_idx in (postprocess.label_trees(parent),
+                                 postprocess._label_trees_loop(parent, mask.size)):
+            assert sup_idx == expected_sup_idx
+            np.testing.assert_array_equal(dict_id, expected)
+
+        dict_id, _ = postprocess.label_trees(parent, max_depth=3)
+        np.testing.assert_array_equal(dict_id[:, :, 1], np.minimum(expected[:, :, 1], 3))
+
+
+def test_label_trees_far_apart_loops(monkeypatch):
+    # two loops of four pixels at opposite corners of a large map, the trees
+    # holding a loop are worked out over the arrays too, not replayed
+    monkeypatch.setattr(postprocess, '_label_trees_loop', None)
+    parent = np.zeros((768, 768, 2), np.float32)
+    loop = np.zeros((4, 4, 2), np.float32)
+    loop[1, 1], loop[1, 2], loop[2, 2], loop[2, 1] = [0, 1], [1, 0], [0, -1], [-1, 0]
+    parent[:4, :4] = parent[-4:, -4:] = loop
+    start = time.time()
+    dict_id, sup_idx = postprocess.label_trees(parent)
+    assert time.time() - start < 1
+    assert sup_idx == 3
+    expected = np.zeros((4, 4), np.float32)
+    expected[1:3, 1:3] = [[1, 1], [3, 2]]
+    np.testing.assert_array_equal(dict_id[:4, :4, 1], expected)
+    np.testing.assert_array_equal(dict_id[-4:, -4:, 1], expected)
+
+
+def test_dilate_ending_stops_at_border():
+    # endings one pixel from the left and right border pointing out of the image
+    height, width = 5, 8
+    ending = np.zeros((height, width), np.float32)
+    parent = np.zeros((height, width, 2), np.float32)
+    dict_id = np.zeros((height, width, 2), np.float32)
+    ending[1, 1] = ending[3, width - 2] = 1
+    parent[1, 1] = [0, -1]
+    parent[3, width - 2] = [0, 1]
+    dict_id[:, :, 1] = postprocess.RAY_START + postprocess.RAY_LENGTH
+    expected = np.zeros((height, width), np.float32)
+    expected[1, 0] = expected[3, width - 1] = 1
+    for dilate_ending in (postprocess.dilate_ending, postprocess._dilate_ending_loop):
+        merged_ending = np.zeros((height, width), np.float32)
+        dilate_ending(ending, parent, dict_id, merged_ending,
+                      postprocess.RAY_START, postprocess.RAY_LENGTH)
+        np.testing.assert_array_equal(merged_ending, expected)
+
+
+def test_process_output_backends():
+    backends = ['python', 'numpy']
+    if postprocess.numba is not None:
+        backends.append('numba')
+    for output in _text_fields(4):
+        expected = _process(output, backend='python', sparse_density=0)
+        assert len(expected) > 0
+        for backend in backends:
+            _assert_same_contours(_process(output, backend=backend, sparse_density=0), expected)
+        # the numpy and numba backends switch to the text pixel list
+        for backend in backends[1:]:
+            _assert_same_contours(_process(output, backend=backend, sparse_density=1.1), expected)
+
+
+def test_process_output_debug():
+    output = next(_text_fields(1))
+    dumped = {}
+    result = _process(output, backend='numpy', debug=lambda name, array: dumped.setdefault(name, array))
+    _assert_same_contours(result, _process(output, backend='numpy', sparse_density=0))
+    assert list(dumped) == ['x_pred', 'y_pred', 'magnitude', 'mask', 'parent', 'ending',
+                            'ending_merge', 'label', 'result']
+    assert set(np.unique(dumped['mask'])) == {0, 1}
+
+
+def test_init_backend_environment(monkeypatch):
+    factory = getattr(postprocess, '__backend_factory')
+    monkeypatch.delenv('TEXTFIELD_BACKEND', raising=False)
+    assert postprocess.init_backend() is factory['numpy']
+    monkeypatch.setenv('TEXTFIELD_BACKEND', 'python')
+    assert postprocess.init_backend() is factory['python']
+    # an explicit name wins over the environment
+    assert postprocess.init_backend('numpy') is factory['numpy']
+    monkeypatch.setenv('TEXTFIELD_BACKEND', 'cython')
+    with pytest.raises(KeyError):
+        postprocess.init_backend()
+
+
+def test_numba_missing_falls_back_to_numpy(monkeypatch):
+    output = next(_text_fields(5))
+    expected = _process(output, backend='numpy')
+    try:
+        with monkeypatch.context() as patch:
+            # import numba raises ImportError
+            patch.setitem(sys.modules, 'numba', None)
+            importlib.reload(postprocess)
+            assert postprocess.numba is None
+            assert 'numba' not in getattr(postprocess, '__backend_factory')
+            numpy_stages = getattr(postprocess, '__backend_factory')['numpy']
+            for name in ('numba', None):
+                patch.setenv('TEXTFIELD_BACKEND', 'numba')
+                with pytest.warns(UserWarning):
+                    assert postprocess.init_backend(name) is numpy_stages
+            with pytest.warns(UserWarning):
+                _assert_same_contours(_process(output, backend='numba'), expected)
+    finally:
+        importlib.reload(postprocess)
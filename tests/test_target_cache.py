@@ -0,0 +1,106 @@
+import os
+
+import cv2
+import numpy as np
+
+from torchtext.dataset_loader import DetectDataset
+from torchtext.target_cache import TargetCache, build_target_cache
+from torchtext.transforms import build_transforms
+
+
+def _parse_box(annotation_path):
+    with open(annotation_path) as f:
+        points = np.array([int(value) for value in f.read().split(',')]).reshape(-1, 2)
+    return [[points, 'c', 'text']]
+
+
+def _make_samples(folder, count=3):
+    rng = np.random.RandomState(0)
+    samples = []
+    for i in range(count):
+        img_path = str(folder / '{}.png'.format(i))
+        annotation_path = str(folder / '{}.txt'.format(i))
+        cv2.imwrite(img_path, rng.randint(0, 255, (48, 64, 3)).astype(np.uint8))
+        left, top = 4 + 6 * i, 5 + 3 * i
+        with open(annotation_path, 'w') as f:
+            f.write('{},{},{},{},{},{},{},{}'.format(
+                left, top, left + 30, top, left + 30, top + 16, left, top + 16))
+        samples.append([img_path, annotation_path, _parse_box])
+    return samples
+
+
+def _targets(samples, transform, index):
+    _, vec, weight = DetectDataset(samples, transform_image=transform)[index]
+    return vec, weight
+
+
+def test_target_cache_hit(tmp_path):
+    samples = _make_samples(tmp_path)
+    transform = build_transforms(64, 64, is_train=False)
+    cache_dir = str(tmp_path / 'cache')
+    assert build_target_cache(samples, transform, cache_dir, verbose=False) == len(samples)
+    cache = TargetCache(cache_dir)
+    assert cache.usable(transform)
+    for i, (img_path, annotation_path, _) in enumerate(samples):
+        vec, weight = cache.lookup(img_path, annotation_path)
+        expected_vec, expected_weight = _targets(samples, transform, i)
+        np.testing.assert_array_equal(vec, expected_vec)
+        np.testing.assert_array_equal(weight, expected_weight)
+    # served by the dataset too
+    dataset = DetectDataset(samples, transform_image=transform, target_cache=cache)
+    assert dataset.target_cache is cache
+    np.testing.assert_array_equal(dataset[1][1], _targets(samples, transform, 1)[0])
+    # nothing to compute again
+    assert build_target_cache(samples, transform, cache_dir, verbose=False) == 0
+
+
+def test_target_cache_annotation_changed(tmp_path):
+    samples = _make_samples(tmp_path)
+    transform = build_transforms(64, 64, is_train=False)
+    cache_dir = str(tmp_path / 'cache')
+    build_target_cache(samples, transform, cache_dir, verbose=False)
+    img_path, annotation_path, _ = samples[1]
+    with open(annotation_path, 'w') as f:
+        f.write('20,20,50,20,50,40,20,40')
+    stat = os.stat(annotation_path)
+    os.utime(annotation_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert TargetCache(cache_dir).lookup(img_path, annotation_path) is None
+    # only the changed sample is computed again
+    assert build_target_cache(samples, transform, cache_dir, verbose=False) == 1
+    vec, weight = TargetCache(cache_dir).lookup(img_path, annotation_path)
+    expected_vec, expected_weight = _targets(samples, transform, 1)
+    np.testing.assert_array_equal(vec, expected_vec)
+    np.testing.assert_array_equal(weight, expected_weight)
+
+
+def test_target_cache_transform_changed(tmp_path, capsys):
+    samples = _make_samples(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    build_target_cache(samples, build_transforms(64, 64, is_train=False), cache_dir, verbose=False)
+    cache = TargetCache(cache_dir)
+    transform = build_transforms(96, 96, is_train=False)
+    assert not cache.usable(transform)
+    assert not cache.usable(build_transforms(64, 64, is_train=True))
+    dataset = DetectDataset(samples, transform_image=transform, target_cache=cache)
+    assert dataset.target_cache is None
+    assert dataset[0][2].shape == (96, 96)
+    # a new size builds the whole cache again
+    assert build_target_cache(samples, transform, cache_dir, verbose=False) == len(samples)
+    assert TargetCache(cache_dir).usable(transform)
+
+
+def test_target_cache_unreadable_image(tmp_path):
+    samples = _make_samples(tmp_path)
+    transform = build_transforms(64, 64, is_train=False)
+    cache_dir = str(tmp_path / 'cache')
+    with open(samples[1][0], 'wb') as f:
+        f.write(b'not an image')
+    build_target_cache(samples, transform, cache_dir, verbose=False)
+    cache = TargetCache(cache_dir)
+    # not the targets of the next readable sample
+    assert cache.lookup(samples[1][0], samples[1][1]) is None
+    assert cache.lookup(samples[2][0], samples[2][1]) is not None
+    # built once the image can be read
+    cv2.imwrite(samples[1][0], np.zeros((48, 64, 3), np.uint8))
+    assert build_target_cache(samples, transform, cache_dir, verbose=False) == 1
+    assert TargetCache(cache_dir).lookup(samples[1][0], samples[1][1]) is not None
@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+
+from benchmark_targets import random_polygons
+from torchtext.dataset_loader import DetectDataset
+from torchtext.targets import build_targets, collate_sparse_targets, densify_targets
+from test_dataset_loader import _assert_bit_identical, _fixed_polygons
+
+
+def _polygon_owners(dataset, height, width, bboxes, hards):
+    # index + 1 of the polygon filled last on every pixel, cal_vector's
+    # instance map before the don't care ones are marked, the index + 1 of
+    # the polygon whose field vec holds, 0 where several fields add up, and
+    # the field canvas of each polygon with its background border
+    owner = np.zeros((height, width), np.int64)
+    field = np.zeros((height, width), np.int64)
+    count = np.zeros((height, width), np.int64)
+    canvases = {}
+    for bboxi, hard, top, left, fill, x, y, vec_x, vec_y in dataset.polygon_fields(
+            height, width, bboxes, hards):
+        box = np.s_[top:top+fill.shape[0], left:left+fill.shape[1]]
+        owner[box][fill] = bboxi + 1
+        count[box][fill] = 0
+        count[box][x, y] += 1
+        field[box][x, y] = bboxi + 1
+        canvas = np.zeros((fill.shape[0] + 2, fill.shape[1] + 2), np.uint8)
+        canvas[x + 1, y + 1] = 1
+        canvases[bboxi] = (top, left, canvas)
+    return owner, np.where(count == 1, field, 0), canvases
+
+
+def _pointed_background(vec, point, canvas):
+    # the background pixel a unit vector points away from, and the distance
+    # of the nearest background pixel
+    background = np.argwhere(canvas == 0)
+    offset = point - background
+    dist = np.hypot(offset[:, 0], offset[:, 1])
+    along = np.abs(offset / dist[:, None] - vec).max(axis=1) < 1e-5
+    assert along.any()
+    pointed = np.flatnonzero(along)[np.argmin(dist[along])]
+    return tuple(background[pointed]), dist[pointed], dist.min()
+
+
+def test_build_targets_matches_cal_vector():
+    rng = np.random.RandomState(0)
+    dataset = DetectDataset([])
+    batch_size, height, width = 4, 192, 256
+    samples = [random_polygons(rng, height, width, 30, hard_ratio=0.3) for _ in range(batch_size)]
+    vecs, weights, instances = build_targets(
+        (batch_size, 3, height, width), [s[0] for s in samples], [s[1] for s in samples],
+        device='cpu', max_chunk_pixels=1 << 14, return_instances=True)
+
+    num_tie = num_diff = 0
+    for b, (bboxes, hards) in enumerate(samples):
+        _, vec, weight = dataset.cal_vector(np.zeros((height, width, 3), np.float32), bboxes, hards)
+        np.testing.assert_array_equal(weights[b].numpy(), weight)
+        owner, field, canvases = _polygon_owners(dataset, height, width, bboxes, hards)
+        hard = np.asarray(hards)[np.maximum(owner - 1, 0)] != 0
+        np.testing.assert_array_equal(instances[b].numpy(), np.where((owner > 0) & hard, -1, owner))
+
+        # vec points away from a nearest background pixel of the field's
+        # polygon, cal_vector from the label of cv2, which may be another one
+        # at the same distance or, on a few pixels, a farther one
+        rows, cols = np.nonzero((vecs[b].numpy() != vec).any(axis=0))
+        assert (field[rows, cols] > 0).all()
+        for row, col in zip(rows, cols):
+            top, left, canvas = canvases[field[row, col] - 1]
+            point = np.array([row - top + 1, col - left + 1])
+            result, dist, nearest = _pointed_background(vecs[b, :, row, col].numpy(), point, canvas)
+            expected, expected_dist, _ = _pointed_background(vec[:, row, col], point, canvas)
+            assert result != expected
+            np.testing.assert_allclose(dist, nearest)
+            num_tie += np.isclose(expected_dist, nearest)
+        num_diff += len(rows)
+    # the differences are rare, mostly ties, a wrong field would differ on
+    # most text pixels
+    assert 0 < num_diff < 0.05 * (instances != 0).sum().item()
+    assert num_tie > 0.9 * num_diff
+
+
+def test_densify_targets_matches_cal_vector():
+    # dont_care boxes and overlapping polygons, a sample without any, and the
+    # boxes of the later samples offset in the collated patches
+    rng = np.random.RandomState(1)
+    dataset = DetectDataset([])
+    height, width, bboxes, hards = _fixed_polygons()
+    samples = [(bboxes, hards), ([], [])]
+    samples += [random_polygons(rng, height, width, 12, hard_ratio=0.3) for _ in range(3)]
+    image = np.zeros((height, width, 3), np.float32)
+    batch = [dataset.cal_patches(image, bboxes, hards) for bboxes, hards in samples]
+    imgs, targets = collate_sparse_targets(batch)
+    vecs, weights = densify_targets(targets)
+    assert imgs.shape == (len(samples), height, width, 3)
+    for b, (bboxes, hards) in enumerate(samples):
+        _, vec, weight = dataset.cal_vector(image, bboxes, hards)
+        _assert_bit_identical(vecs[b].numpy(), vec)
+        _assert_bit_identical(weights[b].numpy(), weight)
@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+import pytest
+from torch.utils.data.dataloader import default_collate
+
+from torchtext.dataset_loader import DetectDataset, TextInstance
+from torchtext.targets import collate_polygons, collate_sparse_targets
+from torchtext.transforms import (IMAGENET_MEAN, IMAGENET_STD, Compose, Normalize, RandomMirror,
+                                  RandomResizedLimitCrop, RandomWarpCrop, Rotate, build_transforms)
+
+
+def _parse_boxes(annotation_path):
+    return [[np.array([[8, 6], [40, 6], [40, 22], [8, 22]]), 'c', 'text'],
+            [np.array([[30, 30], [60, 26], [62, 44], [28, 46]]), '#', '###']]
+
+
+@pytest.mark.parametrize('targets', ['dense', 'batch', 'sparse'])
+@pytest.mark.parametrize('normalize', [True, False])
+def test_field_augmentation_collate(tmp_path, targets, normalize):
+    rng = np.random.RandomState(0)
+    samples = []
+    for i in range(4):
+        img_path = str(tmp_path / '{}.png'.format(i))
+        cv2.imwrite(img_path, rng.randint(0, 255, (48, 64, 3)).astype(np.uint8))
+        samples.append([img_path, 'annotation', _parse_boxes])
+    transform = build_transforms(64, 64, is_train=True, field_augment=True, normalize=normalize)
+    dataset = DetectDataset(samples, transform_image=transform,
+                            batch_targets=targets == 'batch', sparse_targets=targets == 'sparse')
+    collate = {'dense': default_collate, 'batch': collate_polygons,
+               'sparse': collate_sparse_targets}[targets]
+    # enough draws to mirror and rotate some of the samples
+    np.random.seed(0)
+    for _ in range(6):
+        imgs = collate([dataset[i] for i in range(len(dataset))])[0]
+        assert tuple(imgs.shape) == (4, 3, 64, 64)
+
+
+def _warp_sample(rng, height, width, num_polygon):
+    # a smooth image, the crop resamples it, and word like int32 polygons
+    image = cv2.GaussianBlur(rng.randint(0, 255, (height, width, 3)).astype(np.uint8), (0, 0), 3)
+    polygons = []
+    for _ in range(num_polygon):
+        x, y = rng.randint(0, width - 60), rng.randint(0, height - 20)
+        w, h = rng.randint(10, 60), rng.randint(5, 20)
+        polygons.append(np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], np.int32))
+    return image, polygons
+
+
+def test_random_warp_crop_matches_chain():
+    rng = np.random.RandomState(0)
+    chain = Compose([RandomMirror(), RandomResizedLimitCrop(maxHeight=96, maxWidth=128, ratio=(0.3, 3)),
+                     Rotate()])
+    fused = RandomWarpCrop(maxHeight=96, maxWidth=128, ratio=(0.3, 3))
+    for seed in range(20):
+        image, points = _warp_sample(rng, 120, 200, 6)
+        np.random.seed(seed)
+        expected, expected_polygons = chain(image, [TextInstance(pts.copy(), 'c', 'text') for pts in points])
+        np.random.seed(seed)
+        result, polygons = fused(image, [TextInstance(pts.copy(), 'c', 'text') for pts in points])
+        assert result.shape == expected.shape and result.dtype == np.uint8
+        # pixels sampled as cv2.resize, points kept as float where the chain truncates them
+        assert np.abs(result.astype(np.int16) - expected).max() <= 2
+        for polygon, expected_polygon in zip(polygons, expected_polygons):
+            assert np.abs(polygon.points - expected_polygon.points).max() <= 1
+
+
+def test_random_warp_crop_normalize():
+    rng = np.random.RandomState(1)
+    image, points = _warp_sample(rng, 120, 200, 4)
+    warp = RandomWarpCrop(maxHeight=96, maxWidth=128)
+    fused = RandomWarpCrop(maxHeight=96, maxWidth=128, mean=IMAGENET_MEAN, std=IMAGENET_STD)
+    for seed in range(5):
+        np.random.seed(seed)
+        expected, _ = Normalize(IMAGENET_MEAN, IMAGENET_STD)(
+            *warp(image, [TextInstance(pts.copy(), 'c', 'text') for pts in points]))
+        np.random.seed(seed)
+        result, _ = fused(image, [TextInstance(pts.copy(), 'c', 'text') for pts in points])
+        assert result.dtype == np.float32 and result.flags['C_CONTIGUOUS']
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-5)
+
+
+def _get_window_reference(crop, image, points=None):
+    # RandomResizedLimitCrop.get_window before the summed-area table
+    height, width = image.shape[0], image.shape[1]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    if points is not None:
+        for pts in points:
+            cv2.fillPoly(mask, [pts.astype(np.int32)], (1,), 1)
+    attempt = 0
+    min_overlap = [0.1, 0.3, 0.5, 0.7]
+    while attempt < 10:
+        i, j, h, w = crop.get_params(image, crop.scale, crop.ratio)
+        overlap = mask[i:i+h, j:j+w] > 0
+        random_idx = np.random.randint(0, 4)
+        if np.sum(overlap) >= np.sum(mask)*min_overlap[random_idx]:
+            break
+        attempt += 1
+    if attempt == 10:
+        h = min(height, width)
+        w = h
+        i = (height-h) // 2
+        j = (width-w) // 2
+    return i, j, h, w
+
+
+def test_get_window_matches_mask_search():
+    rng = np.random.RandomState(0)
+    crop = RandomResizedLimitCrop(maxHeight=64, maxWidth=64, ratio=(0.3, 3))
+    image = np.zeros((90, 160, 3), np.uint8)
+    for case in range(60):
+        # polygons inside, crossing the border or outside the image, small
+        # ones making the overlap test fail, float points, or no polygon
+        points = [rng.uniform(-40, 200, (rng.randint(3, 8), 2)) for _ in range(case % 5)]
+        points += [rng.randint(0, 90, 2) + rng.randint(0, 4, (4, 2)) for _ in range(case % 3)]
+        for pts in (points, [] if case % 2 else None):
+            np.random.seed(case)
+            expected = _get_window_reference(crop, image, pts)
+            state = np.random.randint(1 << 30)
+            np.random.seed(case)
+            assert crop.get_window(image, pts) == expected
+            assert np.random.randint(1 << 30) == state
@@ -1,9 +1,14 @@
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 
 from .dataset_loader import DetectDataset
 from .datasets import init_detect_dataset
-from .transforms import build_transforms
+from .datasets.sample_index import SampleIndex
+from .transforms import build_transforms, batch_normalize, BaseTransform
 from .samplers import build_train_sampler
+from .targets import collate_polygons, collate_sparse_targets, DenseTargetLoader
+from .target_cache import TargetCache
+from .image_reader import ImageReader
 
 
 class BaseDataManager(object):
@@ -19,6 +24,17 @@ class BaseDataManager(object):
                  test_batch_size=100,
                  workers=4,
                  train_sampler='',
+                 batch_targets=False,
+                 sparse_targets=False,
+                 augment=True,
+                 field_augment=False,
+                 crop=True,
+                 target_cache='',
+                 decode_backend='pil',
+                 quarantine_file='',
+                 start_method='',
+                 uint8_images=False,
+                 fused_warp=True,
                  **kwargs
                  ):
         self.use_gpu = use_gpu
@@ -31,16 +47,32 @@ class BaseDataManager(object):
         self.test_batch_size = test_batch_size
         self.workers = workers
         self.train_sampler = train_sampler
+        self.batch_targets = batch_targets
+        self.sparse_targets = sparse_targets
+        assert not (batch_targets and sparse_targets), 'batch_targets and sparse_targets are exclusive'
+        self.augment = augment
+        self.field_augment = field_augment
+        self.crop = crop
+        self.target_cache = target_cache
+        self.decode_backend = decode_backend
+        self.quarantine_file = quarantine_file
+        self.start_method = start_method
+        # workers send uint8 images, normalized by the batch in the training process
+        self.uint8_images = uint8_images
+        self.batch_normalize = batch_normalize() if uint8_images else None
         # self.random_erase = random_erase
         # self.color_jitter = color_jitter
         # self.color_aug = color_aug
         # self.num_instances = num_instances
 
         transform_train = build_transforms(
-            self.height, self.width, batch_size=train_batch_size, is_train=True
+            self.height, self.width, batch_size=train_batch_size, is_train=augment,
+            field_augment=field_augment, crop=crop, normalize=not uint8_images,
+            fused=fused_warp
         )
         transform_test = build_transforms(
-            self.height, self.width, batch_size=train_batch_size, is_train=False
+            self.height, self.width, batch_size=train_batch_size, is_train=False,
+            normalize=not uint8_images
         )
         self.transform_train = transform_train
         self.transform_test = transform_test
@@ -54,7 +86,6 @@ class BaseDataManager(object):
 
 class DetectImageManager(BaseDataManager):
     def __init__(self,
-                 model,
                  use_gpu,
                  source_names,
                  target_names,
@@ -63,21 +94,43 @@ class DetectImageManager(BaseDataManager):
         super(DetectImageManager, self).__init__(
             use_gpu, source_names, target_names, **kwargs)
 
+        # numpy arrays, the workers don't copy the index by touching refcounts
         train = []
         for name in self.source_names:
             dataset = init_detect_dataset(root=self.root, name=name)
-
-            for img_path, annotation_path, parse_txt in dataset.train:
-                train.append([img_path, annotation_path, parse_txt])
+            train.append(dataset.train)
+        train = SampleIndex.concatenate(train)
 
         self.train_sampler = build_train_sampler(
             train, self.train_sampler
         )
+        if self.batch_targets:
+            collate_fn = collate_polygons
+        elif self.sparse_targets:
+            collate_fn = collate_sparse_targets
+        else:
+            collate_fn = default_collate
+        target_cache = TargetCache(self.target_cache) if self.target_cache else None
+        # shared with the workers, its summary covers every process
+        self.image_reader = ImageReader(self.decode_backend, quarantine_file=self.quarantine_file,
+                                        num_workers=self.workers)
+        # images only resized can be decoded at a reduced size, crops need the full one
+        base_transform = getattr(self.transform_train, 'base', self.transform_train)
+        decode_size = None
+        if isinstance(base_transform, BaseTransform):
+            decode_size = (base_transform.maxHeight, base_transform.maxWidth)
         self.trainloader = DataLoader(
-            DetectDataset(model, train, transform_image=self.transform_train), sampler=self.train_sampler,
+            DetectDataset(train, transform_image=self.transform_train,
+                          batch_targets=self.batch_targets,
+                          sparse_targets=self.sparse_targets,
+                          target_cache=target_cache, image_reader=self.image_reader,
+                          decode_size=decode_size), sampler=self.train_sampler,
             batch_size=self.train_batch_size, shuffle=False, num_workers=self.workers,
-            pin_memory=self.use_gpu, drop_last=False
+            pin_memory=self.use_gpu, drop_last=False, collate_fn=collate_fn,
+            multiprocessing_context=self.start_method or None
         )
+        if self.sparse_targets:
+            self.trainloader = DenseTargetLoader(self.trainloader)
 
         print('\n')
         print('  **************** Summary ****************')
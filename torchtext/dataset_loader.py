@@ -8,26 +8,52 @@ import copy
 import torch
 from torch.utils.data import Dataset
 from skimage.draw import polygon as drawpoly
-from torchtext.utils.misc import find_bottom, find_long_edges, split_edge_seqence, norm2, vector_cos, vector_sin, process_output
+from torchtext.utils.misc import find_bottom, find_long_edges, split_edge_seqence, norm2, vector_cos, vector_sin
+from torchtext.transforms import build_transforms
+from torchtext.image_reader import ImageReader
+from torchtext.datasets.sample_index import SampleIndex
 import cv2
 import time
 
 
+_image_reader = ImageReader()
+
+
 def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
-    if not osp.exists(img_path):
-        raise IOError('{} does not exist'.format(img_path))
-    while not got_img:
-        try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print('IOError incurred when reading "{}". Will redo. Don\'t worry. Just chill.'.format(
-                img_path))
-            pass
-    return np.array(img)
+    """Read an RGB image, retrying a few times on IOError incurred by heavy IO
+    process before giving up, see ImageReader."""
+    return _image_reader.read(img_path)[0]
+
+
+def scratch_view(scratch, name, shape, dtype):
+    """View of shape on the buffer scratch[name], reallocated when too small"""
+    size = int(np.prod(shape))
+    if name not in scratch or scratch[name].size < size:
+        scratch[name] = np.empty(size, dtype=dtype)
+    return scratch[name][:size].reshape(shape)
+
+
+def balanced_weight(instance, num_polygon):
+    """
+    Loss weight of every pixel, every instance shares the same total weight
+    spread over the pixels it keeps, don't care pixels are marked -1
+    :param instance: (np.array), (H, W) instance map, polygon index + 1 on
+        its pixels, -1 on don't care pixels and 0 on background
+    :param num_polygon: (int), number of polygons of the sample
+    :return: (np.array), (H, W) float32 weight
+    """
+    pixel_instance = instance.astype(np.int32)
+    np.maximum(pixel_instance, 0, out=pixel_instance)
+    pixCount = np.bincount(pixel_instance.ravel(), minlength=num_polygon+1)
+    pixCount[0] = 0
+    pixAve = np.zeros(len(pixCount), dtype=np.float64)
+    posCount = np.sum(pixCount)
+    if posCount != 0:
+        bboxAve = float(posCount)/np.count_nonzero(pixCount)
+        pixAve[pixCount > 0] = bboxAve/pixCount[pixCount > 0]
+    weight = pixAve.astype(np.float32)[pixel_instance]
+    weight[instance < 0] = -1
+    return weight
 
 
 class TextInstance():
@@ -61,18 +87,88 @@ class TextInstance():
 
 
 class DetectDataset(Dataset):
-    def __init__(self, model, raw_dataset, transform_image=None, **kwargs):
-        self.model = model
-        self.dataset = raw_dataset
+    """
+    :param raw_dataset: (SampleIndex), samples [img_path, annotation_path,
+        parse_annotation], a list of them is turned into a SampleIndex
+    :param batch_targets: (bool), return the polygons instead of the vec and
+        weight maps, the targets are then built on the collated batch, see
+        torchtext.targets.build_targets
+    :param sparse_targets: (bool), return the compact targets of cal_patches
+        instead of the vec and weight maps, see torchtext.targets.DenseTargetLoader
+    :param target_cache: (TargetCache), precomputed vec and weight maps, only
+        read with the deterministic transform they were built for, see
+        torchtext.target_cache
+    :param image_reader: (ImageReader), decoder of the images, samples whose
+        image can't be read are replaced by the next ones
+    :param decode_size: (tuple), height, width the decoded images keep at
+        least, large JPEG images are decoded at a reduced size, see ImageReader.read
+    With a transform_image having a field_transform, see FieldAugmentation,
+    the vec and weight maps are computed after its base transform and
+    transformed with the image.
+    """
+    def __init__(self, raw_dataset, transform_image=None, batch_targets=False,
+                 sparse_targets=False, target_cache=None, image_reader=None, decode_size=None,
+                 **kwargs):
+        self.dataset = raw_dataset if isinstance(raw_dataset, SampleIndex) else SampleIndex(raw_dataset)
         self.transform_image = transform_image
+        self.image_reader = image_reader if image_reader is not None else ImageReader()
+        self.decode_size = decode_size
+        self.batch_targets = batch_targets
+        self.sparse_targets = sparse_targets
+        # the polygons themselves are transformed when the maps aren't built here
+        self.field_transform = None
+        self.base_transform = transform_image
+        if not (batch_targets or sparse_targets) and hasattr(transform_image, 'field_transform'):
+            self.field_transform = transform_image.field_transform
+            self.base_transform = transform_image.base
+        if target_cache is not None and (batch_targets or sparse_targets or
+                                         not target_cache.usable(self.base_transform)):
+            print('=> target cache {} not used with this transform'.format(target_cache.cache_dir))
+            target_cache = None
+        self.target_cache = target_cache
     def __len__(self):
         return len(self.dataset)
 
+    def read_sample(self, index):
+        """
+        Image of the sample, or of the next readable one
+        :return: sample, image, (height, width) of the image file
+        """
+        for offset in range(len(self.dataset)):
+            sample = self.dataset[(index + offset) % len(self.dataset)]
+            try:
+                image, size = self.image_reader.read(sample[0], self.decode_size)
+                return sample, image, size
+            except IOError as err:
+                print('{}, skipped'.format(err))
+        raise IOError('no readable image in the dataset')
+
     def __getitem__(self, index):
-        img_path, annotation_path, parse_annotation = self.dataset[index]
+        sample, image, size = self.read_sample(index)
+        return self.load_sample(sample, image, size)
+
+    def load_sample(self, sample, image, size):
+        """
+        Training data of a sample whose image is read
+        :param sample: (tuple), img_path, annotation_path, parse_annotation
+        :param size: (tuple), (height, width) of the image file
+        """
+        img_path, annotation_path, parse_annotation = sample
+        if self.target_cache is not None:
+            targets = self.target_cache.lookup(img_path, annotation_path)
+            if targets is not None:
+                image, _ = self.base_transform(image)
+                vec, weight = targets
+                if self.field_transform:
+                    image, vec, weight = self.field_transform(image, vec, weight)
+                return image.transpose(2, 0, 1), vec, weight
         annotation = parse_annotation(annotation_path)
         polygons = self.parse_annot(annotation)
-        image = read_image(img_path)
+        if image.shape[:2] != size:
+            # the annotations are given on the full size image
+            scales = np.array([image.shape[1] / size[1], image.shape[0] / size[0]])
+            for polygon in polygons:
+                polygon.points = polygon.points * scales
         return self.get_training_data(image, polygons, img_path)
 
     def parse_annot(self, annotation):
@@ -90,9 +186,17 @@ class DetectDataset(Dataset):
             polygons.append(TextInstance(annot[0], annot[1], annot[2]))
         return polygons
 
-    def cal_vector(self, image, bboxes, hards):
-        height, width = image.shape[0:2]
-        accumulation = np.zeros((3, height, width), dtype=np.float32)
+    def polygon_fields(self, height, width, bboxes, hards):
+        """
+        Field of every polygon drawn in the image, in drawing order
+        :return: generator of (bboxi, hard, top, left, fill, x, y, vec_x, vec_y),
+            fill the (h, w) bool polygon in its box, a view on a buffer reused
+            by the next polygon, x, y the box coordinates of its text pixels
+            and vec_x, vec_y their float32 unit vector from the nearest
+            background pixel
+        """
+        # buffers shared by the polygons of the sample, grown to the largest box
+        scratch = {}
         for bboxi, points in enumerate(bboxes):
             points = points.astype(np.int32)
             left, top = points.min(axis=0)
@@ -108,87 +212,107 @@ class DetectDataset(Dataset):
             new_points = points - [left,top]+1
             new_height = bottom-top+3
             new_width = right-left+3
-            hard = hards[bboxi]
-            new_seg = np.zeros((new_height, new_width), dtype=np.uint8)
-            cv2.fillPoly(new_seg, [new_points], (1,))
-            contours = np.array(
-                [[0, 0], [new_seg.shape[1]-1, 0], [new_seg.shape[1]-1, new_seg.shape[0]-1], [0, new_seg.shape[0]-1]])
-            cv2.drawContours(new_seg, [contours], -1, (0,), 1)
-            new_img = new_seg.astype(np.uint8)
+            new_img = scratch_view(scratch, 'seg', (new_height, new_width), np.uint8)
+            new_img[...] = 0
+            cv2.fillPoly(new_img, [new_points], (1,))
+            # keep a background border so every pixel has a background pixel
+            # inside the box
+            new_img[[0, new_height-1], :] = 0
+            new_img[:, [0, new_width-1]] = 0
             dst, labels = cv2.distanceTransformWithLabels(
-                new_img, cv2.DIST_L2, cv2.DIST_MASK_PRECISE, labelType=cv2.DIST_LABEL_PIXEL)
-            index = np.copy(labels)
-            index[new_img > 0] = 0
-            place = np.argwhere(index > 0)
-            nearCord = place[labels-1, :]
+                new_img, cv2.DIST_L2, cv2.DIST_MASK_PRECISE,
+                scratch_view(scratch, 'dst', (new_height, new_width), np.float32),
+                scratch_view(scratch, 'labels', (new_height, new_width), np.int32),
+                cv2.DIST_LABEL_PIXEL)
+            # background pixels are labelled 1, 2... in raster order, a text
+            # pixel takes the label of its nearest background pixel
+            text = np.flatnonzero(new_img).astype(np.int32)
+            place = np.flatnonzero(new_img == 0).astype(np.int32)
+            nearest = place[labels.ravel()[text]-1]
             # x height, y width
-            x = nearCord[:, :, 0]
-            y = nearCord[:, :, 1]
-            nearPixel = np.zeros((2, new_height, new_width))
-            nearPixel[0, :, :] = x
-            nearPixel[1, :, :] = y
-            grid = np.indices(new_img.shape)
-            grid = grid.astype(np.float32)
-            diff = grid - nearPixel
-            dist = np.sqrt(np.sum(diff**2, axis=0))
-
-            new_direction = np.zeros(
-                (3, new_height, new_width), dtype=np.float32)
-            new_direction[0, new_img > 0] = np.divide(
-                diff[0, new_img > 0], dist[new_img > 0])
-            new_direction[1, new_img > 0] = np.divide(
-                diff[1, new_img > 0], dist[new_img > 0])
-
-            direction = np.zeros(
-                (3, height, width), dtype=np.float32)
-            direction[:, top:bottom+1, left:right +
-                      1] = new_direction[:, 1:new_height-1, 1:new_width-1]
-
-            seg = np.zeros(image.shape[0:2], dtype=np.uint8)
-            cv2.fillPoly(seg, [points], (1,))
-            img = seg.astype(np.uint8)
+            x, y = np.divmod(text, new_width)
+            diff_x = x - nearest // new_width
+            diff_y = y - nearest % new_width
+            # integer offsets, the norm is exact before the square root
+            dist = np.sqrt(diff_x*diff_x + diff_y*diff_y)
+
+            # only the box of the polygon is touched, the fill is clipped at
+            # the same borders as a fill of the whole image
+            img = scratch_view(scratch, 'fill', (bottom-top+1, right-left+1), np.uint8)
+            img[...] = 0
+            cv2.fillPoly(img, [points - [left, top]], (1,))
+            yield (bboxi, hards[bboxi], top, left, img.view(bool), x-1, y-1,
+                   (diff_x/dist).astype(np.float32), (diff_y/dist).astype(np.float32))
+
+    def cal_vector(self, image, bboxes, hards):
+        height, width = image.shape[0:2]
+        accumulation = np.zeros((3, height, width), dtype=np.float32)
+        for bboxi, hard, top, left, img, x, y, vec_x, vec_y in self.polygon_fields(
+                height, width, bboxes, hards):
+            roi = accumulation[:, top:top+img.shape[0], left:left+img.shape[1]]
+            roi[:, img] = 0
+            roi[0, x, y] += vec_x
+            roi[1, x, y] += vec_y
             if hard == 0:
-                direction[2, img > 0] = bboxi+1
+                roi[2, img] = bboxi+1
             else:
-                direction[2, img > 0] = -1
-
-            accumulation[0, img > 0] = 0
-            accumulation[1, img > 0] = 0
-            accumulation[2, img > 0] = 0
-            accumulation = accumulation + direction
-        vec = np.stack((accumulation[0], accumulation[1]))
-        # compute weight
-        weight = np.zeros((height, width), dtype=np.float32)
-        weight[accumulation[2] < 0] = -1
-        posRegion = accumulation[2] > 0
-        posCount = np.sum(posRegion)
-        if posCount != 0:
-            bboxRemain = 0
-            for bboxi, polygon in enumerate(bboxes):
-                overlap_bboxi = accumulation[2] == (bboxi+1)
-                overlapCount_bboxi = np.sum(overlap_bboxi)
-                if overlapCount_bboxi == 0:
-                    continue
-                bboxRemain = bboxRemain+1
-            bboxAve = float(posCount)/bboxRemain
-            for bboxi, polygon in enumerate(bboxes):
-                overlap_bboxi = accumulation[2] == (bboxi+1)
-                overlapCount_bboxi = np.sum(overlap_bboxi)
-                if overlapCount_bboxi == 0:
-                    continue
-                pixAve = bboxAve/overlapCount_bboxi
-                weight = weight*(~overlap_bboxi) + pixAve*overlap_bboxi
-        return image, vec, weight.astype(np.float32)
+                roi[2, img] = -1
+        vec = accumulation[0:2]
+        weight = balanced_weight(accumulation[2], len(bboxes))
+        return image, vec, weight
 
-    def make_word_vector(self, image, polygons, img_path):
+    def cal_patches(self, image, bboxes, hards):
+        """
+        Compact targets of the sample, the fill and the field of every polygon
+        in its box, painted into the vec and weight of cal_vector by
+        torchtext.targets.densify_targets
+        :return: image, dict of numpy arrays
+            boxes (n, 4) int32 top, left, height, width of each drawn polygon
+            instance (n,) int32 polygon index + 1
+            dont_care (m,) int32 indices of the don't care boxes
+            offsets (n+1,) int64 start of each box in fill and vec
+            fill (offsets[-1],) bool and vec (2, offsets[-1]) float32 box patches
+            size (2,) int32 height, width and num_polygon (1,) int32
+        """
+        height, width = image.shape[0:2]
+        boxes, instance, dont_care, fills, vecs = [], [], [], [], []
+        for bboxi, hard, top, left, img, x, y, vec_x, vec_y in self.polygon_fields(
+                height, width, bboxes, hards):
+            patch = np.zeros((2,) + img.shape, dtype=np.float32)
+            patch[0, x, y] = vec_x
+            patch[1, x, y] = vec_y
+            if hard != 0:
+                dont_care.append(len(boxes))
+            boxes.append((top, left) + img.shape)
+            instance.append(bboxi+1)
+            fills.append(img.ravel().copy())
+            vecs.append(patch.reshape(2, -1))
+        offsets = np.cumsum([0] + [len(fill) for fill in fills])
+        targets = {
+            'boxes': np.array(boxes, dtype=np.int32).reshape(-1, 4),
+            'instance': np.array(instance, dtype=np.int32),
+            'dont_care': np.array(dont_care, dtype=np.int32),
+            'offsets': offsets.astype(np.int64),
+            'fill': np.concatenate(fills) if fills else np.zeros(0, dtype=bool),
+            'vec': np.concatenate(vecs, axis=1) if vecs else np.zeros((2, 0), dtype=np.float32),
+            'size': np.array([height, width], dtype=np.int32),
+            'num_polygon': np.array([len(bboxes)], dtype=np.int32),
+        }
+        return image, targets
+
+    def word_polygons(self, polygons):
         bboxes = []
         hards = []
-        self.charBBs = []
-        self.s_conf = 1
         for polygon in polygons:
             bboxes.append(polygon.points.astype(np.int32))
             hard = 1 if polygon.orient == '#' else 0
             hards.append(hard)
+        return bboxes, hards
+
+    def make_word_vector(self, image, polygons, img_path):
+        self.charBBs = []
+        self.s_conf = 1
+        bboxes, hards = self.word_polygons(polygons)
 
         return self.cal_vector(image, bboxes, hards)
 
@@ -196,12 +320,21 @@ class DetectDataset(Dataset):
     def get_training_data(self, image, polygons, image_path):
         # im_name = image_path.split('/')[-1].split('.jpg')[0]
         # cv2.imwrite('./trash/'+im_name+'img.jpg', image)
-        if self.transform_image:
-            image, polygons = self.transform_image(image, copy.copy(polygons))
+        if self.base_transform:
+            image, polygons = self.base_transform(image, copy.copy(polygons))
         # imagenet_mean = [0.485, 0.456, 0.406]
         # imagenet_std = [0.229, 0.224, 0.225]
         # cv2.imwrite('./trash/'+im_name+'img_tranpose.jpg', (image*imagenet_std+imagenet_mean)*255)
+        if self.batch_targets:
+            bboxes, hards = self.word_polygons(polygons)
+            return image.transpose(2, 0, 1), bboxes, np.array(hards, dtype=np.int64)
+        if self.sparse_targets:
+            bboxes, hards = self.word_polygons(polygons)
+            image, targets = self.cal_patches(image, bboxes, hards)
+            return image.transpose(2, 0, 1), targets
         image, vec, weight = self.make_word_vector(image, polygons, image_path)
+        if self.field_transform:
+            image, vec, weight = self.field_transform(image, vec, weight)
 
         # img = np.zeros(image.shape)
         # for i in range(img.shape[0]):
@@ -213,3 +346,53 @@ class DetectDataset(Dataset):
         image = image.transpose(2, 0, 1)
         
         return image, vec, weight
+
+
+class FolderImageDataset(Dataset):
+    """Images to run inference on, decoded and transformed by the loader workers.
+
+    Args:
+    - image_paths (list): image files.
+    - maxHeight, maxWidth (int): network input size.
+    - keep_ratio (bool): fit each image inside maxHeight x maxWidth keeping its
+      aspect ratio (sides rounded to multiples of 32) instead of stretching it.
+    - reduced_decode (bool): decode large JPEG images at a reduced size still
+      larger than the network input, see ImageReader.read.
+    - image_reader (ImageReader): decoder of the images.
+    - uint8_images (bool): return uint8 images, to be normalized by the batch,
+      see torchtext.transforms.batch_normalize.
+    """
+
+    def __init__(self, image_paths, maxHeight=512, maxWidth=512, keep_ratio=False,
+                 reduced_decode=False, image_reader=None, uint8_images=False):
+        self.image_paths = image_paths
+        self.maxHeight = maxHeight
+        self.maxWidth = maxWidth
+        self.keep_ratio = keep_ratio
+        self.reduced_decode = reduced_decode
+        self.image_reader = image_reader if image_reader is not None else ImageReader()
+        self.uint8_images = uint8_images
+        self.transforms = {}
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def target_size(self, index):
+        """(height, width) the image is resized to, only reads the file header"""
+        if not self.keep_ratio:
+            return self.maxHeight, self.maxWidth
+        width, height = Image.open(self.image_paths[index]).size
+        scale = min(self.maxHeight / height, self.maxWidth / width)
+        return (max(32, int(round(height * scale / 32)) * 32),
+                max(32, int(round(width * scale / 32)) * 32))
+
+    def __getitem__(self, index):
+        size = self.target_size(index)
+        image, raw_size = self.image_reader.read(
+            self.image_paths[index], size if self.reduced_decode else None)
+        if size not in self.transforms:
+            self.transforms[size] = build_transforms(
+                maxHeight=size[0], maxWidth=size[1], is_train=False,
+                normalize=not self.uint8_images)
+        img, _ = self.transforms[size](image, None)
+        return img.transpose(2, 0, 1), np.array(raw_size + image.shape[2:]), index
@@ -5,6 +5,8 @@ from .ctw1500 import CTW1500
 from .ic13 import IC13
 from .ic15 import IC15
 from .ic17 import IC17
+from .packed import PackedText
+from .compiled import CompiledText
 
 __detect_factory = {
     'total-text': TotalText,
@@ -18,6 +20,12 @@ __detect_factory = {
 
 
 def init_detect_dataset(name, **kwargs):
+    # a dataset packed by pack_dataset.py, 'packed-<name>'
+    if name.startswith('packed-'):
+        return PackedText(name=name[len('packed-'):], **kwargs)
+    # annotations compiled by compile_annotations.py, 'compiled-<name>'
+    if name.startswith('compiled-'):
+        return CompiledText(name=name[len('compiled-'):], **kwargs)
     if name not in list(__detect_factory.keys()):
         raise KeyError('Invalid dataset, got "{}", but expected to be one of {}'.format(
             name, list(__detect_factory.keys())))
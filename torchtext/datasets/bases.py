@@ -8,6 +8,13 @@ class BaseDataset():
     def __init__(self, root):
         self.root = osp.expanduser(root)
 
+    def __getstate__(self):
+        # the parse functions of the samples are pickled without the samples
+        state = self.__dict__.copy()
+        for key in ('train', 'image_list', 'annotation_list'):
+            state.pop(key, None)
+        return state
+
     def get_imagedata_info(self, image_list,annotation_list):
         num_imgs = len(image_list)
         num_anno = len(annotation_list)
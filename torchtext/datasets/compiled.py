@@ -0,0 +1,179 @@
+from .bases import BaseImageDataset
+from .packed import _POINT_DTYPES, source_file as _source_file
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+
+COMPILED_PREFIX = 'compiled:'
+# columns of a store, a .npy file each
+COLUMNS = ('points', 'point_offsets', 'polygon_offsets', 'dtypes', 'orients',
+           'text_ids', 'text_bytes', 'text_offsets')
+STORE_NAME = 'compiled.json'
+
+
+def is_compiled(path):
+    return isinstance(path, str) and path.startswith(COMPILED_PREFIX)
+
+
+def compiled_ref(store_path, index):
+    return '{}{}:{}'.format(COMPILED_PREFIX, store_path, index)
+
+
+def source_file(path):
+    """File holding a path, the store of a compiled reference, the shard of a packed one"""
+    if is_compiled(path):
+        return path[len(COMPILED_PREFIX):].rsplit(':', 1)[0]
+    return _source_file(path)
+
+
+def compile_annotations(samples, store_dir, verbose=True):
+    """
+    Parse the annotations of samples once into the columns of a store:
+    points (P, 2) float32 of every polygon one after the other, point_offsets
+    (N + 1) the first point of each polygon, polygon_offsets (M + 1) the first
+    polygon of each image, dtypes (the point type to cast back to) and orients
+    codes per polygon, text_ids into the table of distinct texts given by
+    text_bytes and text_offsets
+    :param samples: (list), [img_path, annotation_path, parse_annotation] of a dataset
+    :param store_dir: (str), folder of the .npy columns and compiled.json
+    :return: (int), number of samples compiled
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    images = []
+    points = []
+    point_offsets = [0]
+    polygon_offsets = [0]
+    dtypes = []
+    orients = []
+    text_ids = []
+    orient_table = {}
+    text_table = {}
+    for img_path, annotation_path, parse_annotation in tqdm(samples, disable=not verbose):
+        try:
+            polygons = parse_annotation(annotation_path)
+        except (IOError, OSError, ValueError) as err:
+            print('{}, skipped'.format(err))
+            continue
+        for pts, orient, text in polygons:
+            pts = np.asarray(pts)
+            dtypes.append(_POINT_DTYPES.index(pts.dtype) if pts.dtype in _POINT_DTYPES else
+                          _POINT_DTYPES.index(np.dtype(np.float64)))
+            points.append(pts.reshape(-1, 2).astype(np.float32))
+            point_offsets.append(point_offsets[-1] + len(points[-1]))
+            orients.append(orient_table.setdefault(str(orient), len(orient_table)))
+            text_ids.append(text_table.setdefault(str(text), len(text_table)))
+        images.append(img_path)
+        polygon_offsets.append(len(dtypes))
+    texts = [text.encode('utf-8') for text in text_table]
+    columns = {
+        'points': np.concatenate(points) if points else np.zeros((0, 2), np.float32),
+        'point_offsets': np.array(point_offsets, np.int64),
+        'polygon_offsets': np.array(polygon_offsets, np.int64),
+        'dtypes': np.array(dtypes, np.uint8),
+        'orients': np.array(orients, np.uint32),
+        'text_ids': np.array(text_ids, np.uint32),
+        'text_bytes': np.frombuffer(b''.join(texts), np.uint8),
+        'text_offsets': np.cumsum([0] + [len(text) for text in texts], dtype=np.int64),
+    }
+    for name in COLUMNS:
+        np.save(os.path.join(store_dir, name + '.npy'), columns[name])
+    # written last, a store without it is incomplete
+    with open(os.path.join(store_dir, STORE_NAME), 'w') as f:
+        json.dump({'images': images, 'orients': list(orient_table)}, f)
+    return len(images)
+
+
+class AnnotationStore(object):
+    """
+    Annotations compiled by compile_annotations, the parse function of the
+    samples: the polygons of an image are slices of the columns read through
+    np.memmap
+    :param store_dir: (str), folder of the store
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.store_path = os.path.join(store_dir, STORE_NAME)
+        with open(self.store_path) as f:
+            store = json.load(f)
+        self.images = store['images']
+        self.orient_table = store['orients']
+        # opened by each loader worker on its first read
+        self.columns = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['columns'] = None
+        state['images'] = []
+        return state
+
+    def __len__(self):
+        return len(self.images)
+
+    def open(self):
+        if self.columns is None:
+            # plain arrays over the maps, indexing a np.memmap is slower
+            self.columns = {name: np.asarray(np.load(os.path.join(self.store_dir, name + '.npy'), mmap_mode='r'))
+                            for name in COLUMNS}
+        return self.columns
+
+    def parse(self, annotation_path):
+        """
+        Compiled annotation parser
+        :param annotation_path: (str), compiled reference of the image
+        :return: (list), [points, orient, text]
+        """
+        index = int(annotation_path.rsplit(':', 1)[1])
+        columns = self.open()
+        first, last = columns['polygon_offsets'][index:index + 2].tolist()
+        point_offsets = columns['point_offsets'][first:last + 1]
+        # a slice per column, the polygons are cut from them
+        points = columns['points'][point_offsets[0]:point_offsets[-1]]
+        point_offsets = (point_offsets - point_offsets[0]).tolist()
+        text_ids = columns['text_ids'][first:last]
+        text_offsets = columns['text_offsets']
+        text_starts = text_offsets[text_ids].tolist()
+        text_ends = text_offsets[text_ids + 1].tolist()
+        text_bytes = columns['text_bytes']
+        polygons = []
+        for i, (dtype, orient) in enumerate(zip(columns['dtypes'][first:last].tolist(),
+                                                columns['orients'][first:last].tolist())):
+            pts = points[point_offsets[i]:point_offsets[i + 1]].astype(_POINT_DTYPES[dtype])
+            text = text_bytes[text_starts[i]:text_ends[i]].tobytes().decode('utf-8')
+            polygons.append([pts, self.orient_table[orient], text])
+        return polygons
+
+
+class CompiledText(BaseImageDataset):
+    """
+    Dataset compiled by compile_annotations.py in root/compiled/<name>, the
+    annotations are compiled references parsed by an AnnotationStore
+    """
+    dataset_dir = 'compiled'
+
+    def __init__(self, root='./data', name='', verbose=True, **kwargs):
+        super(CompiledText, self).__init__(root)
+        self.dataset_dir = os.path.join(self.root, self.dataset_dir, name)
+        self.check_before_run()
+        self.store = AnnotationStore(self.dataset_dir)
+        self.image_list = self.store.images
+        self.annotation_list = [compiled_ref(self.store.store_path, i) for i in range(len(self.store))]
+        if verbose:
+            print('=> Compiled {} loaded'.format(name))
+            self.print_dataset_statistics(
+                self.image_list, self.annotation_list)
+        self.train = self.process_dir(self.image_list, self.annotation_list)
+
+    def check_before_run(self):
+        """Check if all files are available before going deeper"""
+        if not os.path.exists(os.path.join(self.dataset_dir, STORE_NAME)):
+            raise RuntimeError(
+                '"{}" is not available'.format(self.dataset_dir))
+
+    def process_dir(self, image_list, annotation_list):
+        dataset = []
+        for i in range(len(image_list)):
+            dataset.append([image_list[i], annotation_list[i], self.store.parse])
+        return dataset
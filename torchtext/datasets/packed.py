@@ -0,0 +1,178 @@
+from .bases import BaseImageDataset
+import os
+import json
+import mmap
+import numpy as np
+from tqdm import tqdm
+
+PACKED_PREFIX = 'packed:'
+# point types of the annotations, kept so the transforms behave the same
+_POINT_DTYPES = [np.dtype(np.int32), np.dtype(np.int64), np.dtype(np.float32), np.dtype(np.float64)]
+_RECORD_DTYPE = np.dtype([('num_points', '<u4'), ('dtype', 'u1'), ('orient', '<u4'), ('text', '<u4')])
+INDEX_DTYPE = np.dtype([('shard', '<u4'), ('image_offset', '<u8'), ('image_length', '<u4'),
+                        ('annotation_offset', '<u8'), ('annotation_length', '<u4')])
+# shards opened by this process
+_shards = {}
+
+
+def is_packed(path):
+    return isinstance(path, str) and path.startswith(PACKED_PREFIX)
+
+
+def packed_ref(shard_path, offset, length):
+    return '{}{}:{}:{}'.format(PACKED_PREFIX, shard_path, offset, length)
+
+
+def source_file(path):
+    """File holding a path, the shard of a packed reference"""
+    if is_packed(path):
+        return path[len(PACKED_PREFIX):].rsplit(':', 2)[0]
+    return path
+
+
+def read_packed(ref):
+    """
+    Bytes of a packed reference, read through an mmap of its shard
+    :return: (memoryview)
+    """
+    shard_path, offset, length = ref[len(PACKED_PREFIX):].rsplit(':', 2)
+    shard = _shards.get(shard_path)
+    if shard is None:
+        with open(shard_path, 'rb') as f:
+            shard = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _shards[shard_path] = shard
+    offset = int(offset)
+    return memoryview(shard)[offset:offset + int(length)]
+
+
+def encode_annotation(polygons):
+    """
+    Compact record of the polygons of an image: the number of polygons, then
+    per polygon its number of points, point type, orient and text lengths,
+    then the orient and text utf-8 strings and the points
+    :param polygons: (list), [points, orient, text] as given by the parse functions
+    :return: (bytes)
+    """
+    header = np.zeros(len(polygons), _RECORD_DTYPE)
+    strings = []
+    points = []
+    for i, (pts, orient, text) in enumerate(polygons):
+        pts = np.asarray(pts)
+        if pts.dtype not in _POINT_DTYPES:
+            pts = pts.astype(np.float64)
+        orient = str(orient).encode('utf-8')
+        text = str(text).encode('utf-8')
+        header[i] = (len(pts), _POINT_DTYPES.index(pts.dtype), len(orient), len(text))
+        strings += [orient, text]
+        points.append(np.ascontiguousarray(pts.reshape(-1, 2), pts.dtype.newbyteorder('<')).tobytes())
+    return b''.join([np.uint32(len(polygons)).tobytes(), header.tobytes()] + strings + points)
+
+
+def decode_annotation(record):
+    """
+    :param record: (bytes), see encode_annotation
+    :return: (list), [points, orient, text]
+    """
+    num_polygons = int(np.frombuffer(record, '<u4', 1)[0])
+    header = np.frombuffer(record, _RECORD_DTYPE, num_polygons, 4)
+    offset = 4 + header.nbytes
+    strings = []
+    for num_points, dtype, orient_length, text_length in header.tolist():
+        orient = bytes(record[offset:offset + orient_length]).decode('utf-8')
+        offset += orient_length
+        text = bytes(record[offset:offset + text_length]).decode('utf-8')
+        offset += text_length
+        strings.append((orient, text))
+    polygons = []
+    for (num_points, dtype, _, _), (orient, text) in zip(header.tolist(), strings):
+        dtype = _POINT_DTYPES[dtype]
+        pts = np.frombuffer(record, dtype.newbyteorder('<'), num_points * 2, offset)
+        offset += pts.nbytes
+        polygons.append([pts.astype(dtype).reshape(num_points, 2), orient, text])
+    return polygons
+
+
+def pack_samples(samples, pack_dir, shard_size=1 << 30, verbose=True):
+    """
+    Write the images and annotations of samples into shard files, the image
+    file bytes as they are followed by the encoded annotation
+    :param samples: (list), [img_path, annotation_path, parse_annotation] of a dataset
+    :param pack_dir: (str), folder of the shards, index.npy and packed.json
+    :param shard_size: (int), bytes after which a new shard is started
+    :return: (int), number of samples packed
+    """
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    index = np.zeros(len(samples), INDEX_DTYPE)
+    shards = []
+    shard = None
+    count = 0
+    for img_path, annotation_path, parse_annotation in tqdm(samples, disable=not verbose):
+        try:
+            with open(img_path, 'rb') as f:
+                image = f.read()
+            record = encode_annotation(parse_annotation(annotation_path))
+        except (IOError, OSError, ValueError) as err:
+            print('{}, skipped'.format(err))
+            continue
+        if shard is None or shard.tell() >= shard_size:
+            if shard is not None:
+                shard.close()
+            shards.append('shard-{:05d}.pack'.format(len(shards)))
+            shard = open(os.path.join(pack_dir, shards[-1]), 'wb')
+        offset = shard.tell()
+        shard.write(image)
+        shard.write(record)
+        index[count] = (len(shards) - 1, offset, len(image), offset + len(image), len(record))
+        count += 1
+    if shard is not None:
+        shard.close()
+    np.save(os.path.join(pack_dir, 'index.npy'), index[:count])
+    with open(os.path.join(pack_dir, 'packed.json'), 'w') as f:
+        json.dump({'shards': shards, 'count': count}, f)
+    return count
+
+
+class PackedText(BaseImageDataset):
+    """
+    Dataset packed by pack_dataset.py in root/packed/<name>, images and
+    annotations are packed references read through mmap, see read_packed
+    """
+    dataset_dir = 'packed'
+
+    def __init__(self, root='./data', name='', verbose=True, **kwargs):
+        super(PackedText, self).__init__(root)
+        self.dataset_dir = os.path.join(self.root, self.dataset_dir, name)
+        self.check_before_run()
+        with open(os.path.join(self.dataset_dir, 'packed.json')) as f:
+            shards = [os.path.join(self.dataset_dir, shard) for shard in json.load(f)['shards']]
+        index = np.load(os.path.join(self.dataset_dir, 'index.npy'))
+        self.image_list = [packed_ref(shards[shard], offset, length) for shard, offset, length in
+                           zip(index['shard'], index['image_offset'], index['image_length'])]
+        self.annotation_list = [packed_ref(shards[shard], offset, length) for shard, offset, length in
+                                zip(index['shard'], index['annotation_offset'], index['annotation_length'])]
+        if verbose:
+            print('=> Packed {} loaded'.format(name))
+            self.print_dataset_statistics(
+                self.image_list, self.annotation_list)
+        self.train = self.process_dir(self.image_list, self.annotation_list)
+
+    def check_before_run(self):
+        """Check if all files are available before going deeper"""
+        if not os.path.exists(os.path.join(self.dataset_dir, 'packed.json')):
+            raise RuntimeError(
+                '"{}" is not available'.format(self.dataset_dir))
+
+    def process_dir(self, image_list, annotation_list):
+        dataset = []
+        for i in range(len(image_list)):
+            dataset.append([image_list[i], annotation_list[i], self.parse_record])
+        return dataset
+
+    def parse_record(self, annotation_path):
+        """
+        Packed annotation parser
+        :param annotation_path: (str), packed reference of the record
+        :return: (list), [points, orient, text]
+        """
+        return decode_annotation(read_packed(annotation_path))
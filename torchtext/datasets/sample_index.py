@@ -0,0 +1,110 @@
+import pickle
+import numpy as np
+
+
+def _encode_paths(paths):
+    """
+    :return: (N,) uint8 utf-8 bytes of the paths one after the other, (N + 1,) int64 offsets
+    """
+    paths = [path.encode('utf-8') for path in paths]
+    offsets = np.zeros(len(paths) + 1, np.int64)
+    np.cumsum([len(path) for path in paths], out=offsets[1:])
+    return np.frombuffer(b''.join(paths), np.uint8), offsets
+
+
+def _dump_parser(parse_annotation):
+    # bytes hold no reference to the dataset, the parser is loaded back in each worker
+    try:
+        return pickle.dumps(parse_annotation, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return parse_annotation
+
+
+class SampleIndex(object):
+    """
+    Samples [img_path, annotation_path, parse_annotation] held in a few numpy
+    arrays instead of a Python list per sample, so the forked loader workers
+    don't copy the pages of the index by touching refcounts. The paths are
+    utf-8 bytes with offsets, the parser of a sample an id into the parsers of
+    the datasets, pickled and loaded on first use by each process.
+    :param samples: (list), [img_path, annotation_path, parse_annotation]
+    """
+
+    def __init__(self, samples=()):
+        self.parsers = []
+        keys = {}
+        parser_ids = np.zeros(len(samples), np.uint16)
+        for i, sample in enumerate(samples):
+            parser_id = keys.get(sample[2])
+            if parser_id is None:
+                parser_id = keys[sample[2]] = len(self.parsers)
+                self.parsers.append(_dump_parser(sample[2]))
+            parser_ids[i] = parser_id
+        self.parser_ids = parser_ids
+        self.image_bytes, self.image_offsets = _encode_paths([sample[0] for sample in samples])
+        self.annotation_bytes, self.annotation_offsets = _encode_paths([sample[1] for sample in samples])
+        self._parsers = {}
+
+    @classmethod
+    def from_paths(cls, image_paths, annotation_paths, parse_annotation):
+        """Index of the samples of a dataset sharing one parser"""
+        index = cls()
+        index.parsers = [_dump_parser(parse_annotation)]
+        index.parser_ids = np.zeros(len(image_paths), np.uint16)
+        index.image_bytes, index.image_offsets = _encode_paths(image_paths)
+        index.annotation_bytes, index.annotation_offsets = _encode_paths(annotation_paths)
+        return index
+
+    @classmethod
+    def concatenate(cls, indexes):
+        """
+        :param indexes: (list), SampleIndex or lists of samples, one per dataset
+        """
+        indexes = [index if isinstance(index, cls) else cls(index) for index in indexes]
+        joined = cls()
+        joined.parsers = sum([index.parsers for index in indexes], [])
+        first_ids = np.cumsum([0] + [len(index.parsers) for index in indexes])
+        joined.parser_ids = np.concatenate(
+            [joined.parser_ids] + [index.parser_ids + first for index, first in zip(indexes, first_ids)])
+        for name in ('image', 'annotation'):
+            buffers = [getattr(index, name + '_bytes') for index in indexes]
+            offsets = [getattr(index, name + '_offsets') for index in indexes]
+            starts = np.cumsum([0] + [len(buffer) for buffer in buffers])
+            setattr(joined, name + '_bytes', np.concatenate([np.zeros(0, np.uint8)] + buffers))
+            setattr(joined, name + '_offsets', np.concatenate(
+                [np.zeros(1, np.int64)] + [offset[1:] + start for offset, start in zip(offsets, starts)]))
+        return joined
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_parsers'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.parser_ids)
+
+    def parser(self, parser_id):
+        parse_annotation = self._parsers.get(parser_id)
+        if parse_annotation is None:
+            parse_annotation = self.parsers[parser_id]
+            if isinstance(parse_annotation, bytes):
+                parse_annotation = pickle.loads(parse_annotation)
+            self._parsers[parser_id] = parse_annotation
+        return parse_annotation
+
+    def __getitem__(self, index):
+        """
+        :return: (tuple), img_path, annotation_path, parse_annotation
+        """
+        if not -len(self) <= index < len(self):
+            raise IndexError('sample index {} out of range'.format(index))
+        index %= len(self)
+        start, end = self.image_offsets[index:index + 2]
+        img_path = self.image_bytes[start:end].tobytes().decode('utf-8')
+        start, end = self.annotation_offsets[index:index + 2]
+        annotation_path = self.annotation_bytes[start:end].tobytes().decode('utf-8')
+        return img_path, annotation_path, self.parser(int(self.parser_ids[index]))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -1,4 +1,5 @@
 from .bases import BaseImageDataset
+from .sample_index import SampleIndex
 import os
 from scipy import io
 import numpy as np
@@ -88,8 +89,8 @@ class SynthText_2(BaseImageDataset):
                     dataset += pickle.load(fp)
             for i in tqdm(range(len(dataset))):
                 self.image_list.append(dataset[i][0])
-                dataset[i].append(self.parse_annotation)
-            return dataset
+            return SampleIndex.from_paths(
+                self.image_list, [sample[1] for sample in dataset], self.parse_annotation)
         tmp_dataset = []
         for i in tqdm(range(len(self.annotation_list))):
             annotation_path = self.annotation_list[i]
@@ -97,15 +98,13 @@ class SynthText_2(BaseImageDataset):
             annotations.append(annotation)
             image_path = os.path.join(self.image_dir, image_id)
             self.image_list.append(image_path)
-            dataset.append(
-                [self.image_list[i], annotation_path, self.parse_annotation])
             tmp_dataset.append(
                 [self.image_list[i], annotation_path])
             if (i > 0 and i % 50000 == 0) or i == (len(self.annotation_list)-1):
                 with open(pickle_path+'/'+str(i+1)+'.pkl', 'wb') as fp:
                     pickle.dump(tmp_dataset, fp)
                 tmp_dataset = []
-        return dataset
+        return SampleIndex.from_paths(self.image_list, self.annotation_list, self.parse_annotation)
 
     def parse_json(self, annotation_path):
 
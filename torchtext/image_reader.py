@@ -0,0 +1,143 @@
+import io
+import os.path as osp
+import time
+import numpy as np
+import cv2
+import torch
+from PIL import Image
+from torch.utils.data import get_worker_info
+
+from torchtext.datasets.packed import is_packed, read_packed
+
+# cv2.imread flags decoding a JPEG at 1/2, 1/4 and 1/8 of its size
+_CV2_REDUCED = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def reduce_factor(size, min_size):
+    """
+    Largest JPEG scale denominator keeping the decoded image at least min_size
+    :param size: (tuple), height, width of the image
+    :param min_size: (tuple), height, width the decoded image keeps, None for full size
+    """
+    if min_size is None:
+        return 1
+    for factor in (8, 4, 2):
+        if -(-size[0] // factor) >= min_size[0] and -(-size[1] // factor) >= min_size[1]:
+            return factor
+    return 1
+
+
+class ImageReader(object):
+    """
+    RGB uint8 image decoder giving up on a file after a few attempts.
+
+    Args:
+    - backend (str): 'pil' or 'cv2', cv2 falls back to pil on files it can't decode.
+    - retries (int): attempts on a file before it is quarantined.
+    - retry_delay (float): seconds between two attempts.
+    - quarantine_file (str): paths that failed, one per line, skipped without
+      being opened and appended with the new ones.
+    - num_workers (int): loader workers reading with copies of the reader,
+      the counters of summary are kept in shared memory, one row per process.
+    Paths can also be packed references, see torchtext.datasets.packed.
+    """
+    backends = ('pil', 'cv2')
+    # counters of every process: images and seconds of each backend, then
+    # reduced, failures and quarantined images
+    stat_names = ('pil', 'pil_time', 'cv2', 'cv2_time', 'reduced', 'failures', 'quarantined')
+
+    def __init__(self, backend='pil', retries=3, retry_delay=0.1, quarantine_file='', num_workers=0):
+        if backend not in self.backends:
+            raise KeyError('Invalid decode backend, got "{}", but expected to be one of {}'.format(
+                backend, self.backends))
+        self.backend = backend
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.quarantine_file = quarantine_file
+        self.quarantine = set()
+        if quarantine_file and osp.exists(quarantine_file):
+            with open(quarantine_file) as f:
+                self.quarantine = set(line.strip() for line in f if line.strip())
+        self.stats = torch.zeros((num_workers + 1, len(self.stat_names)), dtype=torch.float64).share_memory_()
+        self.stats[0, self.stat_names.index('quarantined')] = len(self.quarantine)
+
+    def read(self, img_path, min_size=None):
+        """
+        :param min_size: (tuple), height, width the decoded image keeps at
+            least, JPEG files are decoded at 1/2, 1/4 or 1/8 of their size
+            when they stay larger, None for full size
+        :return: (H, W, 3) contiguous uint8 RGB image, (height, width) of the file
+        """
+        if img_path in self.quarantine:
+            raise IOError('{} is quarantined'.format(img_path))
+        if not is_packed(img_path) and not osp.exists(img_path):
+            self.add_quarantine(img_path)
+            raise IOError('{} does not exist'.format(img_path))
+        for attempt in range(self.retries):
+            try:
+                return self.decode(img_path, min_size)
+            except (IOError, OSError, ValueError, SyntaxError, Image.DecompressionBombError) as err:
+                error = err
+                if attempt + 1 < self.retries:
+                    time.sleep(self.retry_delay)
+        self.count('failures')
+        self.add_quarantine(img_path)
+        raise IOError('can not read "{}" after {} attempts: {}'.format(img_path, self.retries, error))
+
+    def decode(self, img_path, min_size=None):
+        start = time.time()
+        data = read_packed(img_path) if is_packed(img_path) else None
+        source = img_path if data is None else io.BytesIO(data)
+        with Image.open(source) as img:
+            size = img.size[::-1]
+            factor = reduce_factor(size, min_size) if img.format == 'JPEG' else 1
+            if self.backend == 'pil':
+                backend = 'pil'
+                if factor > 1:
+                    img.draft('RGB', (-(-size[1] // factor), -(-size[0] // factor)))
+                image = np.array(img.convert('RGB'))
+        if self.backend == 'cv2':
+            backend = 'cv2'
+            flags = _CV2_REDUCED[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+            if data is None:
+                image = cv2.imread(img_path, flags)
+            else:
+                image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+            if image is None:
+                backend = 'pil'
+                source = img_path if data is None else io.BytesIO(data)
+                with Image.open(source) as img:
+                    image = np.array(img.convert('RGB'))
+            else:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if image.shape[:2] != size:
+            self.count('reduced')
+        self.count(backend)
+        self.count(backend + '_time', time.time() - start)
+        return np.ascontiguousarray(image), size
+
+    def add_quarantine(self, img_path):
+        print('=> quarantined unreadable image "{}"'.format(img_path))
+        self.quarantine.add(img_path)
+        self.count('quarantined')
+        if self.quarantine_file:
+            with open(self.quarantine_file, 'a') as f:
+                f.write(img_path + '\n')
+
+    def count(self, name, value=1):
+        # each loader worker adds to its own row, the main process to row 0,
+        # workers beyond num_workers share the last one
+        worker = get_worker_info()
+        row = 0 if worker is None else min(worker.id + 1, len(self.stats) - 1)
+        self.stats[row, self.stat_names.index(name)] += value
+
+    def summary(self):
+        """Decode counters of all the processes reading with the reader"""
+        stats = dict(zip(self.stat_names, self.stats.sum(0).tolist()))
+        lines = ['{}: {} images, {:.2f} ms/image'.format(
+            backend, int(stats[backend]), stats[backend + '_time'] / stats[backend] * 1000)
+            for backend in self.backends if stats[backend]]
+        lines.append('reduced: {}, failures: {}, quarantined: {}'.format(
+            int(stats['reduced']), int(stats['failures']), int(stats['quarantined'])))
+        return '\n'.join(lines)
@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from torchtext.utils.postprocess import process_output
+
+
+def process_field(field, raw_shape, **kwargs):
+    """process_output for callers that only know the shape of the raw image"""
+    # only the shape of the raw image is read
+    raw_img = np.broadcast_to(np.uint8(0), tuple(raw_shape))
+    return process_output(None, field, raw_img, **kwargs)
+
+
+def _process_shared(name, shape, dtype, raw_shape, **kwargs):
+    """Worker side of FieldPostProcessor, maps the field instead of unpickling it"""
+    start = time.time()
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        field = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        contours = process_field(field, raw_shape, **kwargs)
+        del field
+    finally:
+        shm.close()
+    return contours, time.time() - start
+
+
+class FieldPostProcessor(object):
+    """Runs process_output on model fields in a pool of worker processes.
+
+    Every field is copied once into a shared memory block that the worker
+    maps, the block is released when the worker is done with it.
+
+    Args:
+    - workers (int): number of worker processes, 0 runs process_output in the
+      calling process when submitting.
+    - kwargs: threshold, min_area, backend... passed to process_output.
+    """
+
+    def __init__(self, workers=2, **kwargs):
+        self.workers = workers
+        self.kwargs = kwargs
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def submit(self, field, raw_shape):
+        """
+        :param field: (np.array), (2, H, W) model output for one image
+        :param raw_shape: (tuple), shape of the raw image
+        :return: (Future), resolves to (contours, seconds spent in the worker)
+        """
+        if self.executor is None:
+            start = time.time()
+            future = Future()
+            future.set_result((process_field(field, raw_shape, **self.kwargs), time.time() - start))
+            return future
+        field = np.ascontiguousarray(field)
+        shm = shared_memory.SharedMemory(create=True, size=max(field.nbytes, 1))
+        np.ndarray(field.shape, dtype=field.dtype, buffer=shm.buf)[...] = field
+        future = self.executor.submit(
+            _process_shared, shm.name, field.shape, field.dtype.str, tuple(raw_shape), **self.kwargs)
+
+        def release(_):
+            shm.close()
+            shm.unlink()
+        future.add_done_callback(release)
+        return future
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
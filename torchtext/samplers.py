@@ -1,4 +1,5 @@
-from torch.utils.data.sampler import RandomSampler
+from collections import OrderedDict
+from torch.utils.data.sampler import RandomSampler, Sampler
 
 def build_train_sampler(data_source,
                         train_sampler,
@@ -13,4 +14,28 @@ def build_train_sampler(data_source,
     else:
         print('Suport RandomSampler only!')
 
-    return sampler
\ No newline at end of file
+    return sampler
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of indices that share the same size, so they can be stacked.
+
+    Args:
+    - sizes (list): size key of every sample, e.g. (height, width).
+    - batch_size (int): max number of samples per batch.
+    """
+
+    def __init__(self, sizes, batch_size):
+        self.batch_size = batch_size
+        self.buckets = OrderedDict()
+        for index, size in enumerate(sizes):
+            self.buckets.setdefault(size, []).append(index)
+
+    def __iter__(self):
+        for indices in self.buckets.values():
+            for start in range(0, len(indices), self.batch_size):
+                yield indices[start:start + self.batch_size]
+
+    def __len__(self):
+        return sum((len(indices) + self.batch_size - 1) // self.batch_size
+                   for indices in self.buckets.values())
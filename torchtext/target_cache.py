@@ -0,0 +1,131 @@
+import os
+import os.path as osp
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+from torchtext.dataset_loader import DetectDataset
+from torchtext.datasets.compiled import source_file
+from torchtext.utils.misc import mkdirs
+
+
+def transform_params(transform):
+    """
+    Parameters of a deterministic transform the targets depend on
+    :return: (dict), or None for a random transform, whose targets can't be cached
+    """
+    if not getattr(transform, 'deterministic', False):
+        return None
+    return {'transform': type(transform).__name__,
+            'height': transform.maxHeight, 'width': transform.maxWidth}
+
+
+class TargetCache(object):
+    """
+    vec and weight of DetectDataset precomputed for a deterministic transform,
+    see build_target_cache. The targets are .npy files read through np.memmap,
+    a row per sample keyed on its image path, and a row is only used while the
+    annotation file, or its shard or store when packed or compiled, keeps the mtime it was built from.
+    :param cache_dir: (str), folder of the cache
+    """
+    index_name = 'index.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.params = None
+        self.images = []
+        self.mtimes = []
+        index_path = osp.join(cache_dir, self.index_name)
+        if osp.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.params = index['params']
+            self.images = index['images']
+            self.mtimes = index['mtimes']
+        self.rows = {img_path: row for row, img_path in enumerate(self.images)}
+        # opened by each loader worker on its first read
+        self.vec = None
+        self.weight = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['vec'] = state['weight'] = None
+        return state
+
+    def __len__(self):
+        return len(self.images)
+
+    def usable(self, transform):
+        params = transform_params(transform)
+        return self.params is not None and params is not None and \
+            all(self.params[key] == value for key, value in params.items())
+
+    def lookup(self, img_path, annotation_path):
+        """
+        :return: vec (2, H, W), weight (H, W) float32, None when the sample
+            isn't cached, its image couldn't be read or its annotation changed since
+        """
+        row = self.rows.get(img_path)
+        if row is None or os.stat(source_file(annotation_path)).st_mtime_ns != self.mtimes[row]:
+            return None
+        if self.vec is None:
+            self.vec = np.load(osp.join(self.cache_dir, 'vec.npy'), mmap_mode='r')
+            self.weight = np.load(osp.join(self.cache_dir, 'weight.npy'), mmap_mode='r')
+        return self.vec[row].astype(np.float32), self.weight[row].astype(np.float32)
+
+
+def build_target_cache(samples, transform, cache_dir, dtype=np.float32, verbose=True):
+    """
+    Precompute the targets of every sample for a deterministic transform. A
+    cache built for the same samples and transform is updated in place, only
+    the samples whose annotation file changed are computed again.
+    :param samples: (list), [img_path, annotation_path, parse_annotation] as given to DetectDataset
+    :param transform: deterministic transform of the images, see BaseTransform
+    :param cache_dir: (str), folder of the cache
+    :param dtype: np.float32 or np.float16, storage type of the targets
+    :return: (int), number of samples computed
+    """
+    params = transform_params(transform)
+    if params is None:
+        raise ValueError('the targets of the random transform {} can not be cached'.format(
+            type(transform).__name__))
+    params['dtype'] = np.dtype(dtype).name
+    images = [sample[0] for sample in samples]
+    mtimes = [os.stat(source_file(sample[1])).st_mtime_ns for sample in samples]
+    shape = (len(samples), params['height'], params['width'])
+    vec_path = osp.join(cache_dir, 'vec.npy')
+    weight_path = osp.join(cache_dir, 'weight.npy')
+
+    cache = TargetCache(cache_dir)
+    if cache.params == params and cache.images == images:
+        vec = np.load(vec_path, mmap_mode='r+')
+        weight = np.load(weight_path, mmap_mode='r+')
+        stale = [i for i in range(len(samples)) if cache.mtimes[i] != mtimes[i]]
+    else:
+        mkdirs(cache_dir)
+        vec = open_memmap(vec_path, mode='w+', dtype=dtype, shape=(shape[0], 2) + shape[1:])
+        weight = open_memmap(weight_path, mode='w+', dtype=dtype, shape=shape)
+        stale = range(len(samples))
+    # rows are written without an index, an interrupted build starts over
+    index_path = osp.join(cache_dir, TargetCache.index_name)
+    if osp.exists(index_path):
+        os.remove(index_path)
+
+    dataset = DetectDataset(samples, transform_image=transform)
+    for i in tqdm(stale, disable=not verbose):
+        # read sample i itself, the dataset would give the next readable one
+        sample = dataset.dataset[i]
+        try:
+            image, size = dataset.image_reader.read(sample[0], dataset.decode_size)
+        except IOError as err:
+            # no mtime, the row is never looked up and is built again next time
+            print('{}, not cached'.format(err))
+            mtimes[i] = None
+            continue
+        _, vec[i], weight[i] = dataset.load_sample(sample, image, size)
+    vec.flush()
+    weight.flush()
+    with open(index_path, 'w') as f:
+        json.dump({'params': params, 'images': images, 'mtimes': mtimes}, f)
+    return len(stale)
@@ -0,0 +1,418 @@
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from torchtext.dataset_loader import balanced_weight
+from torchtext.utils.avgmeter import AverageMeter
+
+
+def collate_polygons(batch):
+    """
+    collate_fn of DetectDataset(batch_targets=True), images are stacked and
+    the polygons are kept as lists, see build_targets
+    :return: imgs (B, C, H, W), bboxes list of per image polygon lists,
+             hards list of per image don't care flags
+    """
+    imgs = default_collate([sample[0] for sample in batch])
+    return imgs, [sample[1] for sample in batch], [sample[2] for sample in batch]
+
+
+def collate_sparse_targets(batch):
+    """
+    collate_fn of DetectDataset(sparse_targets=True), it runs in the loader
+    workers so the targets stay compact, the box patches of the batch are
+    concatenated and densified by DenseTargetLoader in the main process
+    :return: imgs (B, C, H, W), dict of tensors, the keys of
+             DetectDataset.cal_patches plus sample (n,) the image of each box
+    """
+    imgs = default_collate([sample[0] for sample in batch])
+    targets = [sample[1] for sample in batch]
+    num_boxes = np.cumsum([0] + [len(target['boxes']) for target in targets])
+    num_patch = np.cumsum([0] + [target['offsets'][-1] for target in targets])
+    collated = {
+        'sample': np.repeat(np.arange(len(batch)), np.diff(num_boxes)),
+        'boxes': np.concatenate([target['boxes'] for target in targets]),
+        'instance': np.concatenate([target['instance'] for target in targets]),
+        'dont_care': np.concatenate([target['dont_care'] + num_boxes[i]
+                                     for i, target in enumerate(targets)]),
+        'offsets': np.concatenate([[0]] + [target['offsets'][1:] + num_patch[i]
+                                           for i, target in enumerate(targets)]),
+        'fill': np.concatenate([target['fill'] for target in targets]),
+        'vec': np.concatenate([target['vec'] for target in targets], axis=1),
+        'size': np.stack([target['size'] for target in targets]),
+        'num_polygon': np.concatenate([target['num_polygon'] for target in targets]),
+    }
+    return imgs, {key: torch.from_numpy(np.ascontiguousarray(value))
+                  for key, value in collated.items()}
+
+
+def densify_targets(targets):
+    """
+    vec and weight maps of a batch of compact targets, every box drawn in
+    order as DetectDataset.cal_vector does
+    :param targets: (dict), see collate_sparse_targets
+    :return: vecs (B, 2, H, W), weights (B, H, W) float32 tensors
+    """
+    targets = {key: value.numpy() for key, value in targets.items()}
+    height, width = targets['size'][0]
+    batch_size = len(targets['size'])
+    vecs = np.zeros((batch_size, 2, height, width), dtype=np.float32)
+    instances = np.zeros((batch_size, height, width), dtype=np.float32)
+    dont_care = np.zeros(len(targets['boxes']), dtype=bool)
+    dont_care[targets['dont_care']] = True
+    offsets = targets['offsets']
+    for i, (top, left, box_height, box_width) in enumerate(targets['boxes']):
+        b = targets['sample'][i]
+        fill = targets['fill'][offsets[i]:offsets[i+1]].reshape(box_height, box_width)
+        vec = vecs[b, :, top:top+box_height, left:left+box_width]
+        vec[:, fill] = 0
+        vec += targets['vec'][:, offsets[i]:offsets[i+1]].reshape(2, box_height, box_width)
+        instance = instances[b, top:top+box_height, left:left+box_width]
+        instance[fill] = -1 if dont_care[i] else targets['instance'][i]
+    weights = np.stack([balanced_weight(instances[b], targets['num_polygon'][b])
+                        for b in range(batch_size)])
+    return torch.from_numpy(vecs), torch.from_numpy(weights)
+
+
+def tensor_bytes(tensors):
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class DenseTargetLoader(object):
+    """
+    Loader of DetectDataset(sparse_targets=True) batches yielding the
+    (imgs, vecs, weights) of the dense loader, the targets densified in the
+    main process. Keeps the bytes of targets moved from the workers per batch,
+    and the bytes the dense targets would have moved.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.sparse_bytes = AverageMeter()
+        self.dense_bytes = AverageMeter()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for imgs, targets in self.loader:
+            vecs, weights = densify_targets(targets)
+            self.sparse_bytes.update(tensor_bytes(targets.values()))
+            self.dense_bytes.update(tensor_bytes([vecs, weights]))
+            yield imgs, vecs, weights
+
+
+def _polygon_boxes(bboxes, hards, height, width):
+    """
+    Polygons kept by cal_vector with their canvas, the box clipped to the
+    image and padded by one background pixel on each side
+    :return: list of (image index, polygon index in the image, hard, top,
+             left, canvas height, canvas width, points in canvas coordinates)
+    """
+    boxes = []
+    for b, (polygons, flags) in enumerate(zip(bboxes, hards)):
+        for bboxi, points in enumerate(polygons):
+            points = np.asarray(points).astype(np.int32)
+            left, top = points.min(axis=0)
+            right, bottom = points.max(axis=0)
+            if right < 0 or bottom < 0:
+                continue
+            if left > width-1 or top > height-1:
+                continue
+            left = max(0, left)
+            top = max(0, top)
+            right = min(width-1, right)
+            bottom = min(height-1, bottom)
+            boxes.append((b, bboxi, int(flags[bboxi]), top, left, bottom-top+3,
+                          right-left+3, points - [left-1, top-1]))
+    return boxes
+
+
+def _chunks(boxes, max_chunk_pixels):
+    # boxes of similar size share a padded chunk
+    order = sorted(range(len(boxes)), key=lambda i: max(boxes[i][5], boxes[i][6]))
+    chunk = []
+    chunk_height = chunk_width = 0
+    for i in order:
+        box_height = max(chunk_height, boxes[i][5])
+        box_width = max(chunk_width, boxes[i][6])
+        if chunk and (len(chunk) + 1) * box_height * box_width > max_chunk_pixels:
+            yield chunk
+            chunk = []
+            box_height, box_width = boxes[i][5], boxes[i][6]
+        chunk.append(i)
+        chunk_height, chunk_width = box_height, box_width
+    if chunk:
+        yield chunk
+
+
+def _clip_lines(start, end, canvas):
+    """
+    cv2.clipLine on every edge, integer Cohen-Sutherland clipping to the
+    canvas which moves the first pixel of the lines crossing its border
+    :param start, end: (torch.Tensor), (K, E, 2) int64 x, y end points
+    :param canvas: (torch.Tensor), (K, 2) canvas height and width
+    :return: clipped start and end, (K, E) bool False for lines outside
+    """
+    right = (canvas[:, 1] - 1)[:, None]
+    bottom = (canvas[:, 0] - 1)[:, None]
+    x1, y1 = start[..., 0], start[..., 1]
+    x2, y2 = end[..., 0], end[..., 1]
+
+    def outcode(x, y):
+        return (x < 0).long() + (x > right).long() * 2 + (y < 0).long() * 4 + (y > bottom).long() * 8
+
+    def shift(delta, num, den):
+        # (int64)((double)delta * num / den), den is 0 only where unused
+        den = torch.where(den != 0, den, torch.ones_like(den))
+        return torch.trunc(delta.double() * num.double() / den.double()).long()
+
+    c1, c2 = outcode(x1, y1), outcode(x2, y2)
+    clip = ((c1 & c2) == 0) & ((c1 | c2) != 0)
+    # first onto the top or bottom border, then onto the left or right one
+    move = clip & ((c1 & 12) != 0)
+    a = torch.where(c1 < 8, torch.zeros_like(bottom), bottom)
+    x1 = torch.where(move, x1 + shift(a - y1, x2 - x1, y2 - y1), x1)
+    y1 = torch.where(move, a.expand_as(y1), y1)
+    c1 = torch.where(move, (x1 < 0).long() + (x1 > right).long() * 2, c1)
+    move = clip & ((c2 & 12) != 0)
+    a = torch.where(c2 < 8, torch.zeros_like(bottom), bottom)
+    x2 = torch.where(move, x2 + shift(a - y2, x2 - x1, y2 - y1), x2)
+    y2 = torch.where(move, a.expand_as(y2), y2)
+    c2 = torch.where(move, (x2 < 0).long() + (x2 > right).long() * 2, c2)
+    clip = clip & ((c1 & c2) == 0) & ((c1 | c2) != 0)
+    move = clip & (c1 != 0)
+    a = torch.where(c1 == 1, torch.zeros_like(right), right)
+    y1 = torch.where(move, y1 + shift(a - x1, y2 - y1, x2 - x1), y1)
+    x1 = torch.where(move, a.expand_as(x1), x1)
+    c1 = torch.where(move, torch.zeros_like(c1), c1)
+    move = clip & (c2 != 0)
+    a = torch.where(c2 == 1, torch.zeros_like(right), right)
+    y2 = torch.where(move, y2 + shift(a - x2, y2 - y1, x2 - x1), y2)
+    x2 = torch.where(move, a.expand_as(x2), x2)
+    c2 = torch.where(move, torch.zeros_like(c2), c2)
+    return torch.stack([x1, y1], dim=2), torch.stack([x2, y2], dim=2), (c1 | c2) == 0
+
+
+def _rasterize(points, canvas, device, border=False):
+    """
+    Fill the polygons the way cv2.fillPoly does on integer points: the
+    Bresenham outline of every edge, plus on every row the pixels between
+    each pair of edge crossings
+    :param points: (np.array), (K, E, 2) x, y vertices, padded by repeating the last one
+    :param canvas: (np.array), (K, 2) canvas height and width of each polygon
+    :param border: (bool), clear the border of every canvas
+    :return: (K, H, W) bool, H and W the largest canvas
+    """
+    num_polygon = len(points)
+    height, width = int(canvas[:, 0].max()), int(canvas[:, 1].max())
+    canvas = torch.as_tensor(canvas, device=device)
+    # the padding makes the last edge go from the last vertex back to the first
+    start = torch.as_tensor(points, dtype=torch.int64, device=device)
+    end = torch.as_tensor(np.roll(points, -1, axis=1), dtype=torch.int64, device=device)
+    clip_start, clip_end, drawn = _clip_lines(start, end, canvas)
+
+    # an edge leaving the canvas crosses the rows along its clipped line when
+    # it is not flat once clipped, edges inside the canvas half a pixel right
+    # of the true edge, in 16 bit fixed point with a truncated slope
+    size = canvas[:, None, [1, 0]]
+    outside = ((start < 0) | (start >= size) | (end < 0) | (end >= size)).any(dim=2)
+    clipped = (outside & (clip_start[..., 1] != clip_end[..., 1]))[..., None]
+    first = torch.where(clipped, clip_start, start)
+    second = torch.where(clipped, clip_end, end)
+    first_x = (first[..., 0] << 16) + torch.where(outside, 0, 1 << 15)
+    second_x = (second[..., 0] << 16) + torch.where(outside, 0, 1 << 15)
+    rise = second[..., 1] - first[..., 1]
+    slope = torch.div(second_x - first_x, torch.where(rise != 0, rise, torch.ones_like(rise)),
+                      rounding_mode='trunc')
+    downward = start[..., 1] < end[..., 1]
+    y0 = torch.min(start[..., 1], end[..., 1])
+    y1 = torch.max(start[..., 1], end[..., 1])
+    x0 = torch.where(downward, first_x + (start[..., 1] - first[..., 1]) * slope,
+                     second_x + (end[..., 1] - second[..., 1]) * slope)
+
+    rows = torch.arange(height, device=device)[None, :, None]
+    cross = x0[:, None] + (rows - y0[:, None]) * slope[:, None]
+    never = np.iinfo(np.int64).max
+    active = (rows >= y0[:, None]) & (rows < y1[:, None])
+    cross = torch.where(active, cross, torch.full_like(cross, never))
+    cross, _ = torch.sort(cross, dim=2)
+    if cross.shape[2] % 2:
+        cross = torch.cat([cross, torch.full_like(cross[..., :1], never)], dim=2)
+    valid = cross[..., 1::2] != never
+    span_left = (cross[..., 0::2] >> 16).clamp(0, width)
+    span_right = (cross[..., 1::2] >> 16).clamp(-1, width - 1) + 1
+    span_left = torch.where(valid, span_left, torch.full_like(span_left, width))
+    span_right = torch.where(valid, span_right, torch.full_like(span_right, width))
+    span_right = torch.max(span_right, span_left)
+    edge = torch.zeros((num_polygon, height, width + 1), dtype=torch.int32, device=device)
+    edge.scatter_add_(2, span_left, torch.ones_like(span_left, dtype=torch.int32))
+    edge.scatter_add_(2, span_right, -torch.ones_like(span_right, dtype=torch.int32))
+    fill = torch.cumsum(edge, dim=2)[..., :width] > 0
+
+    # outlines, 8-connected Bresenham lines drawn from their left end, the
+    # minor axis moves once past half a pixel
+    swap = (clip_end[..., 0] < clip_start[..., 0])[..., None]
+    start = torch.where(swap, clip_end, clip_start)
+    end = torch.where(swap, clip_start, clip_end)
+    dx = end[..., 0] - start[..., 0]
+    dy = end[..., 1] - start[..., 1]
+    major = torch.max(dx, torch.abs(dy))
+    minor = torch.min(dx, torch.abs(dy))
+    steps = torch.arange(int(major.max()) + 1, device=device)[None, None]
+    moved = (2 * steps * minor[..., None] + major[..., None] - 1) // torch.clamp(2 * major, min=1)[..., None]
+    along_x = (dx >= torch.abs(dy))[..., None]
+    x = start[..., 0, None] + torch.where(along_x, steps, moved)
+    y = start[..., 1, None] + torch.sign(dy)[..., None] * torch.where(along_x, moved, steps)
+    keep = (steps <= major[..., None]) & drawn[..., None] & (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    polygon = torch.arange(num_polygon, device=device)[:, None, None].expand_as(x)
+    fill.view(-1)[(polygon * height * width + y * width + x)[keep]] = True
+
+    # pixels past the canvas of a polygon, and its border if asked, are background
+    border = int(border)
+    inner_rows = torch.arange(height, device=device)[None, :]
+    inner_cols = torch.arange(width, device=device)[None, :]
+    inner_rows = (inner_rows >= border) & (inner_rows < canvas[:, :1] - border)
+    inner_cols = (inner_cols >= border) & (inner_cols < canvas[:, 1:] - border)
+    return fill & inner_rows[:, :, None] & inner_cols[:, None, :]
+
+
+def _nearest_background(text, polygon, rows, cols):
+    """
+    Exact euclidean nearest background pixel of the given text pixels, a
+    column pass followed by a row pass over columns further and further away,
+    a pixel is done once no further column can be strictly nearer
+    :param text: (torch.Tensor), (K, H, W) bool, the border is background
+    :param polygon, rows, cols: (torch.Tensor), (N,) the text pixels, see torch.nonzero
+    :return: row and col of the nearest background pixel, (N,) int64
+    """
+    num_polygon, height, width = text.shape
+    device = text.device
+    line = torch.arange(height, dtype=torch.int32, device=device)[None, :, None].expand_as(text)
+    never = torch.tensor(-2 * height, dtype=torch.int32, device=device)
+    # nearest background row above and below in the same column
+    above = torch.cummax(torch.where(text, never, line), dim=1)[0]
+    below = -torch.flip(torch.cummax(torch.flip(torch.where(text, never, -line), [1]), dim=1)[0], [1])
+    near_row = torch.where(line - above <= below - line, above, below).view(-1)
+    column = (line.reshape(-1) - near_row) ** 2
+    del above, below
+
+    # a text pixel is nearer to the border than to any column past it, so the
+    # columns searched stay inside the chunk
+    index = (polygon * height + rows) * width + cols
+    best_row = near_row[index].long()
+    best_col = cols.clone()
+    pixel = torch.arange(len(index), device=device)
+    best = column[index]
+    offset = 1
+    while len(pixel):
+        # candidates this far away are at least offset ** 2 from the pixel
+        active = best > offset * offset
+        pixel, index, best = pixel[active], index[active], best[active]
+        for shift in (-offset, offset):
+            candidate = column[index + shift] + offset * offset
+            closer = candidate < best
+            best = torch.where(closer, candidate, best)
+            best_row[pixel[closer]] = near_row[index[closer] + shift].long()
+            best_col[pixel[closer]] = cols[pixel[closer]] + shift
+        offset += 1
+    return best_row, best_col
+
+
+def build_targets(shape, bboxes, hards, device=None, max_chunk_pixels=1 << 20,
+                  return_instances=False):
+    """
+    Text field targets of a whole batch, the batched counterpart of
+    DetectDataset.cal_vector: unit vector from the nearest background pixel
+    of its polygon on every text pixel, later polygons overwriting earlier
+    ones, and the balanced weight map with don't care pixels marked -1.
+    Polygons are filled like cv2.fillPoly, so the weights and instance maps
+    are those of cal_vector. Every text pixel points away from a nearest
+    background pixel: where two are equally near it may be another one than
+    the label of cv2.distanceTransformWithLabels, and on the few pixels where
+    that label is not a nearest one vec differs from cal_vector too.
+    :param shape: (tuple), (B, C, H, W) shape of the image batch
+    :param bboxes: (list), per image, list of (k, 2) x, y polygons
+    :param hards: (list), per image, 1 for the don't care polygons
+    :param device: (torch.device), where the targets are built
+    :param max_chunk_pixels: (int), bound of the padded boxes processed at once
+    :param return_instances: (bool), also return the instance maps
+    :return: vecs (B, 2, H, W), weights (B, H, W) float32 tensors on device,
+        and with return_instances the (B, H, W) int64 instance maps, polygon
+        index + 1 of the polygon drawn last, -1 on don't care, 0 on background
+    """
+    batch_size, height, width = shape[0], shape[-2], shape[-1]
+    num_pixel = batch_size * height * width
+    boxes = _polygon_boxes(bboxes, hards, height, width)
+
+    # instance ids run over the batch in polygon order, so the largest id on a
+    # pixel is the polygon drawn last
+    offsets = np.cumsum([0] + [len(polygons) for polygons in bboxes])
+    seg_index, seg_instance = [], []
+    text_index, text_instance, vec_x, vec_y = [], [], [], []
+    for chunk in _chunks(boxes, max_chunk_pixels):
+        num_points = max(len(boxes[i][7]) for i in chunk)
+        points = np.zeros((len(chunk), num_points, 2), np.int64)
+        for k, i in enumerate(chunk):
+            points[k] = boxes[i][7][np.minimum(np.arange(num_points), len(boxes[i][7]) - 1)]
+        canvas = np.array([boxes[i][5:7] for i in chunk])
+        info = torch.as_tensor(np.array([[boxes[i][0], offsets[boxes[i][0]] + boxes[i][1] + 1,
+                                          boxes[i][3], boxes[i][4]] for i in chunk]), device=device)
+
+        # the polygon filled in its box gets its id, the one filled in the
+        # padded box with a background border gets the field
+        polygon, rows, cols = torch.nonzero(_rasterize(points - 1, canvas - 2, device), as_tuple=True)
+        seg_index.append((info[polygon, 0] * height + info[polygon, 2] + rows) * width +
+                         info[polygon, 3] + cols)
+        seg_instance.append(info[polygon, 1])
+
+        text = _rasterize(points, canvas, device, border=True)
+        polygon, rows, cols = torch.nonzero(text, as_tuple=True)
+        near_row, near_col = _nearest_background(text, polygon, rows, cols)
+        diff_x = rows - near_row
+        diff_y = cols - near_col
+        dist = torch.sqrt((diff_x * diff_x + diff_y * diff_y).double())
+        vec_x.append((diff_x / dist).float())
+        vec_y.append((diff_y / dist).float())
+        text_index.append((info[polygon, 0] * height + info[polygon, 2] - 1 + rows) * width +
+                          info[polygon, 3] - 1 + cols)
+        text_instance.append(info[polygon, 1])
+
+    vecs = torch.zeros((2, num_pixel), dtype=torch.float32, device=device)
+    owner = torch.zeros(num_pixel, dtype=torch.int64, device=device)
+    pixAve = torch.zeros(offsets[-1] + 1, dtype=torch.float64, device=device)
+    hard = torch.zeros(offsets[-1] + 1, dtype=torch.bool, device=device)
+    if boxes:
+        owner.scatter_reduce_(0, torch.cat(seg_index), torch.cat(seg_instance), reduce='amax')
+        # a polygon clears the field under its fill, then adds its own field
+        text_index, text_instance = torch.cat(text_index), torch.cat(text_instance)
+        keep = text_instance >= owner[text_index]
+        order = torch.argsort(text_instance[keep], stable=True)
+        vecs[0].index_add_(0, text_index[keep][order], torch.cat(vec_x)[keep][order])
+        vecs[1].index_add_(0, text_index[keep][order], torch.cat(vec_y)[keep][order])
+
+        hard[1:] = torch.as_tensor(np.concatenate(
+            [np.asarray(flags, dtype=bool).reshape(-1) for flags in hards]), device=device)
+        pixCount = torch.bincount(owner, minlength=len(pixAve))
+        pixCount[0] = 0
+        pixCount[hard] = 0
+        # every image shares its weight equally between its instances
+        image = torch.as_tensor(np.repeat(np.arange(batch_size), np.diff(offsets)), device=device)
+        posCount = torch.zeros(batch_size, dtype=torch.float64, device=device)
+        posCount.index_add_(0, image, pixCount[1:].double())
+        bboxRemain = torch.zeros(batch_size, dtype=torch.float64, device=device)
+        bboxRemain.index_add_(0, image, (pixCount[1:] > 0).double())
+        bboxAve = posCount / bboxRemain.clamp(min=1)
+        pixAve[1:] = torch.where(pixCount[1:] > 0, bboxAve[image] / pixCount[1:].clamp(min=1).double(),
+                                 torch.zeros_like(bboxAve[image]))
+    weights = pixAve.float()[owner]
+    weights[hard[owner]] = -1
+    vecs = vecs.view(2, batch_size, height, width).transpose(0, 1).contiguous()
+    weights = weights.view(batch_size, height, width)
+    if not return_instances:
+        return vecs, weights
+    # global ids back to the polygon index + 1 within the image
+    local = torch.as_tensor(np.concatenate(
+        [[0]] + [np.arange(1, len(polygons) + 1) for polygons in bboxes]), device=device)
+    local[hard] = -1
+    return vecs, weights, local[owner].view(batch_size, height, width)
@@ -1,8 +1,14 @@
 import numpy as np
 import math
 import cv2
+import torch
 import numpy.random as random
 
+# use imagenet mean and std as default
+# TODO: compute dataset-specific mean and std
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
 
 class Compose(object):
     """Composes several augmentations together.
@@ -291,19 +297,39 @@ class RandomResizedLimitCrop(object):
         j = (img.shape[1] - w) // 2
         return i, j, w, w
 
-    def __call__(self, image, polygons=None):
+    def get_window(self, image, points=None):
+        """
+        Crop window keeping enough of the text
+        :param points: (list), points of the polygons
+        :return: top, left, height, width of the window
+        """
         height, width = image.shape[0], image.shape[1]
-        mask = np.zeros((height, width), dtype=np.uint8)
-        if polygons is not None:
-            for polygon in polygons:
-                cv2.fillPoly(mask, [polygon.points.astype(np.int32)], (1,), 1)
+        points = [pts.astype(np.int32) for pts in points] if points else []
+        # the text mask is only rasterized over the box of the polygons inside the image
+        top, left, bottom, right = 0, 0, 0, 0
+        if points:
+            corners = np.concatenate(points)
+            left, top = np.maximum(corners.min(0), 0).tolist()
+            right, bottom = np.minimum(corners.max(0) + 1, [width, height]).tolist()
+        total = 0
+        if left < right and top < bottom:
+            mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+            for pts in points:
+                cv2.fillPoly(mask, [pts], (1,), 1, offset=(-left, -top))
+            # text area of the image, and of any window with a summed-area table
+            total = cv2.countNonZero(mask)
+            integral = cv2.integral(mask)
         attempt = 0
         min_overlap = [0.1, 0.3, 0.5, 0.7]
         while attempt < 10:
             i, j, h, w = self.get_params(image, self.scale, self.ratio)
-            overlap = mask[i:i+h, j:j+w] > 0
+            overlap = 0
+            if total:
+                y0, y1 = [min(max(y - top, 0), bottom - top) for y in (i, i + h)]
+                x0, x1 = [min(max(x - left, 0), right - left) for x in (j, j + w)]
+                overlap = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
             random_idx = np.random.randint(0, 4)
-            if np.sum(overlap) >= np.sum(mask)*min_overlap[random_idx]:
+            if overlap >= total*min_overlap[random_idx]:
                 break
             attempt += 1
         if attempt == 10:
@@ -311,7 +337,11 @@ class RandomResizedLimitCrop(object):
             w = h
             i = (height-h) // 2
             j = (width-w) // 2
+        return i, j, h, w
 
+    def __call__(self, image, polygons=None):
+        i, j, h, w = self.get_window(
+            image, [polygon.points for polygon in polygons] if polygons is not None else None)
         cropped = image[i:i + h, j:j + w, :]
         scales = np.array([self.size[0] / w, self.size[1] / h])
         if polygons is not None:
@@ -323,6 +353,89 @@ class RandomResizedLimitCrop(object):
         return img, polygons
 
 
+class RandomWarpCrop(object):
+    """
+    RandomMirror, RandomResizedLimitCrop and Rotate in one cv2.warpAffine: the
+    same random parameters, drawn in the same order, are composed into a
+    single matrix mapping the output pixels to the input image, and the
+    points of all the polygons are moved by one matrix product. Pixels are
+    sampled as the resize samples the crop, the points are moved as the
+    chained transforms move them, kept as float. With mean and std the warped
+    image is normalized too, in one cv2.transform pass equal to Normalize
+    within float32 rounding.
+    """
+
+    def __init__(self, maxHeight=512, maxWidth=512, scale=(0.1, 1.0), ratio=(1./3, 3.), mean=None, std=None):
+        self.maxHeight = maxHeight
+        self.maxWidth = maxWidth
+        self.crop = RandomResizedLimitCrop(maxHeight=maxHeight, maxWidth=maxWidth, scale=scale, ratio=ratio)
+        self.matrix = None
+        if mean is not None:
+            # (x / 255 - mean) / std of every channel as one 3x4 matrix for cv2.transform
+            self.matrix = np.hstack([np.diag(1 / (255.0 * np.array(std))),
+                                     (-np.array(mean) / np.array(std))[:, None]]).astype(np.float32)
+
+    @staticmethod
+    def get_rotation():
+        """Quarter turns of Rotate, counterclockwise as np.rot90"""
+        prob = np.random.uniform(0, 1)
+        if prob <= 0.2:
+            return 1
+        elif prob <= 0.4:
+            return 3
+        elif prob <= 0.5:
+            return 2
+        return 0
+
+    def __call__(self, image, polygons=None):
+        height, width = image.shape[0], image.shape[1]
+        # (x, y, 1) of every point of the polygons, one row each
+        sizes = [len(polygon.points) for polygon in polygons] if polygons is not None else []
+        points = np.ones((sum(sizes), 3))
+        if sizes:
+            points[:, :2] = np.concatenate([polygon.points.reshape(-1, 2) for polygon in polygons])
+
+        # points: x -> width - x, pixels: x -> width - 1 - x
+        mirror = np.random.randint(10) != 0
+        point_mirror = np.eye(3)
+        pixel_mirror = np.eye(3)
+        if mirror:
+            point_mirror[0] = [-1, 0, width]
+            pixel_mirror[0] = [-1, 0, width - 1]
+        splits = np.cumsum(sizes)[:-1]
+        i, j, h, w = self.crop.get_window(
+            image, np.split(points.dot(point_mirror[:2].T), splits) if sizes else None)
+        # points of the crop scaled to the output, pixels sampled as cv2.resize
+        sx, sy = self.maxWidth / w, self.maxHeight / h
+        point_crop = np.array([[sx, 0, -j * sx], [0, sy, -i * sy], [0, 0, 1]])
+        pixel_crop = np.array([[1 / sx, 0, 0.5 / sx - 0.5 + j], [0, 1 / sy, 0.5 / sy - 0.5 + i], [0, 0, 1]])
+
+        rtimes = self.get_rotation()
+        # quarter turns about the center for the points as Rotate, np.rot90 for the pixels
+        cx, cy = self.maxWidth / 2.0, self.maxHeight / 2.0
+        cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][rtimes]
+        point_rotate = np.array([[cos, sin, cx - cx * cos - cy * sin],
+                                 [-sin, cos, cy + cx * sin - cy * cos], [0, 0, 1]])
+        last_x, last_y = self.maxWidth - 1, self.maxHeight - 1
+        pixel_rotate = [np.eye(3),
+                        np.array([[0, -1, last_x], [1, 0, 0], [0, 0, 1]]),
+                        np.array([[-1, 0, last_x], [0, -1, last_y], [0, 0, 1]]),
+                        np.array([[0, 1, 0], [-1, 0, last_y], [0, 0, 1]])][rtimes]
+        size = (self.maxHeight, self.maxWidth) if rtimes % 2 else (self.maxWidth, self.maxHeight)
+
+        # output pixel -> input pixel, applied by warpAffine with WARP_INVERSE_MAP
+        pixel_map = pixel_mirror.dot(pixel_crop).dot(pixel_rotate)
+        image = cv2.warpAffine(image, pixel_map[:2], size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                               borderMode=cv2.BORDER_REPLICATE)
+        if self.matrix is not None:
+            image = cv2.transform(image.astype(np.float32), self.matrix)
+        if sizes:
+            point_map = point_rotate.dot(point_crop).dot(point_mirror)
+            for polygon, pts in zip(polygons, np.split(points.dot(point_map[:2].T), splits)):
+                polygon.points = pts
+        return image, polygons
+
+
 class Normalize(object):
     def __init__(self, mean, std):
         self.mean = np.array(mean)
@@ -336,6 +449,37 @@ class Normalize(object):
         return image, polygons
 
 
+class Contiguous(object):
+    """Contiguous copy of a mirrored or rotated view, Normalize does it otherwise"""
+
+    def __call__(self, image, polygons=None):
+        return np.ascontiguousarray(image), polygons
+
+
+class BatchNormalize(object):
+    """
+    Normalize of a uint8 (N, C, H, W) batch, the float cast, scale and shift
+    done in one pass on the device of the batch, see build_transforms(normalize=False)
+    """
+
+    def __init__(self, mean, std):
+        self.mean = np.array(mean)
+        self.std = np.array(std)
+        self.params = {}
+
+    def __call__(self, images):
+        if images.dtype != torch.uint8:
+            return images
+        params = self.params.get(images.device)
+        if params is None:
+            # (x / 255 - mean) / std = x * scale + shift
+            scale = torch.tensor(1 / (255.0 * self.std), dtype=torch.float32).view(-1, 1, 1)
+            shift = torch.tensor(-self.mean / self.std, dtype=torch.float32).view(-1, 1, 1)
+            params = self.params[images.device] = (scale.to(images.device), shift.to(images.device))
+        scale, shift = params
+        return torch.addcmul(shift, images.float(), scale)
+
+
 class Resize(object):
     def __init__(self, maxHeight=512, maxWidth=512):
         self.maxHeight = maxHeight
@@ -356,52 +500,150 @@ class Resize(object):
 
 
 class Augmentation(object):
+    """
+    :param fused: (bool), mirror, crop and rotation in one warp, see RandomWarpCrop
+    """
 
-    def __init__(self, maxHeight, maxWidth, mean, std):
+    def __init__(self, maxHeight, maxWidth, mean, std, normalize=True, fused=True):
         self.maxHeight = maxHeight
         self.maxWidth = maxWidth
         self.mean = mean
         self.std = std
+        if fused:
+            # the warped image is contiguous, normalized by the warp itself
+            geometric = [RandomWarpCrop(
+                maxHeight=maxHeight, maxWidth=maxWidth, scale=(0.1, 1.0), ratio=(0.3, 3),
+                mean=mean if normalize else None, std=std if normalize else None)]
+            final = []
+        else:
+            geometric = [
+                RandomMirror(),
+                RandomResizedLimitCrop(
+                    maxHeight=maxHeight, maxWidth=maxWidth, scale=(0.1, 1.0), ratio=(0.3, 3)),
+                Rotate()
+            ]
+            final = [Normalize(mean, std)] if normalize else [Contiguous()]
         self.augmentation = Compose([
             # Padding(),
             # RandomBrightness(),
             # RandomContrast(),
-            RandomMirror(),
-            RandomResizedLimitCrop(
-                maxHeight=maxHeight, maxWidth=maxWidth, scale=(0.1, 1.0), ratio=(0.3, 3)),
-            Rotate(),
+        ] + geometric + [
             # Resize(maxHeight=maxHeight, maxWidth=maxWidth),
-            Normalize(mean, std)
-        ])
+        ] + final)
 
     def __call__(self, image, polygons=None):
         return self.augmentation(image, polygons)
 
 
 class BaseTransform(object):
-    def __init__(self, maxHeight, maxWidth, mean, std):
+    # the same image and polygons always give the same output
+    deterministic = True
+
+    def __init__(self, maxHeight, maxWidth, mean, std, normalize=True):
         self.maxHeight = maxHeight
         self.maxWidth = maxWidth
         self.mean = mean
         self.std = std
         self.augmentation = Compose([
             Resize(maxHeight=maxHeight, maxWidth=maxWidth),
-            Normalize(mean, std)
-        ])
+        ] + ([Normalize(mean, std)] if normalize else [Contiguous()]))
 
     def __call__(self, image, polygons=None):
         return self.augmentation(image, polygons)
 
 
-def build_transforms(maxHeight=1, maxWidth=1, batch_size=1, is_train=True, **kwargs):
-    # use imagenet mean and std as default
-    # TODO: compute dataset-specific mean and std
-    imagenet_mean = [0.485, 0.456, 0.406]
-    imagenet_std = [0.229, 0.224, 0.225]
+class FieldMirror(object):
+    """RandomMirror of the image with its vec and weight targets"""
+
+    def __call__(self, image, vec, weight):
+        if np.random.randint(10):
+            image = image[:, ::-1]
+            vec = vec[:, :, ::-1].copy()
+            # the width component changes sign, 0 - x keeps the zeros positive
+            np.subtract(0, vec[1], out=vec[1])
+            weight = weight[:, ::-1]
+        return image, vec, weight
+
+
+class FieldRotate(object):
+    """Rotate of the image with its vec and weight targets by np.rot90"""
+
+    def __call__(self, image, vec, weight):
+        prob = np.random.uniform(0, 1)
+        if prob <= 0.2:
+            rtimes = 1
+        elif prob <= 0.4:
+            rtimes = 3
+        elif prob <=0.5:
+            rtimes = 2
+        else:
+            return image, vec, weight
+        image = np.rot90(image, rtimes)
+        weight = np.rot90(weight, rtimes)
+        vec = np.rot90(vec, rtimes, axes=(1, 2))
+        # an offset (dy, dx) turns into (-dx, dy) at every quarter turn
+        for _ in range(rtimes):
+            vec = np.stack([0 - vec[1], vec[0]])
+        return image, vec, weight
+
+
+class FieldAugmentation(object):
+    """
+    Augmentation whose mirror and rotation, exact lattice operations, are
+    applied to the image together with its vec and weight targets, so the
+    targets are only computed after the resampling transforms. DetectDataset
+    calls base on the image and polygons, then field_transform on the image
+    and targets, calling it directly transforms the polygons as Augmentation.
+    :param crop: (bool), random resized crop as Augmentation, else resize as
+        BaseTransform, whose targets can be cached
+    :param normalize: (bool), see build_transforms
+    """
+
+    def __init__(self, maxHeight, maxWidth, mean, std, crop=True, normalize=True):
+        self.maxHeight = maxHeight
+        self.maxWidth = maxWidth
+        self.mean = mean
+        self.std = std
+        if crop:
+            self.base = Compose([
+                RandomResizedLimitCrop(
+                    maxHeight=maxHeight, maxWidth=maxWidth, scale=(0.1, 1.0), ratio=(0.3, 3)),
+            ] + ([Normalize(mean, std)] if normalize else [Contiguous()]))
+        else:
+            self.base = BaseTransform(maxHeight, maxWidth, mean, std, normalize=normalize)
+        # mirror and rotation give views, collate needs the image contiguous
+        self.augmentation = Compose([self.base, RandomMirror(), Rotate(), Contiguous()])
+        self.field_augmentation = [FieldMirror(), FieldRotate()]
+
+    def field_transform(self, image, vec, weight):
+        for t in self.field_augmentation:
+            image, vec, weight = t(image, vec, weight)
+        return np.ascontiguousarray(image), np.ascontiguousarray(vec), np.ascontiguousarray(weight)
+
+    def __call__(self, image, polygons=None):
+        return self.augmentation(image, polygons)
+
+
+def build_transforms(maxHeight=1, maxWidth=1, batch_size=1, is_train=True, field_augment=False,
+                     crop=True, normalize=True, fused=True, **kwargs):
+    """
+    :param normalize: (bool), end with Normalize, else the images stay uint8
+        and are normalized by the batch, see batch_normalize
+    :param fused: (bool), see Augmentation
+    """
     # print(maxHeight, maxWidth, batch_size, 'asdasjkdasjkdhaskdhaskjdhjk')
     maxHeight = maxHeight - maxHeight % 32
     maxWidth = maxWidth - maxWidth % 32
+    if is_train and field_augment:
+        return FieldAugmentation(maxHeight, maxWidth, IMAGENET_MEAN, IMAGENET_STD, crop=crop,
+                                 normalize=normalize)
     if is_train:
-        return Augmentation(maxHeight, maxWidth, imagenet_mean, imagenet_std)
+        return Augmentation(maxHeight, maxWidth, IMAGENET_MEAN, IMAGENET_STD, normalize=normalize,
+                            fused=fused)
     else:
-        return BaseTransform(maxHeight, maxWidth, imagenet_mean, imagenet_std)
+        return BaseTransform(maxHeight, maxWidth, IMAGENET_MEAN, IMAGENET_STD, normalize=normalize)
+
+
+def batch_normalize():
+    """BatchNormalize of the images of build_transforms(normalize=False)"""
+    return BatchNormalize(IMAGENET_MEAN, IMAGENET_STD)
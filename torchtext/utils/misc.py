@@ -2,7 +2,6 @@ import numpy as np
 import errno
 import os
 import cv2
-import queue
 
 
 def mkdirs(newdir):
@@ -194,229 +193,3 @@ def split_edge_seqence(points, long_edge, n_parts):
     p_last = points[long_edge[-1][1]]
     splited_result = [p_first] + splited_result + [p_last]
     return np.stack(splited_result)
-
-
-class Coordinate():
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
-
-    def copy(self):
-        return Coordinate(self.x, self.y)
-
-
-def process_output(image, output, raw_img, threshold, min_area):
-    height, width, _ = image.shape
-    pred_x = output[0, :]
-    pred_y = output[1, :]
-
-    magnitude, angle = cv2.cartToPolar(pred_x, pred_y)
-
-    thr = np.array([threshold])
-    mask = cv2.compare(magnitude, thr, cv2.CMP_GT)
-    mask = mask.astype(np.float32)
-
-    parent = np.zeros((height, width, 2), np.float32)
-    ending = np.zeros((height, width), np.float32)
-    merged_ending = np.zeros((height, width), np.float32)
-    PI = np.pi
-    for row in range(0, height):
-        for col in range(0, width):
-            if mask[row][col] == 255:
-                if angle[row][col] < PI/8 or angle[row][col] >= 15*PI/8:
-                    parent[row][col] = [1,0]
-                    if row+1 <= height-1 and mask[row+1][col] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= PI/8 and angle[row][col] < 3*PI/8:
-                    parent[row][col] = [1,1]
-                    if row+1 <= height-1 and col+1 <= width-1 and mask[row+1][col+1] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 3*PI/8 and angle[row][col] < 5*PI/8:
-                    parent[row][col] = [0,1]
-                    if col+1 <= width-1 and mask[row][col+1] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 5*PI/8 and angle[row][col] < 7*PI/8:
-                    parent[row][col] = [-1,1]
-                    if row-1 >= 0 and col+1 <= width-1 and mask[row-1][col+1] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 7*PI/8 and angle[row][col] < 9*PI/8:
-                    parent[row][col] = [-1,0]
-                    if row-1 >= 0 and mask[row-1][col] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 9*PI/8 and angle[row][col] < 11*PI/8:
-                    parent[row][col] = [-1,-1]
-                    if row-1 >= 0 and col-1 >= 0 and mask[row-1][col-1] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 11*PI/8 and angle[row][col] < 13*PI/8:
-                    parent[row][col] = [0,-1]
-                    if col-1 >= 0 and mask[row][col-1] == 0:
-                        ending[row][col] = 1
-                elif angle[row][col] >= 13*PI/8 and angle[row][col] < 15*PI/8:
-                    parent[row][col] = [1,-1]
-                    if row+1 <= height-1 and col-1 >= 0 and mask[row+1][col-1] == 0:
-                        ending[row][col] = 1
-
-    p = Coordinate()
-    pc = Coordinate()
-    pt = Coordinate()
-    visited = np.zeros((height, width), np.float32)
-    dict_id = np.zeros((height, width, 2), np.float32)
-    # blob lableing to construct trees encoded by P
-    # get depth each pixel in text instance
-    sup_idx = 1
-    for row in range(0, height):
-        for col in range(0, width):
-            if mask[row][col] == 255 and visited[row][col] == 0:
-                p.x = row
-                p.y = col
-                Q = queue.Queue()
-                Q.put(p)
-                while not Q.empty():
-                    pc = Q.get()
-                    dict_id[pc.x][pc.y][0] = sup_idx
-                    visited[pc.x][pc.y] = 1
-                    for dx in range(-1, 2):
-                        for dy in range(-1, 2):
-                            pt.x = pc.x + dx
-                            pt.y = pc.y + dy
-                            if pt.x >= 0 and pt.x <= height-1 and pt.y >= 0 and pt.y <= width-1:
-                                if visited[pt.x][pt.y] == 0 and (parent[pt.x][pt.y][0] != 0 or parent[pt.x][pt.y][1] != 0):
-                                    if parent[pt.x][pt.y][0] == -1*dx and parent[pt.x][pt.y][1] == -1*dy:
-                                        Q.put(pt.copy())
-                                        dict_id[pc.x][pc.y][1] = max(
-                                            dict_id[pc.x][pc.y][1], dict_id[pt.x][pt.y][1]+1)
-                                    elif parent[pc.x][pc.y][0] == 1*dx and parent[pc.x][pc.y][1] == 1*dy:
-                                        Q.put(pt.copy())
-                                        dict_id[pt.x][pt.y][1] = max(
-                                            dict_id[pt.x][pt.y][1], dict_id[pc.x][pc.y][1]+1)
-                sup_idx += 1
-
-    element = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    # fill hole in ending
-    merged_ending = cv2.dilate(
-        ending, element, iterations=5).astype(np.float32)
-    # dilate ending
-    for row in range(0, height):
-        for col in range(0, width):
-            if ending[row][col] == 1:
-                for dilDepth in range(1, min(int(1*dict_id[row][col][1]-16), 12)+1):
-                    p.x = row+int(parent[row][col][0]*dilDepth)
-                    p.y = col+int(parent[row][col][1]*dilDepth)
-                    if p.x >= 0 and p.x <= height-1 and pt.y >= 0 and pt.y <= width-1:
-                        merged_ending[p.x][p.y] = 1
-
-    # find connected Components
-    cctmp = merged_ending.astype(np.uint8)
-    # ccnum: num component, cctmp: mask component
-    ccnum, cctmp = cv2.connectedComponents(
-        cctmp, connectivity=8, ltype=cv2.CV_16U)
-    label = cctmp.astype(np.float32)
-
-    sup_map_cc = np.zeros((sup_idx), np.int32)
-    stat = np.zeros((ccnum, 8), np.int32)
-    # calculate num stat each label and assign label each sup_idx
-    for row in range(0, height):
-        for col in range(0, width):
-            if ending[row][col] == 1:
-                dx = int(parent[row][col][0])
-                dy = int(parent[row][col][1])
-                cc_idx = int(label[row][col])
-                sup_map_cc[int(dict_id[row][col][0])] = cc_idx
-                if dx == 1 and dy == 0:  # down
-                    stat[cc_idx][0] += 1
-                if dx == 1 and dy == 1:  # down right
-                    stat[cc_idx][1] += 1
-                if dx == 0 and dy == 1:  # right
-                    stat[cc_idx][2] += 1
-                if dx == -1 and dy == 1:  # up right
-                    stat[cc_idx][3] += 1
-                if dx == -1 and dy == 0:  # up
-                    stat[cc_idx][4] += 1
-                if dx == -1 and dy == -1:  # up left
-                    stat[cc_idx][5] += 1
-                if dx == 0 and dy == -1:  # left
-                    stat[cc_idx][6] += 1
-                if dx == 1 and dy == -1:  # down left
-                    stat[cc_idx][7] += 1
-
-    cc_map_filted = np.zeros((ccnum), np.int32)
-    filted_idx = 1
-    # Filter unblanced Text
-    for cc_idx in range(1, ccnum):
-        dif1 = np.abs(stat[cc_idx][0] - stat[cc_idx][4])  # abs(down - up)
-        # abs(down_right - up_left)
-        dif2 = np.abs(stat[cc_idx][1] - stat[cc_idx][5])
-        dif3 = np.abs(stat[cc_idx][2] - stat[cc_idx][6])  # abs(right - left)
-        # abs(down_left - up_right)
-        dif4 = np.abs(stat[cc_idx][3] - stat[cc_idx][7])
-        sum1 = stat[cc_idx][0]+stat[cc_idx][1]+stat[cc_idx][2]+stat[cc_idx][3]
-        sum2 = stat[cc_idx][4]+stat[cc_idx][5]+stat[cc_idx][6]+stat[cc_idx][7]
-        difsum = np.abs(sum1-sum2)
-        sum_total = sum1 + sum2
-        ratio1 = float(difsum) / float(sum_total)
-        ratio2 = float(dif1+dif2+dif3+dif4) / float(sum_total)
-        # keep candidate have low ratio (high opposite directions)
-        # <=0.6 mean >40% opposite directions
-        if ratio1 <= 0.6 and ratio2 <= 0.6:
-            cc_map_filted[cc_idx] = filted_idx
-            filted_idx += 1
-
-    # filter candidate
-    for row in range(0, height):
-        for col in range(0, width):
-            if label[row][col] == 0:
-                label[row][col] = cc_map_filted[int(
-                    sup_map_cc[int(dict_id[row][col][0])])]
-            else:
-                label[row][col] = cc_map_filted[int(label[row][col])]
-
-    res = np.zeros((height, width), np.float32)
-    element_ = cv2.getStructuringElement(cv2.MORPH_RECT, (11, 11))
-    # get result mask
-    for i in range(1, filted_idx):
-        clstmp = cv2.compare(label, np.array([i]), cv2.CMP_EQ)
-        clstmp = cv2.dilate(clstmp, element_, iterations=1)
-        clstmp = cv2.erode(clstmp, element_, iterations=1)
-        clstmp = cv2.compare(clstmp, np.array([0]), cv2.CMP_GT)
-        clstmp = clstmp.astype(np.float32)
-        res = cv2.multiply(res, 1-clstmp/255)
-        res = cv2.add(res, clstmp/255*i)
-
-    return seg2bbox(res, cv2.resize(raw_img, (width, height)), raw_img, min_area)
-
-
-def seg2bbox(seg, img_resize, raw_img, min_area):
-    list_cnt = []
-    ratio_height, ratio_width = raw_img.shape[0] / \
-        img_resize.shape[0], raw_img.shape[1]/img_resize.shape[1]
-    min_area = min_area / ratio_height / ratio_width
-    if np.amax(seg) == 0:
-        return list_cnt
-    filtered_seg = 0
-    for idx in range(int(np.amax(seg))):
-        seg_mask = (seg == (idx+1)).astype(np.uint8)
-        if np.sum(seg_mask) <= int(min_area):
-            filtered_seg += 1
-            continue
-    if np.amax(seg) == filtered_seg:
-        return list_cnt
-
-    for idx in range(int(np.amax(seg))):
-        seg_mask = (seg == (idx+1)).astype(np.uint8)
-
-        if np.sum(seg_mask) <= int(min_area):
-            filtered_seg += 1
-            continue
-        _, contours, _ = cv2.findContours(
-            seg_mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        maxc, maxc_idx = 0, 0
-
-        for i in range(len(contours)):
-            if len(contours[i]) > maxc:
-                maxc = len(contours[i])
-                maxc_idx = i
-        cnt = contours[maxc_idx]
-        cnt = cnt.squeeze()
-        cnt = np.int0(cnt*[ratio_width, ratio_height])
-        list_cnt.append(cnt)
-    return list_cnt
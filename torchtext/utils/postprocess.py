@@ -0,0 +1,743 @@
+import os
+import warnings
+import numpy as np
+import cv2
+
+from torchtext.utils.misc import mkdirs
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# (row, col) step towards the neighbour pointed by each direction code, codes
+# follow the angle bins: down, down right, right, up right, up, up left, left,
+# down left
+DIRECTION_OFFSETS = np.array([[1, 0], [1, 1], [0, 1], [-1, 1],
+                              [-1, 0], [-1, -1], [0, -1], [1, -1]], np.int32)
+
+# an ending is drawn forward by min(depth - RAY_START, RAY_LENGTH) pixels, so
+# depth is clipped at RAY_START + RAY_LENGTH
+RAY_START = 16
+RAY_LENGTH = 12
+
+# direction code of a (row, col) step, indexed by step + 1
+_DIRECTION_CODE = np.zeros((3, 3), np.int64)
+_DIRECTION_CODE[DIRECTION_OFFSETS[:, 0] + 1, DIRECTION_OFFSETS[:, 1] + 1] = np.arange(8)
+
+
+# Reference kernels, plain loops over the pixels. The numba backend compiles
+# these same functions.
+
+def _quantize_direction_loop(mask, angle):
+    height, width = mask.shape
+    parent = np.zeros((height, width, 2), np.float32)
+    ending = np.zeros((height, width), np.float32)
+    PI = np.pi
+    for row in range(height):
+        for col in range(width):
+            if mask[row, col] != 255:
+                continue
+            code = 0
+            for k in range(1, 8):
+                if angle[row, col] >= (2*k-1)*PI/8 and angle[row, col] < (2*k+1)*PI/8:
+                    code = k
+            dx = DIRECTION_OFFSETS[code, 0]
+            dy = DIRECTION_OFFSETS[code, 1]
+            parent[row, col, 0] = dx
+            parent[row, col, 1] = dy
+            x = row + dx
+            y = col + dy
+            if x >= 0 and x <= height-1 and y >= 0 and y <= width-1 and mask[x, y] == 0:
+                ending[row, col] = 1
+    return parent, ending
+
+
+def _label_trees_loop(parent, max_depth):
+    height, width = parent.shape[:2]
+    dict_id = np.zeros((height, width, 2), np.float32)
+    visited = np.zeros((height, width), np.uint8)
+    # the queue of one tree, a pixel is queued again only where the two sides
+    # of a loop reach it, so twice at most
+    queue = np.zeros(2 * height * width + 1, np.int64)
+    sup_idx = 1
+    for row in range(height):
+        for col in range(width):
+            if visited[row, col] == 1 or (parent[row, col, 0] == 0 and parent[row, col, 1] == 0):
+                continue
+            queue[0] = row * width + col
+            head = 0
+            tail = 1
+            while head < tail:
+                x = queue[head] // width
+                y = queue[head] % width
+                head += 1
+                dict_id[x, y, 0] = sup_idx
+                visited[x, y] = 1
+                for dx in range(-1, 2):
+                    for dy in range(-1, 2):
+                        u = x + dx
+                        v = y + dy
+                        if u < 0 or u > height-1 or v < 0 or v > width-1:
+                            continue
+                        if visited[u, v] == 1 or (parent[u, v, 0] == 0 and parent[u, v, 1] == 0):
+                            continue
+                        if parent[u, v, 0] == -dx and parent[u, v, 1] == -dy:
+                            queue[tail] = u * width + v
+                            tail += 1
+                            dict_id[x, y, 1] = max(dict_id[x, y, 1], dict_id[u, v, 1] + 1)
+                        elif parent[x, y, 0] == dx and parent[x, y, 1] == dy:
+                            queue[tail] = u * width + v
+                            tail += 1
+                            dict_id[u, v, 1] = max(dict_id[u, v, 1], dict_id[x, y, 1] + 1)
+            sup_idx += 1
+    for row in range(height):
+        for col in range(width):
+            dict_id[row, col, 1] = min(dict_id[row, col, 1], max_depth)
+    return dict_id, sup_idx
+
+
+def _dilate_ending_loop(ending, parent, dict_id, merged_ending, ray_start, ray_length):
+    height, width = ending.shape
+    for row in range(height):
+        for col in range(width):
+            if ending[row, col] == 1:
+                for dilDepth in range(1, min(int(dict_id[row, col, 1]) - ray_start, ray_length) + 1):
+                    x = row + int(parent[row, col, 0]) * dilDepth
+                    y = col + int(parent[row, col, 1]) * dilDepth
+                    if x >= 0 and x <= height-1 and y >= 0 and y <= width-1:
+                        merged_ending[x, y] = 1
+
+
+def _component_stats_loop(ending, parent, dict_id, label, sup_idx, ccnum):
+    height, width = ending.shape
+    sup_map_cc = np.zeros(sup_idx, np.int32)
+    stat = np.zeros((ccnum, 8), np.int32)
+    for row in range(height):
+        for col in range(width):
+            if ending[row, col] == 1:
+                cc_idx = int(label[row, col])
+                sup_map_cc[int(dict_id[row, col, 0])] = cc_idx
+                for k in range(8):
+                    if parent[row, col, 0] == DIRECTION_OFFSETS[k, 0] and parent[row, col, 1] == DIRECTION_OFFSETS[k, 1]:
+                        stat[cc_idx, k] += 1
+    return sup_map_cc, stat
+
+
+def _filter_components_loop(stat, max_ratio):
+    ccnum = stat.shape[0]
+    cc_map_filted = np.zeros(ccnum, np.int32)
+    filted_idx = 1
+    for cc_idx in range(1, ccnum):
+        # abs(down - up) + abs(down_right - up_left) + ...
+        dif = 0
+        for k in range(4):
+            dif += abs(stat[cc_idx, k] - stat[cc_idx, k + 4])
+        sum1 = stat[cc_idx, 0] + stat[cc_idx, 1] + stat[cc_idx, 2] + stat[cc_idx, 3]
+        sum2 = stat[cc_idx, 4] + stat[cc_idx, 5] + stat[cc_idx, 6] + stat[cc_idx, 7]
+        sum_total = sum1 + sum2
+        ratio1 = float(abs(sum1 - sum2)) / float(sum_total)
+        ratio2 = float(dif) / float(sum_total)
+        if ratio1 <= max_ratio and ratio2 <= max_ratio:
+            cc_map_filted[cc_idx] = filted_idx
+            filted_idx += 1
+    return cc_map_filted, filted_idx
+
+
+def _remap_label_loop(label, dict_id, sup_map_cc, cc_map_filted):
+    height, width = label.shape
+    for row in range(height):
+        for col in range(width):
+            if label[row, col] == 0:
+                label[row, col] = cc_map_filted[sup_map_cc[int(dict_id[row, col, 0])]]
+            else:
+                label[row, col] = cc_map_filted[int(label[row, col])]
+    return label
+
+
+def _assemble_mask_full(label, filted_idx, ksize):
+    height, width = label.shape
+    res = np.zeros((height, width), np.float32)
+    element_ = cv2.getStructuringElement(cv2.MORPH_RECT, (ksize, ksize))
+    for i in range(1, filted_idx):
+        clstmp = cv2.compare(label, np.array([i]), cv2.CMP_EQ)
+        clstmp = cv2.dilate(clstmp, element_, iterations=1)
+        clstmp = cv2.erode(clstmp, element_, iterations=1)
+        clstmp = cv2.compare(clstmp, np.array([0]), cv2.CMP_GT)
+        clstmp = clstmp.astype(np.float32)
+        res = cv2.multiply(res, 1-clstmp/255)
+        res = cv2.add(res, clstmp/255*i)
+    return res
+
+
+def _direction_code(angle):
+    # bins are [PI/8, 3*PI/8) ... [13*PI/8, 15*PI/8), the rest goes back to
+    # code 0, edges are compared in float64 like the scalar loop did
+    edges = np.arange(1, 16, 2) * np.pi / 8
+    code = np.searchsorted(edges, angle.astype(np.float64), side='right')
+    code[code == 8] = 0
+    return code
+
+
+def quantize_direction(mask, angle):
+    """
+    Quantize the field angle of every text pixel into 8 direction codes
+    :param mask: (np.array), (H, W) 255 on text pixels, 0 elsewhere
+    :param angle: (np.array), (H, W) angle in radian given by cv2.cartToPolar
+    :return: parent (H, W, 2) step to the pointed neighbour,
+             ending (H, W) 1 where the pointed neighbour is inside the image but not text
+    """
+    height, width = mask.shape
+    text = mask == 255
+    code = _direction_code(angle)
+
+    parent = np.zeros((height, width, 2), np.float32)
+    parent[text] = DIRECTION_OFFSETS[code[text]]
+
+    # neighbours outside the image never make an ending
+    background = np.zeros((height + 2, width + 2), bool)
+    background[1:height + 1, 1:width + 1] = mask == 0
+    ending = np.zeros((height, width), np.float32)
+    for k, (dx, dy) in enumerate(DIRECTION_OFFSETS):
+        shifted = background[1 + dx:1 + dx + height, 1 + dy:1 + dy + width]
+        ending[text & (code == k) & shifted] = 1
+    return parent, ending
+
+
+def _union_trees(src, dst, num_node):
+    # hook the larger root under the smaller one, then jump every pointer to
+    # its root, until both ends of every edge share a root
+    root = np.arange(num_node)
+    while True:
+        root_src = root[src]
+        root_dst = root[dst]
+        joined = root_src != root_dst
+        if not joined.any():
+            break
+        root[np.maximum(root_src[joined], root_dst[joined])] = np.minimum(
+            root_src[joined], root_dst[joined])
+        while True:
+            jumped = root[root]
+            if np.array_equal(jumped, root):
+                break
+            root = jumped
+    return root
+
+
+def _bfs_depth(step_x, step_y, target, src, dst, root):
+    num_node = len(target)
+    num_child = np.bincount(dst, minlength=num_node)
+    # a pixel popped from the queue is one deeper than its unvisited children,
+    # which are all still at 0
+    depth = (num_child > 0).astype(np.int64)
+
+    # only the parent chain of the first pixel of a tree is reached through
+    # its child: the depth grows by one on every step, starting one deeper
+    # when a child of the first pixel is scanned before its parent
+    scan = (step_x + 1) * 3 + step_y + 1
+    child_scan = np.full(num_node, 9, np.int64)
+    np.minimum.at(child_scan, dst, 8 - scan[src])
+    current = np.flatnonzero(root == np.arange(num_node))
+    level = 1 + (child_scan[current] < scan[current])
+    # depth given along the chain, -1 off the chains
+    walked = np.full(num_node, -1, np.int64)
+    walked[current] = level - 1
+    entries, closes = [], []
+    while len(current):
+        step = target[current]
+        keep = step >= 0
+        back = keep.copy()
+        back[keep] = target[step[keep]] == current[keep]
+        # the chain stops at a mutual pair, the child it was reached from
+        # is visited already
+        depth[step[back]] = num_child[step[back]] > 1
+        keep &= ~back
+        # or once it has gone round a loop of three pixels or more
+        loop = keep.copy()
+        loop[keep] = walked[step[keep]] >= 0
+        entries.append(step[loop])
+        closes.append(current[loop])
+        keep &= ~loop
+        current, level = step[keep], level[keep]
+        depth[current] = level
+        walked[current] = level
+        level = level + 1
+
+    entry = np.concatenate(entries)
+    if len(entry):
+        # the queue goes round a loop both ways from the pixel the chain
+        # entered it by, the chain keeps counting up to where both sides
+        # meet: one step past half the loop, or half the loop when it is
+        # even and the queue reaches the side closing the loop first
+        close = np.concatenate(closes)
+        length = walked[close] - walked[entry] + 1
+        forward_first = scan[entry] < 8 - scan[close]
+        reach = np.full(num_node, np.iinfo(np.int64).max)
+        reach[root[entry]] = walked[entry] + length // 2 + ((length % 2 == 1) | forward_first)
+        met = walked > reach[root]
+        depth[met] = num_child[met] > 0
+    return depth
+
+
+def _label_forest(node, step_x, step_y, height, width, max_depth=None):
+    """
+    Tree id and depth of every text pixel, see label_trees
+    :param node: (np.array), (N,) flat index of the text pixels, ascending
+    :param step_x, step_y: (np.array), (N,) step to the pointed pixel
+    :return: tree_id (N,), depth (N,)
+    """
+    num_node = len(node)
+    rows, cols = np.divmod(node, width)
+    rows = rows + step_x
+    cols = cols + step_y
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    target = np.where(inside, rows * width + cols, -1)
+    # edge i -> target[i] when the parent pixel is text too
+    position = np.minimum(np.searchsorted(node, target), num_node - 1)
+    target = np.where((target >= 0) & (node[position] == target), position, -1)
+    src = np.flatnonzero(target >= 0)
+    dst = target[src]
+
+    root = _union_trees(src, dst, num_node)
+    # roots are the first pixel of their tree, number them in raster order
+    tree_id = np.cumsum(root == np.arange(num_node))[root]
+
+    depth = _bfs_depth(step_x, step_y, target, src, dst, root)
+    if max_depth is not None:
+        depth = np.minimum(depth, max_depth)
+    return tree_id, depth
+
+
+def label_trees(parent, max_depth=None):
+    """
+    Label the trees encoded by parent with array-wide pointer jumping. The
+    depth is the one set by a breadth-first walk from the first pixel of each
+    tree in raster order, worked out over the arrays
+    :param parent: (np.array), (H, W, 2) step to the parent pixel, 0 off text
+    :param max_depth: (int), depths are clipped to it, None keeps them
+    :return: dict_id (H, W, 2) tree id starting from 1 in raster order of the
+             first pixel of each tree, and depth; sup_idx the number of trees + 1
+    """
+    height, width = parent.shape[:2]
+    dict_id = np.zeros((height, width, 2), np.float32)
+    step_x = parent[:, :, 0].astype(np.int64).ravel()
+    step_y = parent[:, :, 1].astype(np.int64).ravel()
+    node = np.flatnonzero((step_x != 0) | (step_y != 0))
+    if len(node) == 0:
+        return dict_id, 1
+
+    tree_id, depth = _label_forest(node, step_x[node], step_y[node], height, width, max_depth)
+    dict_id.reshape(-1, 2)[node, 0] = tree_id
+    dict_id.reshape(-1, 2)[node, 1] = depth
+    return dict_id, int(tree_id.max()) + 1
+
+
+def _draw_rays(merged_ending, rows, cols, step_x, step_y, depth, ray_start, ray_length):
+    height, width = merged_ending.shape
+    reach = np.minimum(depth - ray_start, ray_length)
+    for dilDepth in range(1, ray_length + 1):
+        keep = reach >= dilDepth
+        x = rows[keep] + step_x[keep] * dilDepth
+        y = cols[keep] + step_y[keep] * dilDepth
+        inside = (x >= 0) & (x < height) & (y >= 0) & (y < width)
+        merged_ending[x[inside], y[inside]] = 1
+
+
+def dilate_ending(ending, parent, dict_id, merged_ending, ray_start=RAY_START, ray_length=RAY_LENGTH):
+    """
+    Draw every ending forward along its direction, as far as its depth allows,
+    rays stop at the image border. The loop this replaces checked the row of
+    each ray pixel but a column left over from the tree labeling, so rays
+    leaving by the left or right border wrapped around or raised IndexError
+    :param merged_ending: (np.array), (H, W) updated in place
+    :param ray_start: (int), endings shallower than this are not drawn
+    :param ray_length: (int), longest ray in pixels
+    """
+    rows, cols = np.nonzero(ending == 1)
+    _draw_rays(merged_ending, rows, cols,
+               parent[rows, cols, 0].astype(np.int64),
+               parent[rows, cols, 1].astype(np.int64),
+               dict_id[rows, cols, 1].astype(np.int64), ray_start, ray_length)
+
+
+def _count_directions(cc_idx, code, tree, sup_idx, ccnum):
+    stat = np.bincount(cc_idx * 8 + code, minlength=ccnum * 8)
+    stat = stat.reshape(ccnum, 8).astype(np.int32)
+
+    sup_map_cc = np.zeros(sup_idx, np.int32)
+    _, last = np.unique(tree[::-1], return_index=True)
+    last = len(tree) - 1 - last
+    sup_map_cc[tree[last]] = cc_idx[last]
+    return sup_map_cc, stat
+
+
+def component_stats(ending, parent, dict_id, label, sup_idx, ccnum):
+    """
+    Count the endings of each connected component per direction code
+    :return: sup_map_cc (sup_idx,) component of every tree, taken from its
+             last ending in raster order, stat (ccnum, 8) direction histogram
+    """
+    rows, cols = np.nonzero(ending == 1)
+    code = _DIRECTION_CODE[parent[rows, cols, 0].astype(np.int64) + 1,
+                           parent[rows, cols, 1].astype(np.int64) + 1]
+    return _count_directions(label[rows, cols].astype(np.int64), code,
+                             dict_id[rows, cols, 0].astype(np.int64), sup_idx, ccnum)
+
+
+def filter_components(stat, max_ratio):
+    """
+    Keep the components whose endings mostly face each other
+    :param max_ratio: (float), upper bound of both unbalance ratios
+    :return: cc_map_filted (ccnum,) new label of every kept component (0 if
+             dropped), filted_idx the number of kept components + 1
+    """
+    sum1 = stat[:, :4].sum(axis=1).astype(np.float64)
+    sum2 = stat[:, 4:].sum(axis=1).astype(np.float64)
+    dif = np.abs(stat[:, :4] - stat[:, 4:]).sum(axis=1)
+    sum_total = sum1 + sum2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        keep = (np.abs(sum1 - sum2) / sum_total <= max_ratio) & \
+            (dif / sum_total <= max_ratio)
+    keep[0] = False
+    cc_map_filted = np.zeros(len(stat), np.int32)
+    cc_map_filted[keep] = np.arange(1, keep.sum() + 1)
+    return cc_map_filted, int(keep.sum()) + 1
+
+
+def remap_label(label, dict_id, sup_map_cc, cc_map_filted):
+    """
+    Give every pixel the filtered label of its component, pixels outside the
+    merged endings take the component of their tree
+    """
+    cc_idx = label.astype(np.int64)
+    outside = cc_idx == 0
+    cc_idx[outside] = sup_map_cc[dict_id[:, :, 0][outside].astype(np.int64)]
+    return cc_map_filted[cc_idx].astype(np.float32)
+
+
+def _group_labels(ids, rows, cols):
+    # pixels sorted by label, with the first pixel and the box of each label
+    order = np.argsort(ids, kind='stable')
+    ids, rows, cols = ids[order], rows[order], cols[order]
+    present, start = np.unique(ids, return_index=True)
+    if len(present) == 0:
+        return present, start, start, start, start, start, rows, cols
+    return (present, start, np.minimum.reduceat(rows, start), np.maximum.reduceat(rows, start),
+            np.minimum.reduceat(cols, start), np.maximum.reduceat(cols, start), rows, cols)
+
+
+def label_boxes(label):
+    """
+    Bounding box of every label present in an integer label map
+    :return: present labels (ascending, 0 excluded) with their top, bottom,
+             left and right pixel, bounds included
+    """
+    rows, cols = np.nonzero(label)
+    present, _, top, bottom, left, right, _, _ = _group_labels(label[rows, cols], rows, cols)
+    return present, top, bottom, left, right
+
+
+def _paint_closed(res, ids, rows, cols, filted_idx, ksize):
+    height, width = res.shape
+    element_ = cv2.getStructuringElement(cv2.MORPH_RECT, (ksize, ksize))
+    # the closing of a label stays within ksize // 2 of its box, and reads
+    # ksize // 2 further when eroding
+    pad = 2 * (ksize // 2)
+    present, start, top, bottom, left, right, rows, cols = _group_labels(ids, rows, cols)
+    end = np.append(start[1:], len(ids))
+    for i, s, e, t, b, l, r in zip(present, start, end, top, bottom, left, right):
+        if i >= filted_idx:
+            continue
+        t, l = max(t - pad, 0), max(l - pad, 0)
+        b, r = min(b + pad + 1, height), min(r + pad + 1, width)
+        clstmp = np.zeros((b - t, r - l), np.uint8)
+        clstmp[rows[s:e] - t, cols[s:e] - l] = 1
+        clstmp = cv2.dilate(clstmp, element_, iterations=1)
+        clstmp = cv2.erode(clstmp, element_, iterations=1)
+        res[t:b, l:r][clstmp > 0] = i
+
+
+def assemble_mask(label, filted_idx, ksize=11):
+    """
+    Close every label with a ksize x ksize square and paint it over the
+    previous ones, working inside the bounding box of each label only
+    :return: res (H, W) float32, later labels win where closings overlap
+    """
+    res = np.zeros(label.shape, np.float32)
+    label = label.astype(np.int32)
+    rows, cols = np.nonzero(label)
+    _paint_closed(res, label[rows, cols], rows, cols, filted_idx, ksize)
+    return res
+
+
+def segment_sparse(mask, angle, max_ratio, ending_iterations, ksize, ray_start, ray_length):
+    """
+    Same result as the dense stages, computed on the list of text pixels so
+    that no (H, W) map is built for the trees, endings or labels
+    :param mask: (np.array), (H, W) 255 on text pixels, 0 elsewhere
+    :param angle: (np.array), (H, W) angle in radian given by cv2.cartToPolar
+    :param max_ratio: (float), see filter_components
+    :param ending_iterations, ksize, ray_start, ray_length: see process_output
+    :return: res (H, W) float32 instance mask
+    """
+    height, width = mask.shape
+    mask = mask.ravel()
+    node = np.flatnonzero(mask == 255)
+    res = np.zeros((height, width), np.float32)
+    if len(node) == 0:
+        return res
+
+    rows, cols = np.divmod(node, width)
+    code = _direction_code(angle.ravel()[node])
+    step_x = DIRECTION_OFFSETS[code, 0].astype(np.int64)
+    step_y = DIRECTION_OFFSETS[code, 1].astype(np.int64)
+    x = rows + step_x
+    y = cols + step_y
+    inside = (x >= 0) & (x < height) & (y >= 0) & (y < width)
+    target = np.where(inside, x * width + y, -1)
+    ending = inside & (mask[np.maximum(target, 0)] == 0)
+    tree_id, depth = _label_forest(node, step_x, step_y, height, width, ray_start + ray_length)
+
+    element = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    merged_ending = np.zeros((height, width), np.uint8)
+    merged_ending.ravel()[node[ending]] = 1
+    merged_ending = cv2.dilate(merged_ending, element, iterations=ending_iterations)
+    _draw_rays(merged_ending, rows[ending], cols[ending],
+               step_x[ending], step_y[ending], depth[ending], ray_start, ray_length)
+    ccnum, cctmp = cv2.connectedComponents(
+        merged_ending, connectivity=8, ltype=cv2.CV_16U)
+    cctmp = cctmp.ravel()
+
+    sup_map_cc, stat = _count_directions(
+        cctmp[node[ending]].astype(np.int64), code[ending], tree_id[ending],
+        int(tree_id.max()) + 1, ccnum)
+    cc_map_filted, filted_idx = filter_components(stat, max_ratio)
+
+    # merged endings keep their component, the other text pixels take the
+    # component of their tree
+    merged = np.flatnonzero(cctmp)
+    loose = cctmp[node] == 0
+    index = np.concatenate([merged, node[loose]])
+    label = np.concatenate([cc_map_filted[cctmp[merged]],
+                            cc_map_filted[sup_map_cc[tree_id[loose]]]])
+    index, label = index[label > 0], label[label > 0]
+    _paint_closed(res, label, index // width, index % width, filted_idx, ksize)
+    return res
+
+
+def _no_dump(name, array):
+    pass
+
+
+class DebugDump(object):
+    """Debug callback of process_output, writes every intermediate map to a png.
+
+    Scalar maps are drawn in white scaled by their value clipped to [0, 1],
+    the parent map gets one colour per direction code, label maps one colour
+    per label.
+
+    Args:
+    - folder (str): output folder, created if missing.
+    - prefix (str): prepended to the file names, e.g. the image name.
+    """
+    label_maps = ('label', 'result')
+
+    def __init__(self, folder, prefix='', num_colors=2000):
+        mkdirs(folder)
+        self.folder = folder
+        self.prefix = prefix
+        self.palette = np.random.RandomState(0).randint(
+            0, 255, (num_colors, 3)).astype(np.uint8)
+        self.palette[0] = 0
+
+    def colorize(self, name, array):
+        if array.ndim == 3:
+            # parent steps, 0 off text and code + 1 on text
+            step_x = array[:, :, 0].astype(np.int64)
+            step_y = array[:, :, 1].astype(np.int64)
+            index = np.where((step_x != 0) | (step_y != 0),
+                             _DIRECTION_CODE[step_x + 1, step_y + 1] + 1, 0)
+            return self.palette[index]
+        if name in self.label_maps:
+            index = array.astype(np.int64)
+            return self.palette[np.where(index > 0, (index - 1) % (len(self.palette) - 1) + 1, 0)]
+        value = (np.clip(array, 0, 1) * 255).astype(np.uint8)
+        return np.repeat(value[:, :, None], 3, axis=2)
+
+    def __call__(self, name, array):
+        cv2.imwrite(os.path.join(self.folder, self.prefix + name + '.png'),
+                    self.colorize(name, np.asarray(array)))
+
+
+_loop_kernels = {
+    'quantize_direction': _quantize_direction_loop,
+    'label_trees': _label_trees_loop,
+    'dilate_ending': _dilate_ending_loop,
+    'component_stats': _component_stats_loop,
+    'filter_components': _filter_components_loop,
+    'remap_label': _remap_label_loop,
+}
+
+__backend_factory = {
+    'python': dict(_loop_kernels, assemble_mask=_assemble_mask_full),
+    'numpy': {
+        'quantize_direction': quantize_direction,
+        'label_trees': label_trees,
+        'dilate_ending': dilate_ending,
+        'component_stats': component_stats,
+        'filter_components': filter_components,
+        'remap_label': remap_label,
+        'assemble_mask': assemble_mask,
+        'segment_sparse': segment_sparse,
+    },
+}
+if numba is not None:
+    # the mask assembly is a few OpenCV calls per label, numba has nothing to
+    # compile there
+    __backend_factory['numba'] = dict(
+        {name: numba.njit(cache=True, nogil=True)(kernel)
+         for name, kernel in _loop_kernels.items()},
+        assemble_mask=assemble_mask, segment_sparse=segment_sparse)
+
+
+def init_backend(name=None):
+    """
+    Stage functions of process_output for a backend
+    :param name: (str), 'python', 'numpy' or 'numba', falls back to the
+                 TEXTFIELD_BACKEND environment variable then to 'numpy'
+    :return: (dict), stage name -> function
+    """
+    if name is None:
+        name = os.environ.get('TEXTFIELD_BACKEND', 'numpy')
+    if name == 'numba' and numba is None:
+        warnings.warn('numba is not installed, falling back to the numpy backend')
+        name = 'numpy'
+    if name not in list(__backend_factory.keys()):
+        raise KeyError('Invalid backend, got "{}", but expected to be one of {}'.format(
+            name, ['python', 'numpy', 'numba']))
+    return __backend_factory[name]
+
+
+def process_output(image, output, raw_img, threshold, min_area, max_ratio=0.6, ending_iterations=5,
+                   ksize=11, ray_start=RAY_START, ray_length=RAY_LENGTH, backend=None,
+                   sparse_density=0.05, debug=None):
+    """
+    Text instances of a predicted direction field
+    :param output: (np.array), (2, H, W) predicted field
+    :param raw_img: (np.array), raw image, only its shape is read
+    :param threshold: (float), magnitude above which a pixel is text
+    :param min_area: (int), smallest instance kept, in raw image pixels
+    :param max_ratio: (float), upper bound of the direction unbalance of a
+                      kept instance, see filter_components
+    :param ending_iterations: (int), 3x3 dilations joining nearby endings
+    :param ksize: (int), size of the square closing each instance
+    :param ray_start, ray_length: (int), an ending is drawn forward by
+                                  min(depth - ray_start, ray_length) pixels
+    :param backend: (str), see init_backend
+    :param sparse_density: (float), fraction of text pixels under which the
+                           sparse stage is used, when the backend has one
+    :param debug: (callable), called with (name, array) on every intermediate
+                  map, e.g. DebugDump, always runs the dense stages
+    :return: list of contours, see seg2bbox
+    """
+    stages = init_backend(backend)
+    dump = debug if debug is not None else _no_dump
+    pred_x = output[0, :]
+    pred_y = output[1, :]
+    dump('x_pred', pred_x)
+    dump('y_pred', pred_y)
+
+    magnitude, angle = cv2.cartToPolar(pred_x, pred_y)
+
+    thr = np.array([threshold])
+    mask = cv2.compare(magnitude, thr, cv2.CMP_GT)
+    mask = mask.astype(np.float32)
+    dump('magnitude', magnitude)
+    if debug is not None:
+        # the scaled copy is only made for the callback
+        debug('mask', mask / 255)
+
+    # few text pixels, work on their list instead of full maps
+    if debug is None and 'segment_sparse' in stages and \
+            np.count_nonzero(mask) < sparse_density * mask.size:
+        res = stages['segment_sparse'](mask, angle, max_ratio, ending_iterations,
+                                       ksize, ray_start, ray_length)
+        return seg2bbox(res, raw_img, min_area)
+
+    parent, ending = stages['quantize_direction'](mask, angle)
+    dump('parent', parent)
+    dump('ending', ending)
+
+    # blob lableing to construct trees encoded by P
+    # get depth each pixel in text instance
+    dict_id, sup_idx = stages['label_trees'](parent, ray_start + ray_length)
+
+    element = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    # fill hole in ending
+    merged_ending = cv2.dilate(
+        ending, element, iterations=ending_iterations).astype(np.float32)
+    # dilate ending
+    stages['dilate_ending'](ending, parent, dict_id, merged_ending, ray_start, ray_length)
+    dump('ending_merge', merged_ending)
+
+    # find connected Components
+    cctmp = merged_ending.astype(np.uint8)
+    # ccnum: num component, cctmp: mask component
+    ccnum, cctmp = cv2.connectedComponents(
+        cctmp, connectivity=8, ltype=cv2.CV_16U)
+    label = cctmp.astype(np.float32)
+
+    # calculate num stat each label and assign label each sup_idx
+    sup_map_cc, stat = stages['component_stats'](
+        ending, parent, dict_id, label, sup_idx, ccnum)
+    # Filter unblanced Text
+    # keep candidate have low ratio (high opposite directions)
+    # <= max_ratio mean > 1 - max_ratio opposite directions
+    cc_map_filted, filted_idx = stages['filter_components'](stat, max_ratio)
+    # filter candidate
+    label = stages['remap_label'](label, dict_id, sup_map_cc, cc_map_filted)
+    dump('label', label)
+
+    # get result mask
+    res = stages['assemble_mask'](label, filted_idx, ksize)
+    dump('result', res)
+
+    return seg2bbox(res, raw_img, min_area)
+
+
+def seg2bbox(seg, raw_img, min_area):
+    """
+    Contour of every segment larger than min_area, in raw image coordinates
+    :param seg: (np.array), (H, W) segment ids, 0 on background
+    :param raw_img: (np.array), image seg was predicted for, only its shape is read
+    :param min_area: (int), min segment area in raw image pixels
+    :return: (list), np.array (k, 2) contour (x, y) per segment
+    """
+    list_cnt = []
+    height, width = seg.shape
+    ratio_height, ratio_width = raw_img.shape[0] / height, raw_img.shape[1] / width
+    min_area = min_area / ratio_height / ratio_width
+    seg = seg.astype(np.int32)
+    area = np.bincount(seg.ravel())
+    seg[area[seg] <= int(min_area)] = 0
+
+    for idx, top, bottom, left, right in zip(*label_boxes(seg)):
+        # keep a background border around the crop where the image allows
+        top, left = max(top - 1, 0), max(left - 1, 0)
+        bottom, right = min(bottom + 2, height), min(right + 2, width)
+        seg_mask = (seg[top:bottom, left:right] == idx).astype(np.uint8)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+        contours = cv2.findContours(
+            seg_mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(int(left), int(top)))[-2]
+        maxc, maxc_idx = 0, 0
+
+        for i in range(len(contours)):
+            if len(contours[i]) > maxc:
+                maxc = len(contours[i])
+                maxc_idx = i
+        cnt = contours[maxc_idx]
+        cnt = cnt.squeeze()
+        cnt = np.int0(cnt*[ratio_width, ratio_height])
+        list_cnt.append(cnt)
+    return list_cnt
@@ -21,6 +21,7 @@ from args import argument_parser, image_dataset_kwargs, optimizer_kwargs
 from torchtext.data_manager import DetectImageManager
 from torchtext import models
 from torchtext.losses import TextLoss
+from torchtext.targets import build_targets
 from torchtext.utils.iotools import save_checkpoint, check_isfile
 from torchtext.utils.avgmeter import AverageMeter
 from torchtext.utils.loggers import Logger, RankLogger
@@ -125,7 +126,7 @@ def main():
         model = nn.DataParallel(model).cuda()
 
     print("Initializing image data manager")
-    dm = DetectImageManager(model, use_gpu, **image_dataset_kwargs(args))
+    dm = DetectImageManager(use_gpu, **image_dataset_kwargs(args))
     trainloader = dm.return_dataloaders()
 
     start_time = time.time()
@@ -141,7 +142,8 @@ def main():
         for epoch in range(args.fixbase_epoch):
             start_train_time = time.time()
             train(epoch, model, criterion, optimizer,
-                  trainloader, use_gpu, fixbase=True)
+                  trainloader, use_gpu, fixbase=True, normalize=dm.batch_normalize,
+                  image_reader=dm.image_reader)
             train_time += round(time.time() - start_train_time)
 
         print("Done. All layers are open to train for {} epochs".format(args.max_epoch))
@@ -151,7 +153,8 @@ def main():
         start_train_time = time.time()
         scheduler.step()
         local_loss = train(epoch, model, criterion,
-                           optimizer, trainloader, use_gpu, start_idx=start_idx)
+                           optimizer, trainloader, use_gpu, start_idx=start_idx,
+                           normalize=dm.batch_normalize, image_reader=dm.image_reader)
         start_idx = 0
         train_time += round(time.time() - start_train_time)
 
@@ -181,10 +184,18 @@ def main():
     # ranklogger.show_summary()
 
 
-def train(epoch, model, criterion, optimizer, trainloader, use_gpu, fixbase=False, start_idx=0):
+def train(epoch, model, criterion, optimizer, trainloader, use_gpu, fixbase=False, start_idx=0,
+          normalize=None, image_reader=None):
+    """
+    :param normalize: (BatchNormalize), normalization of the uint8 images of
+        the loader, done on the device after the transfer
+    :param image_reader: (ImageReader), decoder of the loader, its counters
+        are printed at the end of the epoch
+    """
     losses = AverageMeter()
     batch_time = AverageMeter()
     data_time = AverageMeter()
+    image_bytes = AverageMeter()
 
     model.train()
 
@@ -194,15 +205,24 @@ def train(epoch, model, criterion, optimizer, trainloader, use_gpu, fixbase=Fals
         open_all_layers(model)
 
     end = time.time()
+    epoch_start = end
 
     for batch_idx, (imgs, vecs, weights) in enumerate(trainloader):
         # if batch_idx < start_idx:
             # continue
         data_time.update(time.time() - end)
+        image_bytes.update(imgs.numel() * imgs.element_size())
 
-        if use_gpu:
+        if args.batch_targets:
+            # the loader gives the polygons and their don't care flags
+            if use_gpu:
+                imgs = imgs.cuda()
+            vecs, weights = build_targets(imgs.shape, vecs, weights, device=imgs.device)
+        elif use_gpu:
             imgs, vecs, weights = imgs.cuda(
             ), vecs.cuda(), weights.cuda()
+        if normalize is not None:
+            imgs = normalize(imgs)
 
         outputs = model(imgs)
 
@@ -239,6 +259,14 @@ def train(epoch, model, criterion, optimizer, trainloader, use_gpu, fixbase=Fals
                 'step': batch_idx,
             }, False, osp.join(args.save_dir, 'quick_save_checkpoint_ep' + str(epoch + 1) + '_' + str(batch_idx+1)+'.pth.tar'))
         end = time.time()
+    # images of the epoch over its wall-clock time, loading and training
+    print('Images moved per batch: {:.2f} MB, epoch {:.1f} img/s'.format(
+        image_bytes.avg / 2**20, losses.count / max(time.time() - epoch_start, 1e-6)))
+    if args.sparse_targets:
+        print('Targets moved per batch: {:.2f} MB (dense {:.2f} MB)'.format(
+            trainloader.sparse_bytes.avg / 2**20, trainloader.dense_bytes.avg / 2**20))
+    if image_reader is not None:
+        print('=> Image decoding so far\n' + image_reader.summary())
     return losses.avg
 
 